@@ -5,9 +5,10 @@ from django.utils.safestring import mark_safe
 from django.db.models import Count, Q
 from django.utils import timezone
 from .models import (
-    Location, BusCompany, SeatLayout, Bus, Route, RouteStop,
-    Trip, Seat, Booking, BookingSeat, TripSeatAvailability
+    Location, BusCompany, SeatLayout, Bus, Route, RouteStop, PriceCurve,
+    Trip, Seat, Booking, BookingSeat, Payment, TripSeatAvailability, Job, OutboxEmail
 )
+from .booking_ids import is_valid_booking_id, normalize_booking_id
 
 
 @admin.register(Location)
@@ -123,6 +124,13 @@ class RouteStopAdmin(admin.ModelAdmin):
     ordering = ('route', 'stop_order')
 
 
+@admin.register(PriceCurve)
+class PriceCurveAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'min_factor', 'max_factor', 'updated_at')
+    search_fields = ('route__origin__name', 'route__destination__name')
+    readonly_fields = ('updated_at',)
+
+
 class BookingSeatInline(admin.TabularInline):
     model = BookingSeat
     extra = 0
@@ -132,7 +140,7 @@ class BookingSeatInline(admin.TabularInline):
 
 @admin.register(Trip)
 class TripAdmin(admin.ModelAdmin):
-    list_display = ('trip_info', 'bus', 'route', 'departure_time', 'arrival_time', 'base_price', 'status', 'bookings_count', 'occupancy_rate')
+    list_display = ('trip_info', 'bus', 'route', 'departure_time', 'arrival_time', 'base_price', 'fare_factor', 'status', 'bookings_count', 'occupancy_rate')
     list_filter = ('status', 'bus__company', 'route__origin', 'route__destination', 'departure_time')
     search_fields = ('bus__number_plate', 'route__origin__name', 'route__destination__name')
     readonly_fields = ('created_at', 'bookings_count', 'occupancy_rate')
@@ -149,7 +157,7 @@ class TripAdmin(admin.ModelAdmin):
     def occupancy_rate(self, obj):
         total_seats = obj.bus.total_seats
         booked_seats = TripSeatAvailability.objects.filter(
-            trip=obj, is_available=False
+            Q(is_available=False) | ~Q(legs_sold=0), trip=obj
         ).count()
         if total_seats > 0:
             rate = (booked_seats / total_seats) * 100
@@ -182,6 +190,13 @@ class BookingAdmin(admin.ModelAdmin):
     date_hierarchy = 'created_at'
     inlines = [BookingSeatInline]
     
+    def get_search_results(self, request, queryset, search_term):
+        # A well-formed reference is an exact unique-index lookup, not a LIKE scan
+        booking_id = normalize_booking_id(search_term)
+        if is_valid_booking_id(booking_id):
+            return queryset.filter(booking_id=booking_id), False
+        return super().get_search_results(request, queryset, search_term)
+    
     fieldsets = (
         ('Booking Information', {
             'fields': ('booking_id', 'trip', 'status', 'total_amount', 'created_at', 'expires_at', 'is_expired_status')
@@ -287,7 +302,7 @@ class BookingSeatAdmin(admin.ModelAdmin):
 
 @admin.register(TripSeatAvailability)
 class TripSeatAvailabilityAdmin(admin.ModelAdmin):
-    list_display = ('trip_info', 'seat_info', 'is_available', 'reserved_until', 'booking_link', 'is_reservable_status')
+    list_display = ('trip_info', 'seat_info', 'is_available', 'legs_sold', 'reserved_until', 'booking_link', 'is_reservable_status')
     list_filter = ('is_available', 'trip__status', 'seat__seat_class', 'trip__bus__company')
     search_fields = ('trip__bus__number_plate', 'seat__seat_number', 'booking__booking_id')
     readonly_fields = ('trip', 'seat', 'is_reservable_status')
@@ -317,6 +332,47 @@ class TripSeatAvailabilityAdmin(admin.ModelAdmin):
         return False  # Should be created automatically with trips
 
 
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'max_attempts', 'run_at', 'created_at', 'finished_at')
+    list_filter = ('status', 'task')
+    search_fields = ('task',)
+    readonly_fields = ('attempts', 'locked_by', 'locked_until', 'last_error', 'created_at', 'finished_at')
+    actions = ['run_again']
+    
+    def run_again(self, request, queryset):
+        updated = queryset.exclude(status='RUNNING').update(
+            status='PENDING', run_at=timezone.now(), attempts=0, finished_at=None
+        )
+        self.message_user(request, f'{updated} jobs queued to run again.')
+    run_again.short_description = "Run selected jobs again"
+
+
+@admin.register(Payment)
+class PaymentAdmin(admin.ModelAdmin):
+    list_display = ('checkout_request_id', 'booking', 'phone_number', 'amount', 'status', 'mpesa_receipt', 'refund_due', 'created_at', 'callback_received_at')
+    list_filter = ('status', 'refund_due', 'created_at')
+    search_fields = ('checkout_request_id', 'merchant_request_id', 'mpesa_receipt', 'phone_number', 'booking__booking_id')
+    readonly_fields = ('booking', 'merchant_request_id', 'checkout_request_id', 'mpesa_receipt', 'result_code', 'result_desc', 'created_at', 'callback_received_at')
+    list_select_related = ('booking',)
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'to_email', 'subject', 'status', 'attempts', 'send_after', 'created_at', 'sent_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('to_email', 'subject', 'booking__booking_id')
+    readonly_fields = ('booking', 'attempts', 'locked_by', 'locked_until', 'last_error', 'created_at', 'sent_at')
+    actions = ['send_again']
+    
+    def send_again(self, request, queryset):
+        updated = queryset.exclude(status='SENDING').update(
+            status='PENDING', send_after=timezone.now(), attempts=0, sent_at=None
+        )
+        self.message_user(request, f'{updated} emails queued to send again.')
+    send_again.short_description = "Send selected emails again"
+
+
 # Customize admin site header and title
 admin.site.site_header = "Bus Booking Administration"
 admin.site.site_title = "Bus Booking Admin"
@@ -0,0 +1,162 @@
+# allocation.py - Automatic seat assignment for group bookings
+
+from itertools import combinations
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import ALL_LEGS, Bus, Seat
+from .inventory import seat_map
+
+MAX_GROUP_SIZE = 8
+
+# A group may spread over at most this many consecutive rows
+MAX_GROUP_ROWS = 4
+
+# Selection costs: every extra row, every extra block within a row (split by
+# the aisle or a taken seat), and the bonus per window seat when preferred
+ROW_COST = 10
+SPLIT_COST = 4
+WINDOW_BONUS = 1
+
+# Bus seat grids only change when seats or layouts are edited
+SEAT_GRID_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def aisle_columns(layout_data, columns):
+    """
+    Columns with the aisle on their right-hand side.
+
+    Read from layout_data['aisle_after'] when the layout designer stored it,
+    otherwise from the block config, so '2x2' and '2x3' both give {2}.
+    """
+    aisle_after = layout_data.get('aisle_after')
+    if aisle_after is not None:
+        return set(aisle_after) if isinstance(aisle_after, list) else {aisle_after}
+    blocks = [int(part) for part in str(layout_data.get('config', '')).split('x') if part.isdigit()]
+    if len(blocks) > 1:
+        edges, column = set(), 0
+        for block in blocks[:-1]:
+            column += block
+            edges.add(column)
+        return edges
+    return {columns // 2} if columns > 1 else set()
+
+
+def _seat_grid_key(bus_id):
+    return f"seat_grid_{bus_id}"
+
+
+def seat_grid(bus_id):
+    """A bus's active seats as (id, row, column, class, is_window) plus its aisle columns, cached"""
+    grid = cache.get(_seat_grid_key(bus_id))
+    if grid is None:
+        bus = Bus.objects.select_related('seat_layout').get(id=bus_id)
+        seats = [
+            (seat_id, row, column, seat_class, seat_type == 'WINDOW')
+            for seat_id, row, column, seat_class, seat_type in Seat.objects.filter(
+                bus_id=bus_id, is_active=True
+            ).order_by('row_number', 'column_number').values_list(
+                'id', 'row_number', 'column_number', 'seat_class', 'seat_type'
+            )
+        ]
+        layout = bus.seat_layout
+        grid = {'seats': seats, 'aisles': aisle_columns(layout.layout_data or {}, layout.columns)}
+        cache.set(_seat_grid_key(bus_id), grid, SEAT_GRID_CACHE_TIMEOUT)
+    return grid
+
+
+def invalidate_seat_grids(bus_ids):
+    """Drop cached seat grids once the transaction commits"""
+    keys = [_seat_grid_key(bus_id) for bus_id in set(bus_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def _runs(seats, aisles):
+    """Split one row's free seats into blocks of adjacent columns not crossing the aisle"""
+    runs = []
+    for seat in seats:
+        if runs and seat[2] == runs[-1][-1][2] + 1 and runs[-1][-1][2] not in aisles:
+            runs[-1].append(seat)
+        else:
+            runs.append([seat])
+    return runs
+
+
+def _cost(selection, aisles, prefer_window):
+    rows = len({seat[1] for seat in selection})
+    blocks = 1
+    for previous, seat in zip(selection, selection[1:]):
+        if seat[1] != previous[1] or seat[2] != previous[2] + 1 or previous[2] in aisles:
+            blocks += 1
+    cost = ROW_COST * (rows - 1) + SPLIT_COST * (blocks - rows)
+    if prefer_window:
+        cost -= WINDOW_BONUS * sum(1 for seat in selection if seat[4])
+    return cost
+
+
+def _best_in_runs(runs, count, aisles, prefer_window):
+    """Cheapest way to seat `count` people using whole runs plus one trimmed run"""
+    best = None
+    for size in range(1, len(runs) + 1):
+        for chosen in combinations(runs, size):
+            total = sum(len(run) for run in chosen)
+            if total < count or total - min(len(run) for run in chosen) >= count:
+                # Too few seats, or a run could be dropped entirely
+                continue
+            excess = total - count
+            for i, run in enumerate(chosen):
+                if len(run) <= excess:
+                    continue
+                keep = len(run) - excess
+                others = [seat for j, other in enumerate(chosen) if j != i for seat in other]
+                # Trim from either end so the leftover seats stay together
+                for part in (run[:keep], run[-keep:]):
+                    selection = sorted(others + part, key=lambda seat: (seat[1], seat[2]))
+                    key = (_cost(selection, aisles, prefer_window), selection[0][1], selection[0][2])
+                    if best is None or key < best[0]:
+                        best = (key, selection)
+    return best
+
+
+def allocate_group(trip, count, seat_class=None, prefer_window=False, exclude=(), legs=ALL_LEGS):
+    """
+    Pick the best block of `count` reservable seats on a trip.
+
+    Seats come from the cached seat grid and seat map, so no per-seat
+    queries run. Candidate blocks span up to MAX_GROUP_ROWS consecutive
+    rows; the cheapest uses the fewest rows, then the fewest splits across
+    the aisle or around taken seats, then (if preferred) the most window
+    seats, then sits nearest the front. Only seats free on `legs` are
+    considered. Returns seat IDs, or None.
+    """
+    grid = seat_grid(trip.bus_id)
+    availability = seat_map(trip.id)
+    now = timezone.now().timestamp()
+
+    free_by_row = {}
+    for seat in grid['seats']:
+        if seat_class and seat[3] != seat_class:
+            continue
+        if seat[0] in exclude or not availability.is_reservable(seat[0], now, legs):
+            continue
+        free_by_row.setdefault(seat[1], []).append(seat)
+    runs_by_row = {row: _runs(seats, grid['aisles']) for row, seats in free_by_row.items()}
+
+    rows = sorted(runs_by_row)
+    best = None
+    for i, start in enumerate(rows):
+        window = []
+        for j, row in enumerate(rows[i:i + MAX_GROUP_ROWS]):
+            if row != start + j:
+                break
+            window.extend(runs_by_row[row])
+            candidate = _best_in_runs(window, count, grid['aisles'], prefer_window)
+            if candidate:
+                if best is None or candidate[0] < best[0]:
+                    best = candidate
+                # More rows can only cost more
+                break
+    if best is None:
+        return None
+    return [seat[0] for seat in best[1]]
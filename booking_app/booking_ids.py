@@ -0,0 +1,110 @@
+# booking_ids.py - Time-ordered, check-digit protected booking references
+
+import os
+import secrets
+import threading
+import time
+
+# Crockford base32: no I, L, O or U, so references survive being read aloud
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# Extra symbols for the mod-37 check character
+CHECK_ALPHABET = ALPHABET + '*~$=U'
+
+TIMESTAMP_BITS = 48     # milliseconds since the Unix epoch, good until the year 10889
+NODE_BITS = 15
+SEQUENCE_BITS = 12      # IDs per millisecond per node before waiting for the next one
+BODY_LENGTH = (TIMESTAMP_BITS + NODE_BITS + SEQUENCE_BITS) // 5
+
+_lock = threading.Lock()
+_node = None
+_pid = None
+_last_ms = 0
+_sequence = 0
+
+
+def encode(number, length):
+    chars = []
+    for _ in range(length):
+        number, remainder = divmod(number, 32)
+        chars.append(ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+def check_symbol(body):
+    number = 0
+    for char in body:
+        number = number * 32 + ALPHABET.index(char)
+    return CHECK_ALPHABET[number % 37]
+
+
+def _node_id():
+    """
+    This process's node number.
+
+    A BOOKING_ID_NODE environment variable, set differently for each worker
+    process, pins it for guaranteed uniqueness; otherwise each process picks
+    a random one (again after a fork). create_booking() retries with a fresh
+    node on the rare collision.
+    """
+    global _node, _pid
+    if _pid != os.getpid():
+        configured = os.environ.get('BOOKING_ID_NODE', '')
+        _node = int(configured) if configured.isdigit() else secrets.randbits(NODE_BITS)
+        _node %= 1 << NODE_BITS
+        _pid = os.getpid()
+    return _node
+
+
+def reroll_node():
+    """Move this process to a new random node after its IDs collided with another process's"""
+    global _node
+    with _lock:
+        _node_id()
+        _node = secrets.randbits(NODE_BITS)
+
+
+def new_booking_id():
+    """
+    A 16-character reference: millisecond timestamp, node and sequence in
+    Crockford base32 plus a check symbol.
+
+    IDs from one process are strictly increasing and consecutive IDs share
+    a prefix, so inserts land at the right-hand edge of the unique index.
+    No database round trip is needed.
+    """
+    global _last_ms, _sequence
+    with _lock:
+        node = _node_id()
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms <= _last_ms:
+            # Same millisecond (or the clock stepped back): keep counting
+            now_ms = _last_ms
+            _sequence += 1
+            if _sequence >> SEQUENCE_BITS:
+                now_ms += 1
+                _sequence = 0
+        else:
+            _sequence = 0
+        _last_ms = now_ms
+        number = (now_ms << (NODE_BITS + SEQUENCE_BITS)) | (node << SEQUENCE_BITS) | _sequence
+    body = encode(number, BODY_LENGTH)
+    return body + check_symbol(body)
+
+
+def normalize_booking_id(text):
+    """
+    Canonical form of a typed reference: upper case, no spaces or dashes,
+    and the letters Crockford treats as digits (O, I, L) mapped back.
+    """
+    cleaned = text.strip().upper().replace('-', '').replace(' ', '')
+    if len(cleaned) != BODY_LENGTH + 1:
+        return cleaned
+    body = cleaned[:-1].replace('O', '0').replace('I', '1').replace('L', '1')
+    return body + cleaned[-1]
+
+
+def is_valid_booking_id(text):
+    """True for a well-formed reference whose check symbol matches"""
+    if len(text) != BODY_LENGTH + 1 or any(char not in ALPHABET for char in text[:-1]):
+        return False
+    return check_symbol(text[:-1]) == text[-1]
@@ -0,0 +1,191 @@
+# bookings.py - Booking creation
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .booking_ids import new_booking_id, reroll_node
+from .models import Booking, BookingSeat, Seat, TripSeatAvailability, legs_free_q, reservable_q
+from .inventory import SeatsUnavailable, invalidate_seat_maps, mirror_seats, trip_journey
+from .outbox import queue_booking_confirmation
+from .pricing import held_prices, schedule_fare_refresh
+from .search import invalidate_trip_search_for
+
+# Fresh references tried before a clash on Booking.booking_id is treated as an error
+BOOKING_ID_ATTEMPTS = 3
+
+
+def create_booking(trip, seat_ids, passenger, user=None, hold_token=None, journey=None):
+    """
+    Create a pending Booking for seats held on a trip, in one transaction.
+
+    With a hold_token only seats still carrying that hold are taken (the
+    token is cleared as they move to the booking); without one the seats
+    must be reservable on the journey's legs.
+    The availability rows move to the booking in a single UPDATE and the
+    BookingSeats go in with one bulk_create, so the query count does not
+    grow with the number of seats. If any seat is missing the transaction
+    rolls back and SeatsUnavailable names the missing seats.
+
+    `passenger` holds the GuestBookingForm fields and `journey` the
+    (pickup_id, dropoff_id, legs) from trip_journey(), the whole route if
+    omitted. The legs are only marked sold once the booking is paid.
+    A booking reference already taken by another process is redrawn.
+    """
+    seat_ids = list(dict.fromkeys(seat_ids))
+    pickup_id, dropoff_id, legs = journey or trip_journey(trip)
+    seats = list(Seat.objects.filter(id__in=seat_ids, bus_id=trip.bus_id))
+    if len(seats) != len(seat_ids) or not seats:
+        found = {seat.id for seat in seats}
+        raise SeatsUnavailable([seat_id for seat_id in seat_ids if seat_id not in found])
+
+    # Fares quoted when the seats were held, so the price cannot move mid-booking
+    prices = held_prices(trip, seat_ids, hold_token, (pickup_id, dropoff_id, legs))
+    if hold_token:
+        held = Q(hold_token=hold_token, is_available=True)
+    else:
+        held = reservable_q(now=timezone.now()) & legs_free_q(legs)
+
+    fields = dict(
+        trip=trip,
+        user=user,
+        passenger_name=passenger['passenger_name'],
+        passenger_email=passenger['passenger_email'],
+        passenger_phone=passenger['passenger_phone'],
+        passenger_id_number=passenger['passenger_id_number'],
+        passenger_age=passenger['passenger_age'],
+        is_kenyan=passenger['is_kenyan'],
+        pickup_location_id=pickup_id,
+        dropoff_location_id=dropoff_id,
+        legs=legs,
+        total_amount=sum(prices.values()),
+        payment_phone=passenger['passenger_phone'],
+    )
+
+    with transaction.atomic():
+        for attempt in range(BOOKING_ID_ATTEMPTS):
+            try:
+                # Savepoint, so a clashing reference does not abort the whole transaction
+                with transaction.atomic():
+                    booking = Booking.objects.create(booking_id=new_booking_id(), **fields)
+                break
+            except IntegrityError:
+                if attempt == BOOKING_ID_ATTEMPTS - 1:
+                    raise
+                # Another process drew the same node: leave it
+                reroll_node()
+
+        moved = TripSeatAvailability.objects.filter(
+            held, trip=trip, seat_id__in=seat_ids
+        ).update(
+            booking=booking,
+            reserved_until=booking.expires_at,
+            # Spent: the hold cannot be turned into a second booking
+            hold_token=None
+        )
+        if moved != len(seat_ids):
+            taken = set(TripSeatAvailability.objects.filter(
+                trip=trip, booking=booking
+            ).values_list('seat_id', flat=True))
+            # Raising inside atomic() also removes the booking
+            raise SeatsUnavailable([seat_id for seat_id in seat_ids if seat_id not in taken])
+        BookingSeat.objects.bulk_create([
+            BookingSeat(booking=booking, seat_id=seat_id, price=prices[seat_id])
+            for seat_id in seat_ids
+        ])
+
+    mirror_seats(trip.id, seat_ids, hold_until=booking.expires_at)
+    return booking
+
+
+def extend_booking(booking, until):
+    """
+    Push a pending booking's expiry (and its seat holds) out to `until`.
+
+    Used while a payment is in flight so the booking cannot lapse between
+    the customer entering their PIN and the callback. Only moves expiry
+    later, and never for a booking that has already expired.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        extended = Booking.objects.filter(
+            id=booking.id, status='PENDING', expires_at__gte=now, expires_at__lt=until
+        ).update(expires_at=until)
+        if extended:
+            TripSeatAvailability.objects.filter(booking_id=booking.id).update(reserved_until=until)
+    if extended:
+        booking.expires_at = until
+        invalidate_seat_maps([booking.trip_id])
+    return bool(extended)
+
+
+def expire_booking(booking):
+    """
+    Mark a pending booking that has run out of time EXPIRED and release its seats.
+
+    The status change is conditional, like confirm_booking(), so it cannot
+    undo a payment landing at the same moment. Only rows still carrying the
+    booking are released: a seat held afresh since has its booking cleared.
+    Returns False if the booking was not expired here.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        expired = Booking.objects.filter(
+            id=booking.id, status='PENDING', expires_at__lt=now
+        ).update(status='EXPIRED')
+        if not expired:
+            return False
+        TripSeatAvailability.objects.filter(
+            booking_id=booking.id, reserved_until__lte=now
+        ).update(
+            is_available=True,
+            reserved_until=None,
+            hold_token=None,
+            booking=None
+        )
+    booking.status = 'EXPIRED'
+    invalidate_seat_maps([booking.trip_id])
+    invalidate_trip_search_for([booking.trip])
+    # Released seats can bring fares back down
+    schedule_fare_refresh([booking.trip])
+    return True
+
+
+def confirm_booking(booking, transaction_id, phone_number):
+    """
+    Mark a pending booking paid and sell its seats' legs.
+
+    The status change is one conditional UPDATE on a booking that is still
+    PENDING and unexpired, so a late or repeated confirmation cannot revive
+    an expired booking or confirm one twice. The seat rows and the outboxed
+    confirmation email commit with it. Returns False if the booking could
+    not be confirmed.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        confirmed = Booking.objects.filter(
+            id=booking.id, status='PENDING', expires_at__gte=now
+        ).update(
+            status='CONFIRMED',
+            paid_at=now,
+            mpesa_transaction_id=transaction_id,
+            payment_phone=phone_number
+        )
+        if not confirmed:
+            return False
+        # Sell only the legs travelled; the seat stays on sale elsewhere on the route
+        TripSeatAvailability.objects.filter(
+            booking_id=booking.id
+        ).update(
+            legs_sold=F('legs_sold').bitor(booking.legs),
+            reserved_until=None,
+            hold_token=None
+        )
+        # The send_outbox worker renders the receipt and sends it, off the request path
+        queue_booking_confirmation(booking)
+    booking.status = 'CONFIRMED'
+    booking.paid_at = now
+    booking.mpesa_transaction_id = transaction_id
+    booking.payment_phone = phone_number
+    invalidate_seat_maps([booking.trip_id])
+    invalidate_trip_search_for([booking.trip])
+    return True
@@ -0,0 +1,26 @@
+# checks.py - System checks for settings the app relies on
+
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Backends private to one process: each worker would keep its own seat maps,
+# holds and request locks, and never see the others' changes
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register()
+def seat_map_cache_shared(app_configs, **kwargs):
+    """Outside DEBUG the default cache must be shared between worker processes"""
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if settings.DEBUG or backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        f"The default cache ({backend}) is private to each process.",
+        hint="Seat maps, seat map locks and idempotency keys are shared through the cache; "
+             "use Redis, Memcached or the database cache when DEBUG is off.",
+        obj='CACHES',
+        id='booking_app.E001',
+    )]
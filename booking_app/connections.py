@@ -0,0 +1,228 @@
+# connections.py - Multi-leg itinerary search over the route segment index
+
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, FilteredRelation
+from django.utils import timezone
+from .models import Location, Trip
+from .search import SEARCH_GENERATION_KEY, bump_version, current_versions, seat_summary_annotations, segment_legs_expression
+
+# Shortest and longest allowed wait between arriving on one bus and boarding the next
+MIN_CONNECTION_TIME = timedelta(minutes=getattr(settings, 'MIN_CONNECTION_MINUTES', 30))
+MAX_CONNECTION_WAIT = timedelta(hours=12)
+
+# Per-process graphs are rebuilt at least this often so seat counts stay roughly current
+CONNECTION_GRAPH_MAX_AGE = getattr(settings, 'CONNECTION_GRAPH_MAX_AGE', 120)
+
+# Later departures considered at each transfer point; keeps the search bounded on busy days
+CONNECTIONS_PER_TRANSFER = 3
+
+# Travel dates whose graphs a process keeps; the least recently searched goes first
+CONNECTION_GRAPH_CACHE_SIZE = getattr(settings, 'CONNECTION_GRAPH_CACHE_SIZE', 8)
+
+_graphs = OrderedDict()
+_graphs_lock = threading.Lock()
+
+
+class DayGraph:
+    """
+    Time-expanded connection graph for one travel date.
+
+    Every trip departing on the date (or the next day, for onward legs)
+    contributes one leg per segment it serves with a seat free on that
+    segment's legs. Legs are indexed by (origin, destination) and sorted by
+    departure time, so each transfer is a bisect rather than a scan.
+    """
+
+    def __init__(self, travel_date):
+        self.travel_date = travel_date
+        self.legs = {}          # (origin_id, destination_id) -> [leg, ...] sorted by departure
+        self.departures = {}    # (origin_id, destination_id) -> [departure, ...] parallel to legs
+        self.reachable = {}     # origin_id -> {destination_id, ...}
+        self.feeders = {}       # destination_id -> {origin_id, ...}
+        self.seats = {}         # (trip_id, origin_id, destination_id) -> (seats_left, lowest_fare)
+        self.locations = {}
+        self.trips = {}
+        self.build()
+
+    def build(self):
+        # One row per trip and segment, grouped so seats are counted on the segment's own legs
+        rows = Trip.objects.filter(
+            departure_date__range=(self.travel_date, self.travel_date + timedelta(days=1)),
+            status='SCHEDULED',
+        ).annotate(
+            segment=FilteredRelation('route__segments'),
+        ).values(
+            'id', 'departure_time', 'departure_date',
+            'segment__origin_id', 'segment__destination_id',
+            'segment__departure_offset', 'segment__arrival_offset',
+            company=F('bus__company__name'),
+        ).annotate(
+            **seat_summary_annotations(legs=segment_legs_expression())
+        ).filter(
+            seats_left__gt=0
+        ).order_by()
+        for row in rows:
+            trip_id = row['id']
+            origin_id = row['segment__origin_id']
+            destination_id = row['segment__destination_id']
+            pair = (origin_id, destination_id)
+            self.trips.setdefault(trip_id, {
+                'id': trip_id,
+                'departure_date': row['departure_date'],
+                'company': row['company'],
+            })
+            self.seats[(trip_id, origin_id, destination_id)] = (row['seats_left'], row['lowest_fare'])
+            self.legs.setdefault(pair, []).append((
+                row['departure_time'] + row['segment__departure_offset'],
+                row['departure_time'] + row['segment__arrival_offset'],
+                trip_id,
+                origin_id,
+                destination_id,
+            ))
+            self.reachable.setdefault(origin_id, set()).add(destination_id)
+            self.feeders.setdefault(destination_id, set()).add(origin_id)
+
+        for pair, legs in self.legs.items():
+            legs.sort()
+            self.departures[pair] = [leg[0] for leg in legs]
+
+        location_ids = set(self.reachable) | set(self.feeders)
+        self.locations = dict(Location.objects.filter(id__in=location_ids).values_list('id', 'name'))
+
+    def onward(self, pair, after, exclude_trip):
+        """Up to CONNECTIONS_PER_TRANSFER legs on `pair` leaving in the transfer window"""
+        departures = self.departures.get(pair)
+        if not departures:
+            return []
+        earliest = after + MIN_CONNECTION_TIME
+        latest = after + MAX_CONNECTION_WAIT
+        legs = []
+        for leg in self.legs[pair][bisect_left(departures, earliest):]:
+            if leg[0] > latest or len(legs) == CONNECTIONS_PER_TRANSFER:
+                break
+            if leg[2] != exclude_trip:
+                legs.append(leg)
+        return legs
+
+    def first_legs(self, pair):
+        """Legs on `pair` whose trip departs on the travel date itself"""
+        return [
+            leg for leg in self.legs.get(pair, [])
+            if self.trips[leg[2]]['departure_date'] == self.travel_date
+        ]
+
+    def itineraries(self, origin_id, destination_id, max_transfers=2):
+        """Every bounded combination of up to max_transfers + 1 legs from origin to destination"""
+        found = [[leg] for leg in self.first_legs((origin_id, destination_id))]
+        if max_transfers < 1:
+            return found
+
+        for first_stop in self.reachable.get(origin_id, ()):
+            if first_stop == destination_id:
+                continue
+            for first in self.first_legs((origin_id, first_stop)):
+                # One transfer
+                for second in self.onward((first_stop, destination_id), first[1], first[2]):
+                    found.append([first, second])
+                if max_transfers < 2:
+                    continue
+                # Two transfers: only via stops that can still reach the destination
+                second_stops = self.reachable.get(first_stop, set()) & self.feeders.get(destination_id, set())
+                for second_stop in second_stops - {origin_id, destination_id}:
+                    for second in self.onward((first_stop, second_stop), first[1], first[2]):
+                        for third in self.onward((second_stop, destination_id), second[1], second[2]):
+                            if third[2] != first[2]:
+                                found.append([first, second, third])
+        return found
+
+    def fare(self, leg):
+        """Lowest fare for riding a leg's trip over the leg's segment"""
+        return self.seats[leg[2:]][1]
+
+    def describe(self, legs):
+        """JSON-friendly itinerary with per-leg details and totals"""
+        fares = [self.fare(leg) for leg in legs]
+        return {
+            'departure': timezone.localtime(legs[0][0]).isoformat(),
+            'arrival': timezone.localtime(legs[-1][1]).isoformat(),
+            'transfers': len(legs) - 1,
+            'total_fare': float(round(sum(fares), 2)),
+            'legs': [{
+                'trip_id': leg[2],
+                'company': self.trips[leg[2]]['company'],
+                'origin_id': leg[3],
+                'origin': self.locations.get(leg[3]),
+                'destination_id': leg[4],
+                'destination': self.locations.get(leg[4]),
+                'departure': timezone.localtime(leg[0]).isoformat(),
+                'arrival': timezone.localtime(leg[1]).isoformat(),
+                'fare': float(round(fare, 2)),
+                'seats_left': self.seats[leg[2:]][0],
+            } for leg, fare in zip(legs, fares)],
+        }
+
+
+def _schedule_version_key(travel_date):
+    return f"trip_schedule_version_{travel_date.isoformat()}"
+
+
+def invalidate_connection_graphs(travel_dates):
+    """Retire cached graphs that may include trips departing on these dates"""
+    travel_dates = set(travel_dates)
+
+    def bump():
+        for travel_date in travel_dates:
+            # Graphs for the previous day carry this day's trips as onward legs
+            bump_version(_schedule_version_key(travel_date))
+            bump_version(_schedule_version_key(travel_date - timedelta(days=1)))
+
+    transaction.on_commit(bump)
+
+
+def day_graph(travel_date):
+    """
+    This process's graph for a date, rebuilt when its trips change or it gets old.
+
+    Graphs for dates before yesterday are dropped, and at most
+    CONNECTION_GRAPH_CACHE_SIZE are kept, least recently used first out.
+    """
+    versions = tuple(current_versions(_schedule_version_key(travel_date), SEARCH_GENERATION_KEY))
+    with _graphs_lock:
+        cached = _graphs.get(travel_date)
+        if cached and cached[0] == versions and time.monotonic() - cached[1] < CONNECTION_GRAPH_MAX_AGE:
+            _graphs.move_to_end(travel_date)
+            return cached[2]
+
+    graph = DayGraph(travel_date)
+    with _graphs_lock:
+        # Drop graphs for dates that have already passed
+        yesterday = timezone.localdate() - timedelta(days=1)
+        for stale_date in [d for d in _graphs if d < yesterday]:
+            del _graphs[stale_date]
+        _graphs[travel_date] = (versions, time.monotonic(), graph)
+        _graphs.move_to_end(travel_date)
+        while len(_graphs) > CONNECTION_GRAPH_CACHE_SIZE:
+            _graphs.popitem(last=False)
+    return graph
+
+
+def find_connections(origin_id, destination_id, travel_date, max_transfers=2, limit=10):
+    """
+    Itineraries from origin to destination starting on travel_date.
+
+    Ranked by arrival time, then total fare, then fewer transfers.
+    """
+    graph = day_graph(travel_date)
+    itineraries = graph.itineraries(origin_id, destination_id, max_transfers)
+    itineraries.sort(key=lambda legs: (
+        legs[-1][1],
+        sum(graph.fare(leg) for leg in legs),
+        len(legs),
+    ))
+    return [graph.describe(legs) for legs in itineraries[:limit]]
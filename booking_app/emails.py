@@ -0,0 +1,188 @@
+# emails.py - Customer emails built from bookings, sent through the outbox
+
+import logging
+from django.conf import settings
+from django.core.mail import EmailMessage
+from .receipts import SITE_URL, RenderBusy, stored_receipt
+
+logger = logging.getLogger(__name__)
+
+
+def generate_booking_pdf(request, booking):
+    """PDF receipt for booking, from the receipt store (rendered there on first use)"""
+    try:
+        path, version = stored_receipt(booking, request.build_absolute_uri() if request else SITE_URL)
+        with open(path, 'rb') as f:
+            return f.read()
+        
+    except RenderBusy:
+        # Worth retrying later rather than falling back to a text-only email
+        raise
+    except Exception:
+        logger.exception("PDF generation failed for booking %s", booking.booking_id)
+        return None
+
+
+def booking_confirmation_email(request, booking):
+    """Confirmation email with the PDF receipt attached, or the text-only fallback"""
+    pdf_content = generate_booking_pdf(request, booking)
+    if not pdf_content:
+        # Fallback to sending email without PDF
+        return booking_confirmation_text_email(booking)
+    
+    # Email subject and content
+    subject = f'Booking Confirmed - {booking.booking_id} | DreamLine Bus Service'
+    
+    # HTML email template
+    html_message = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <style>
+            body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
+            .header {{ background: #28a745; color: white; padding: 20px; text-align: center; }}
+            .content {{ padding: 20px; }}
+            .booking-info {{ background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0; }}
+            .seats {{ background: #007bff; color: white; padding: 5px 10px; border-radius: 3px; margin: 2px; }}
+            .total {{ font-size: 18px; font-weight: bold; color: #28a745; }}
+            .footer {{ background: #f8f9fa; padding: 15px; text-align: center; font-size: 12px; color: #666; }}
+            .important {{ background: #fff3cd; padding: 10px; border-radius: 5px; margin: 15px 0; border-left: 4px solid #ffc107; }}
+        </style>
+    </head>
+    <body>
+        <div class="header">
+            <h1>🎉 Booking Confirmed!</h1>
+            <p>Thank you for choosing DreamLine Bus Service</p>
+        </div>
+        
+        <div class="content">
+            <p>Dear {booking.passenger_name},</p>
+            
+            <p>Great news! Your booking has been successfully confirmed and payment processed.</p>
+            
+            <div class="booking-info">
+                <h3>📋 Booking Details</h3>
+                <p><strong>Booking ID:</strong> {booking.booking_id}</p>
+                <p><strong>Route:</strong> {booking.trip.route}</p>
+                <p><strong>Bus Company:</strong> {booking.trip.bus.company.name}</p>
+                <p><strong>Bus Number:</strong> {booking.trip.bus.number_plate}</p>
+                <p><strong>Departure:</strong> {booking.trip.departure_time.strftime('%B %d, %Y at %H:%M')}</p>
+                <p><strong>Arrival:</strong> {booking.trip.arrival_time.strftime('%B %d, %Y at %H:%M')}</p>
+                <p><strong>Pickup Location:</strong> {booking.pickup_location.name}</p>
+                <p><strong>Drop-off Location:</strong> {booking.dropoff_location.name}</p>
+                <p><strong>Seats:</strong> 
+                    {' '.join([f'<span class="seats">{seat.seat.seat_number}</span>' for seat in booking.booked_seats.all()])}
+                </p>
+                <p class="total"><strong>Total Paid:</strong> KSh {booking.total_amount:,.0f}</p>
+                <p><strong>Transaction ID:</strong> {booking.mpesa_transaction_id}</p>
+            </div>
+            
+            <div class="important">
+                <h4>🚨 Important Information:</h4>
+                <ul>
+                    <li><strong>Arrive 30 minutes early</strong> at the pickup location</li>
+                    <li>Bring a <strong>valid ID</strong> for verification</li>
+                    <li>Keep this confirmation and the attached receipt for your records</li>
+                    <li>Contact us immediately if you need to make changes</li>
+                </ul>
+            </div>
+            
+            <h4>📞 Need Help?</h4>
+            <p>Our customer support team is available 24/7:</p>
+            <ul>
+                <li>📱 Phone: +254 700 123456</li>
+                <li>📧 Email: support@dreamlinebus.com</li>
+                <li>🌐 Website: www.dreamlinebus.com</li>
+            </ul>
+            
+            <p>Have a safe and comfortable journey!</p>
+            
+            <p>Best regards,<br>
+            <strong>DreamLine Bus Service Team</strong></p>
+        </div>
+        
+        <div class="footer">
+            <p>This is an automated email. Please do not reply directly to this message.</p>
+            <p>© 2024 DreamLine Bus Service. All rights reserved.</p>
+        </div>
+    </body>
+    </html>
+    """
+    
+    # Plain text version
+    text_message = f"""
+    Booking Confirmed - {booking.booking_id}
+    
+    Dear {booking.passenger_name},
+    
+    Your booking has been successfully confirmed!
+    
+    BOOKING DETAILS:
+    ================
+    Booking ID: {booking.booking_id}
+    Route: {booking.trip.route}
+    Bus Company: {booking.trip.bus.company.name}
+    Departure: {booking.trip.departure_time.strftime('%B %d, %Y at %H:%M')}
+    Arrival: {booking.trip.arrival_time.strftime('%B %d, %Y at %H:%M')}
+    Pickup: {booking.pickup_location.name}
+    Drop-off: {booking.dropoff_location.name}
+    Seats: {', '.join([seat.seat.seat_number for seat in booking.booked_seats.all()])}
+    Total Paid: KSh {booking.total_amount:,.0f}
+    Transaction ID: {booking.mpesa_transaction_id}
+    
+    IMPORTANT:
+    - Arrive 30 minutes early at pickup location
+    - Bring valid ID for verification
+    - Keep this confirmation for your records
+    
+    Need help? Contact us at +254 700 123456 or support@dreamlinebus.com
+    
+    Thank you for choosing DreamLine Bus Service!
+    """
+    
+    # Create email message
+    email = EmailMessage(
+        subject=subject,
+        body=text_message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[booking.passenger_email],
+        reply_to=['support@dreamlinebus.com'],
+    )
+    
+    # Add HTML version
+    email.content_subtype = 'html'
+    email.body = html_message
+    
+    # Attach PDF
+    email.attach(
+        f'booking_{booking.booking_id}.pdf',
+        pdf_content,
+        'application/pdf'
+    )
+    
+    return email
+
+
+def booking_confirmation_text_email(booking):
+    """Fallback text-only confirmation email"""
+    subject = f'Booking Confirmed - {booking.booking_id}'
+    message = f"""
+    Dear {booking.passenger_name},
+    
+    Your booking has been confirmed!
+    
+    Booking ID: {booking.booking_id}
+    Route: {booking.trip.route}
+    Departure: {booking.trip.departure_time.strftime('%Y-%m-%d %H:%M')}
+    Seats: {', '.join([bs.seat.seat_number for bs in booking.booked_seats.all()])}
+    Total Amount: KSh {booking.total_amount}
+    Transaction ID: {booking.mpesa_transaction_id}
+    
+    Please arrive at the pickup location 30 minutes before departure.
+    
+    Thank you for choosing {booking.trip.bus.company.name}!
+    
+    For support: +254 700 123456
+    """
+    
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [booking.passenger_email])
@@ -1,9 +1,45 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from .models import Location, Booking
+from .locations import location_index, resolve_location
+
+class LocationChoiceIterator(forms.models.ModelChoiceIterator):
+    """Choices read from the cached location index instead of a query"""
+    
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        yield from location_index().choices
+    
+    def __len__(self):
+        return len(location_index().choices) + (self.field.empty_label is not None)
+    
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(location_index().choices)
+
+class LocationChoiceField(forms.ModelChoiceField):
+    """
+    Location choice that also accepts typed text.
+    
+    A submitted primary key works as usual; anything else ("Nairob",
+    "MSA", "Mombsa") is resolved through the location index. Rendered
+    choices come from the same index, so they cover every Location and
+    are refreshed whenever a location or route changes.
+    """
+    
+    iterator = LocationChoiceIterator
+    
+    def to_python(self, value):
+        try:
+            return super().to_python(value)
+        except ValidationError:
+            location = resolve_location(str(value))
+            if location is None:
+                raise
+            return location
 
 class SearchForm(forms.Form):
-    origin = forms.ModelChoiceField(
+    origin = LocationChoiceField(
         queryset=Location.objects.all(),
         empty_label="From",
         widget=forms.Select(attrs={
@@ -11,7 +47,7 @@ class SearchForm(forms.Form):
             'id': 'origin-select'
         })
     )
-    destination = forms.ModelChoiceField(
+    destination = LocationChoiceField(
         queryset=Location.objects.all(),
         empty_label="To",
         widget=forms.Select(attrs={
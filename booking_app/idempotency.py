@@ -0,0 +1,91 @@
+# idempotency.py - Idempotency-Key support for retried POST endpoints
+
+import hashlib
+import time
+import uuid
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+# How long a stored response can be replayed for the same key
+IDEMPOTENCY_KEY_TTL = getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)
+
+# How long a duplicate waits for the first request before giving up, and
+# the longest the first request may hold the key
+IDEMPOTENCY_WAIT = 10
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+MAX_KEY_LENGTH = 255
+
+
+def _replay(stored):
+    response = HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Replay the stored response for a repeated Idempotency-Key.
+
+    The first POST with a key runs the view and stores its response for
+    IDEMPOTENCY_KEY_TTL. Retries get that response back without running the
+    view again; a retry arriving while the first is still running waits for
+    it. Reusing a key for a different request body is rejected. Requests
+    without the header are unaffected.
+
+    Keys, stored responses and the in-flight lock live in the default cache,
+    so retries are only coalesced across worker processes when that cache
+    is shared; with LocMemCache each process only sees its own requests.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if request.method != 'POST' or not key:
+            return view(request, *args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return JsonResponse({'success': False, 'error': 'Idempotency-Key is too long'}, status=400)
+
+        scope = hashlib.sha256(f"{request.path}\n{key}".encode()).hexdigest()
+        response_key = f"idempotency_{scope}"
+        lock_key = f"idempotency_lock_{scope}"
+        fingerprint = hashlib.sha256(request.body).hexdigest()
+        # Marks the lock as ours, so one that expired and was retaken is not released
+        lock_token = uuid.uuid4().hex
+
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            stored = cache.get(response_key)
+            if stored is not None:
+                if stored['fingerprint'] != fingerprint:
+                    return JsonResponse({
+                        'success': False,
+                        'error': 'Idempotency-Key was already used for a different request'
+                    }, status=422)
+                return _replay(stored)
+            if cache.add(lock_key, lock_token, IDEMPOTENCY_LOCK_TIMEOUT):
+                break
+            if time.monotonic() > deadline:
+                return JsonResponse({
+                    'success': False,
+                    'error': 'A request with this Idempotency-Key is still being processed'
+                }, status=409)
+            time.sleep(0.05)
+
+        try:
+            response = view(request, *args, **kwargs)
+            # Server errors are left retryable
+            if response.status_code < 500 and not response.streaming:
+                cache.set(response_key, {
+                    'fingerprint': fingerprint,
+                    'status': response.status_code,
+                    'content': response.content,
+                    'content_type': response.get('Content-Type'),
+                }, IDEMPOTENCY_KEY_TTL)
+            return response
+        finally:
+            if cache.get(lock_key) == lock_token:
+                cache.delete(lock_key)
+
+    return wrapper
@@ -0,0 +1,338 @@
+# inventory.py - Per-trip seat inventory
+
+import time
+import uuid
+from array import array
+from datetime import timedelta
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Value, When
+from django.utils import timezone
+from .models import ALL_LEGS, RouteSegment, RouteStop, Seat, TripSeatAvailability, legs_free_q, reservable_q
+
+# Rows per INSERT; keeps each statement under SQLite's variable limit
+AVAILABILITY_BATCH_SIZE = 500
+
+# Seat maps are mirrors of TripSeatAvailability; expiry only bounds drift.
+# Every worker must share them, see checks.seat_map_cache_shared()
+SEAT_MAP_CACHE_TIMEOUT = getattr(settings, 'SEAT_MAP_CACHE_TIMEOUT', 3600)
+
+# How long a seat map update may hold the per-trip lock, and wait for it
+SEAT_MAP_LOCK_TIMEOUT = 5
+SEAT_MAP_LOCK_WAIT = 1.0
+
+# How long reserve_trip_seats holds seats while the passenger fills in details
+SEAT_HOLD_MINUTES = getattr(settings, 'SEAT_HOLD_MINUTES', 5)
+
+
+class SeatsUnavailable(Exception):
+    """Some requested seats could not be held; `seat_ids` lists them"""
+
+    def __init__(self, seat_ids):
+        super().__init__(f"Seats not available: {seat_ids}")
+        self.seat_ids = seat_ids
+
+
+def trip_journey(trip, origin_id=None, destination_id=None):
+    """
+    (pickup_id, dropoff_id, legs) for riding a trip between two locations.
+
+    Without locations, or with the route's own ends, the journey covers the
+    whole route and needs no query beyond trip.route. Otherwise the pair is
+    looked up in the segment index; returns None if the route does not
+    serve it in that direction.
+    """
+    route = trip.route
+    origin_id = origin_id or route.origin_id
+    destination_id = destination_id or route.destination_id
+    if (origin_id, destination_id) == (route.origin_id, route.destination_id):
+        return origin_id, destination_id, ALL_LEGS
+    indexes = RouteSegment.objects.filter(
+        route_id=route.id, origin_id=origin_id, destination_id=destination_id
+    ).order_by('origin_index').values_list('origin_index', 'destination_index').first()
+    if indexes is None:
+        return None
+    return origin_id, destination_id, leg_mask(*indexes)
+
+
+def leg_mask(origin_index, destination_index):
+    """Legs between two stop indexes: bits origin_index up to destination_index - 1"""
+    return (1 << destination_index) - (1 << origin_index)
+
+
+def materialize_trip_seats(trips):
+    """
+    Create the missing TripSeatAvailability rows for some trips in bulk.
+
+    One row per seat on each trip's bus. Existing rows are left alone, and
+    conflicts with rows inserted concurrently are ignored, so it is safe to
+    call repeatedly. Returns the number of rows inserted.
+    """
+    trips = list(trips)
+    if not trips:
+        return 0
+
+    seats_by_bus = {}
+    for seat_id, bus_id in Seat.objects.filter(
+        bus_id__in={trip.bus_id for trip in trips}
+    ).values_list('id', 'bus_id'):
+        seats_by_bus.setdefault(bus_id, []).append(seat_id)
+
+    existing = set(TripSeatAvailability.objects.filter(
+        trip_id__in=[trip.id for trip in trips]
+    ).values_list('trip_id', 'seat_id'))
+
+    rows = [
+        TripSeatAvailability(trip_id=trip.id, seat_id=seat_id, is_available=True)
+        for trip in trips
+        for seat_id in seats_by_bus.get(trip.bus_id, [])
+        if (trip.id, seat_id) not in existing
+    ]
+    TripSeatAvailability.objects.bulk_create(
+        rows, batch_size=AVAILABILITY_BATCH_SIZE, ignore_conflicts=True
+    )
+    if rows:
+        invalidate_seat_maps({row.trip_id for row in rows})
+    return len(rows)
+
+
+class SeatMap:
+    """
+    Compact availability for one trip, indexed by seat position.
+
+    `blocked` is a bitset with bit i set when seat i is not for sale at all
+    (blocked or inactive); `legs` gives each position's sold legs as a
+    mask, so a seat sold Nairobi to Nakuru stays on sale from Nakuru on;
+    `holds` gives each position's hold expiry in epoch seconds, 0 when
+    free. A hold covers the whole seat. Seats with no TripSeatAvailability
+    row have no position and are never reservable.
+    """
+
+    def __init__(self, trip_id, seat_ids, leg_count=1, blocked=0, legs=None, holds=None):
+        self.trip_id = trip_id
+        self.seat_ids = tuple(seat_ids)
+        self.positions = {seat_id: i for i, seat_id in enumerate(self.seat_ids)}
+        self.leg_count = leg_count
+        self.blocked = blocked
+        self.legs = legs if legs is not None else array('Q', bytes(8 * len(self.seat_ids)))
+        self.holds = holds if holds is not None else array('d', bytes(8 * len(self.seat_ids)))
+
+    @classmethod
+    def build(cls, trip_id):
+        """Load a trip's map from TripSeatAvailability and its route's stop count"""
+        rows = TripSeatAvailability.objects.filter(trip_id=trip_id).values_list(
+            'seat_id', 'is_available', 'reserved_until', 'legs_sold', 'seat__is_active'
+        ).order_by('seat_id')
+        leg_count = RouteStop.objects.filter(route__trip__id=trip_id).count() + 1
+        seat_map = cls(trip_id, [row[0] for row in rows], leg_count)
+        for i, (_, is_available, reserved_until, legs_sold, is_active) in enumerate(rows):
+            if not (is_available and is_active):
+                seat_map.blocked |= 1 << i
+            seat_map.legs[i] = legs_sold
+            if reserved_until:
+                seat_map.holds[i] = reserved_until.timestamp()
+        return seat_map
+
+    def to_cache(self):
+        return (self.seat_ids, self.leg_count, self.blocked, self.legs.tobytes(), self.holds.tobytes())
+
+    @classmethod
+    def from_cache(cls, trip_id, value):
+        seat_ids, leg_count, blocked, legs, holds = value
+        return cls(trip_id, seat_ids, leg_count, blocked, array('Q', legs), array('d', holds))
+
+    def is_reservable(self, seat_id, now=None, legs=ALL_LEGS):
+        """Whether a seat can be held for the given legs (the whole trip by default)"""
+        i = self.positions.get(seat_id)
+        if i is None or self.blocked >> i & 1 or self.legs[i] & legs:
+            return False
+        return self.holds[i] <= (now or time.time())
+
+    def unavailable(self, seat_ids, now=None, legs=ALL_LEGS):
+        """The given seats that cannot be reserved right now"""
+        now = now or time.time()
+        return [seat_id for seat_id in seat_ids if not self.is_reservable(seat_id, now, legs)]
+
+    def seats_left(self, now=None, legs=ALL_LEGS):
+        now = now or time.time()
+        return sum(1 for seat_id in self.seat_ids if self.is_reservable(seat_id, now, legs))
+
+    def load_factor(self, now=None):
+        """
+        Share of the trip's seat-legs taken.
+
+        Blocked and held seats count in full, sold seats by the share of the
+        route's legs sold, so short intermediate-stop sales raise the load too.
+        """
+        if not self.seat_ids:
+            return 0.0
+        now = now or time.time()
+        route_legs = (1 << self.leg_count) - 1
+        taken = 0.0
+        for i in range(len(self.seat_ids)):
+            if self.blocked >> i & 1 or self.holds[i] > now:
+                taken += 1
+            else:
+                taken += min((self.legs[i] & route_legs).bit_count(), self.leg_count) / self.leg_count
+        return taken / len(self.seat_ids)
+
+    def hold(self, seat_ids, until):
+        for seat_id in seat_ids:
+            if seat_id in self.positions:
+                self.holds[self.positions[seat_id]] = until.timestamp()
+
+    def sell(self, seat_ids, legs=ALL_LEGS):
+        for seat_id in seat_ids:
+            if seat_id in self.positions:
+                i = self.positions[seat_id]
+                self.legs[i] |= legs
+                self.holds[i] = 0
+
+    def release(self, seat_ids, legs=ALL_LEGS):
+        for seat_id in seat_ids:
+            if seat_id in self.positions:
+                i = self.positions[seat_id]
+                self.legs[i] &= ~legs
+                self.holds[i] = 0
+
+
+def _seat_map_key(trip_id):
+    # v2 added leg masks; older cached maps are simply never read again
+    return f"seat_map_v2_{trip_id}"
+
+
+def seat_map(trip_id):
+    """A trip's SeatMap from the cache, rebuilt from the database on a miss"""
+    value = cache.get(_seat_map_key(trip_id))
+    if value is not None:
+        return SeatMap.from_cache(trip_id, value)
+    built = SeatMap.build(trip_id)
+    cache.add(_seat_map_key(trip_id), built.to_cache(), SEAT_MAP_CACHE_TIMEOUT)
+    return built
+
+
+@contextmanager
+def _seat_map_lock(trip_id):
+    """Per-trip lock held in the cache; yields False if it could not be taken"""
+    key = f"seat_map_lock_{trip_id}"
+    deadline = time.monotonic() + SEAT_MAP_LOCK_WAIT
+    while not cache.add(key, 1, SEAT_MAP_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            yield False
+            return
+        time.sleep(0.01)
+    try:
+        yield True
+    finally:
+        cache.delete(key)
+
+
+def update_seat_map(trip_id, change):
+    """
+    Apply `change(seat_map)` to a trip's cached map under its lock.
+
+    `change` returns a falsy value to leave the map unstored. If the lock
+    cannot be taken the cached map is dropped instead, so the next read
+    rebuilds it from the database. Returns whatever `change` returned.
+    """
+    with _seat_map_lock(trip_id) as locked:
+        if not locked:
+            cache.delete(_seat_map_key(trip_id))
+            return None
+        current = seat_map(trip_id)
+        result = change(current)
+        if result:
+            cache.set(_seat_map_key(trip_id), current.to_cache(), SEAT_MAP_CACHE_TIMEOUT)
+        return result
+
+
+def mirror_seats(trip_id, seat_ids, hold_until=None, sold=None, legs=ALL_LEGS):
+    """
+    Copy a committed TripSeatAvailability change into the trip's seat map.
+
+    Pass hold_until to (re)hold the seats, sold=True to mark `legs` sold or
+    sold=False to release them. Runs once the current transaction commits.
+    """
+    seat_ids = list(seat_ids)
+
+    def change(current):
+        if sold is True:
+            current.sell(seat_ids, legs)
+        elif sold is False:
+            current.release(seat_ids, legs)
+        if hold_until is not None:
+            current.hold(seat_ids, hold_until)
+        return True
+
+    transaction.on_commit(lambda: update_seat_map(trip_id, change))
+
+
+def invalidate_seat_maps(trip_ids):
+    """Drop cached seat maps once the transaction commits; next read rebuilds them"""
+    keys = [_seat_map_key(trip_id) for trip_id in set(trip_ids)]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def reserve_trip_seats(trip, seat_ids, prices=None, legs=ALL_LEGS, minutes=SEAT_HOLD_MINUTES):
+    """
+    Hold several seats on a trip, all or nothing.
+
+    The check and the hold are one conditional UPDATE over the availability
+    rows, so concurrent callers cannot both hold a seat: the database
+    serialises writers on each row and re-checks the condition for the
+    later one. If fewer rows than requested were updated the transaction
+    is rolled back and SeatsUnavailable names the missing seats.
+
+    `legs` (from trip_journey()) are the legs that must not be sold yet;
+    the hold itself covers the whole seat. `prices` ({seat_id: fare}) are
+    stored as each seat's quoted price so the fare is locked for the
+    length of the hold. Returns (hold_token,
+    held_until, seats) with each Seat's quoted fare set as `price`.
+    """
+    seat_ids = list(dict.fromkeys(seat_ids))
+    if not seat_ids:
+        raise SeatsUnavailable([])
+
+    # Cheap rejection from the cached map before touching the database
+    unavailable = seat_map(trip.id).unavailable(seat_ids, legs=legs)
+    if unavailable:
+        raise SeatsUnavailable(unavailable)
+
+    now = timezone.now()
+    held_until = now + timedelta(minutes=minutes)
+    hold_token = uuid.uuid4().hex
+    seats = list(Seat.objects.filter(id__in=seat_ids, bus_id=trip.bus_id, is_active=True))
+    # The UPDATE is the transaction's first statement so SQLite takes its
+    # write lock (waiting on busy) up front instead of upgrading a read lock
+    with transaction.atomic():
+        held = TripSeatAvailability.objects.filter(
+            reservable_q(now=now),
+            legs_free_q(legs),
+            trip=trip,
+            seat_id__in=[seat.id for seat in seats],
+        ).update(
+            reserved_until=held_until,
+            hold_token=hold_token,
+            # A lapsed booking may still be attached to an unsold row; a row with
+            # legs sold keeps its link to the booking that bought them
+            booking=Case(When(legs_sold=0, then=Value(None)), default=F('booking')),
+            quoted_price=Case(
+                *[When(seat_id=seat_id, then=Value(prices[seat_id])) for seat_id in seat_ids if seat_id in (prices or {})],
+                default=Value(None),
+                output_field=DecimalField(max_digits=10, decimal_places=2),
+            ),
+        )
+        if held != len(seat_ids):
+            held_ids = set(TripSeatAvailability.objects.filter(
+                trip=trip, hold_token=hold_token
+            ).values_list('seat_id', flat=True))
+            # Raising inside atomic() rolls back the partial hold
+            raise SeatsUnavailable([seat_id for seat_id in seat_ids if seat_id not in held_ids])
+
+    mirror_seats(trip.id, seat_ids, hold_until=held_until)
+    for seat in seats:
+        seat.price = (prices or {}).get(seat.id)
+    return hold_token, held_until, seats
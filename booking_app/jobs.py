@@ -0,0 +1,98 @@
+# jobs.py - Database-backed background job queue
+
+import random
+import traceback
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .models import Job
+
+# Retry delays grow from JOB_RETRY_BASE seconds, doubling per attempt up to JOB_RETRY_MAX
+JOB_RETRY_BASE = getattr(settings, 'JOB_RETRY_BASE', 30)
+JOB_RETRY_MAX = getattr(settings, 'JOB_RETRY_MAX', 60 * 60)
+
+# How long a claimed job belongs to its worker; a crashed worker's jobs run again after it
+JOB_LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 5 * 60)
+
+
+def enqueue(task, run_at=None, **payload):
+    """
+    Queue `task` (a dotted function path) to run with payload as keyword arguments.
+
+    The row is written in the caller's transaction, so the job exists only
+    if the surrounding work commits. Payload must be JSON serialisable.
+    Runs as soon as a worker is free, or not before `run_at` if given.
+    """
+    return Job.objects.create(task=task, payload=payload, run_at=run_at or timezone.now())
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for a job that has failed `attempts` times"""
+    delay = min(JOB_RETRY_BASE * 2 ** (attempts - 1), JOB_RETRY_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def due_q(now):
+    """Jobs ready to run: pending and due, or running on an expired lease"""
+    return Q(status='PENDING', run_at__lte=now) | Q(status='RUNNING', locked_until__lt=now)
+
+
+def claim_jobs(limit=10, worker=None):
+    """
+    Take up to `limit` due jobs for this worker.
+
+    Claiming is one conditional UPDATE stamped with a fresh token, so two
+    workers racing for the same rows cannot both get them, without needing
+    SELECT ... FOR UPDATE.
+    """
+    now = timezone.now()
+    candidates = list(Job.objects.filter(due_q(now)).order_by('run_at').values_list('id', flat=True)[:limit])
+    if not candidates:
+        return []
+    token = f"{worker or 'worker'}:{uuid.uuid4().hex[:12]}"
+    Job.objects.filter(due_q(now), id__in=candidates).update(
+        status='RUNNING',
+        locked_by=token,
+        locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS),
+    )
+    return list(Job.objects.filter(locked_by=token, status='RUNNING').order_by('run_at'))
+
+
+def run_job(job):
+    """
+    Run one claimed job and record the outcome.
+
+    Success marks it DONE. An exception schedules a retry with backoff, or
+    marks it FAILED once max_attempts is used up. Returns True on success.
+    """
+    token = job.locked_by
+    job.attempts += 1
+    try:
+        import_string(job.task)(**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'FAILED'
+            job.finished_at = timezone.now()
+        else:
+            job.status = 'PENDING'
+            job.run_at = timezone.now() + retry_delay(job.attempts)
+        succeeded = False
+    else:
+        job.status = 'DONE'
+        job.finished_at = timezone.now()
+        succeeded = True
+    # Only record the outcome if the lease was not lost to another worker meanwhile
+    Job.objects.filter(id=job.id, locked_by=token).update(
+        status=job.status,
+        attempts=job.attempts,
+        run_at=job.run_at,
+        last_error=job.last_error,
+        finished_at=job.finished_at,
+        locked_by='',
+        locked_until=None,
+    )
+    return succeeded
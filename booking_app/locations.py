@@ -0,0 +1,197 @@
+# locations.py - In-process location lookup index for autocomplete
+
+import re
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from .models import Location, RouteSegment
+from .search import bump_version, current_versions
+
+LOCATION_INDEX_VERSION_KEY = 'location_index_version'
+
+# Longest prefix stored per word; longer queries are checked against the full word
+MAX_PREFIX_LENGTH = 12
+
+# Minimum trigram similarity for a fuzzy match; pg_trgm's default is also 0.3
+SIMILARITY_THRESHOLD = getattr(settings, 'LOCATION_SIMILARITY_THRESHOLD', 0.3)
+
+_index = None
+
+
+def normalize(text):
+    """Lowercase words with punctuation stripped"""
+    return re.findall(r'\w+', text.lower())
+
+
+def trigrams(text):
+    """Trigram set of a string, padded per word the same way pg_trgm does"""
+    grams = set()
+    for word in normalize(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class LocationIndex:
+    """
+    Word-prefix index over Location.name and Location.code.
+
+    Every prefix of every word maps to the matching location IDs, already
+    ranked by popularity (number of routes calling there) so the common
+    single-word lookup is one dict access and a slice.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.locations = {}     # id -> {'id', 'name', 'code', 'routes', 'words'}
+        self.prefixes = {}      # prefix -> [id, ...] ranked
+        self.trigrams = {}      # trigram -> {id, ...}
+        self.trigram_counts = {}
+        self.ranked = []
+        self.choices = []       # [(id, name), ...] by name, for select widgets
+        self.build()
+
+    def build(self):
+        routes_by_location = {}
+        for route_id, origin_id, destination_id in RouteSegment.objects.values_list(
+            'route_id', 'origin_id', 'destination_id'
+        ):
+            routes_by_location.setdefault(origin_id, set()).add(route_id)
+            routes_by_location.setdefault(destination_id, set()).add(route_id)
+
+        prefixes = {}
+        for location_id, name, code in Location.objects.values_list('id', 'name', 'code'):
+            words = set(normalize(name)) | set(normalize(code))
+            self.locations[location_id] = {
+                'id': location_id,
+                'name': name,
+                'code': code,
+                'routes': len(routes_by_location.get(location_id, ())),
+                'words': words,
+            }
+            for word in words:
+                for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                    prefixes.setdefault(word[:length], set()).add(location_id)
+            name_trigrams = trigrams(name)
+            self.trigram_counts[location_id] = len(name_trigrams)
+            for gram in name_trigrams:
+                self.trigrams.setdefault(gram, set()).add(location_id)
+
+        self.ranked = sorted(self.locations, key=self.rank)
+        self.choices = sorted(
+            ((location['id'], location['name']) for location in self.locations.values()),
+            key=lambda choice: (choice[1], choice[0]),
+        )
+        self.prefixes = {
+            prefix: sorted(ids, key=self.rank) for prefix, ids in prefixes.items()
+        }
+
+    def rank(self, location_id):
+        location = self.locations[location_id]
+        return (-location['routes'], location['name'])
+
+    def matches(self, word):
+        """Ranked IDs of locations with a word starting with `word`"""
+        ids = self.prefixes.get(word[:MAX_PREFIX_LENGTH], [])
+        if len(word) > MAX_PREFIX_LENGTH:
+            ids = [
+                location_id for location_id in ids
+                if any(w.startswith(word) for w in self.locations[location_id]['words'])
+            ]
+        return ids
+
+    def search(self, term, limit=10):
+        """Locations where every query word prefixes some word of the name or code"""
+        words = normalize(term)
+        if not words:
+            ids = self.ranked
+        else:
+            # Rank by the first word's list; the rest only filter
+            ids = self.matches(words[0])
+            for word in words[1:]:
+                allowed = set(self.matches(word))
+                ids = [location_id for location_id in ids if location_id in allowed]
+        return [self.locations[location_id] for location_id in ids[:limit]]
+
+    def similar(self, term, limit=10, threshold=SIMILARITY_THRESHOLD):
+        """
+        Locations whose name is trigram-similar to `term`, best first.
+
+        Similarity is shared trigrams over the union, as in pg_trgm. Only
+        locations sharing at least one trigram are ever scored.
+        """
+        query = trigrams(term)
+        if not query:
+            return []
+        shared = {}
+        for gram in query:
+            for location_id in self.trigrams.get(gram, ()):
+                shared[location_id] = shared.get(location_id, 0) + 1
+        scored = []
+        for location_id, count in shared.items():
+            score = count / (len(query) + self.trigram_counts[location_id] - count)
+            if score >= threshold:
+                scored.append((-score, self.rank(location_id), location_id))
+        scored.sort()
+        return [
+            dict(self.locations[location_id], similarity=-score)
+            for score, _, location_id in scored[:limit]
+        ]
+
+
+def similar_locations(term, limit=10):
+    """
+    Fuzzy location lookup for misspelt or alternative names.
+
+    Uses pg_trgm through the GIN index on PostgreSQL and the in-process
+    trigram index everywhere else.
+    """
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.lookups import TrigramSimilar
+        from django.contrib.postgres.search import TrigramSimilarity
+        # The % operator is what the GIN index (migration 0004) can answer
+        return [
+            {'id': location.id, 'name': location.name, 'code': location.code,
+             'similarity': location.similarity}
+            for location in Location.objects.filter(
+                TrigramSimilar(F('name'), term)
+            ).annotate(
+                similarity=TrigramSimilarity('name', term)
+            ).filter(
+                similarity__gte=SIMILARITY_THRESHOLD
+            ).order_by('-similarity', 'name')[:limit]
+        ]
+    return location_index().similar(term, limit)
+
+
+def search_locations(term, limit=10):
+    """Word-prefix matches first, topped up with fuzzy matches"""
+    results = location_index().search(term, limit)
+    if len(results) < limit and term.strip():
+        seen = {location['id'] for location in results}
+        for location in similar_locations(term, limit):
+            if location['id'] not in seen and len(results) < limit:
+                results.append(location)
+    return results
+
+
+def resolve_location(text):
+    """Best Location for free text (a code, a name or a misspelling), or None"""
+    matches = location_index().search(text, 1) or similar_locations(text, 1)
+    if not matches:
+        return None
+    return Location.objects.filter(id=matches[0]['id']).first()
+
+
+def location_index():
+    """This process's index, rebuilt whenever the location version changes"""
+    global _index
+    version, = current_versions(LOCATION_INDEX_VERSION_KEY)
+    if _index is None or _index.version != version:
+        _index = LocationIndex(version)
+    return _index
+
+
+def invalidate_location_index():
+    """Make every process rebuild its location index on next use"""
+    bump_version(LOCATION_INDEX_VERSION_KEY)
@@ -0,0 +1,57 @@
+# management/commands/backfill_seat_availability.py
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from booking_app.models import Trip
+from booking_app.inventory import materialize_trip_seats
+from booking_app.search import invalidate_trip_search_for
+
+class Command(BaseCommand):
+    help = 'Create missing seat availability rows for trips in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--trip',
+            type=int,
+            action='append',
+            help='Only backfill the given trip ID (may be repeated)',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Include past and cancelled trips (default: upcoming scheduled trips only)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Trips handled per batch (default: 200)',
+        )
+
+    def handle(self, *args, **options):
+        trips = Trip.objects.order_by('id')
+        if options['trip']:
+            trips = trips.filter(id__in=options['trip'])
+        elif not options['all']:
+            trips = trips.filter(status='SCHEDULED', departure_time__gte=timezone.now())
+        
+        batch_size = options['batch_size']
+        trip_count = 0
+        created = 0
+        last_id = 0
+        while True:
+            batch = list(trips.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            batch_created = materialize_trip_seats(batch)
+            if batch_created:
+                invalidate_trip_search_for(batch)
+            created += batch_created
+            trip_count += len(batch)
+            last_id = batch[-1].id
+        
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Created {created} seat availability rows for {trip_count} trips.'
+            )
+        )
@@ -0,0 +1,208 @@
+# management/commands/benchmark_search.py
+
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from booking_app.models import (
+    Location, BusCompany, SeatLayout, Bus, Route, RouteStop,
+    Trip, Seat, Booking, TripSeatAvailability
+)
+from booking_app.search import annotate_search_results, rebuild_route_segments, segment_trips, trip_search_queryset
+
+
+class Rollback(Exception):
+    """Raised to discard the synthetic dataset once the benchmark is done"""
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the trip search hot path: query plans and latency on a synthetic dataset'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seat-rows',
+            type=int,
+            default=1_000_000,
+            help='Approximate number of TripSeatAvailability rows to seed (default: 1,000,000)',
+        )
+        parser.add_argument(
+            '--seats-per-bus',
+            type=int,
+            default=50,
+            help='Seats per synthetic bus (default: 50)',
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Number of travel days to spread trips over (default: 30)',
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='Timed runs per query (default: 200)',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Commit the synthetic dataset instead of rolling it back',
+        )
+
+    def handle(self, *args, **options):
+        self.iterations = options['iterations']
+
+        try:
+            with transaction.atomic():
+                self.seed(options['seat_rows'], options['seats_per_bus'], options['days'])
+                self.run_benchmarks()
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            self.stdout.write(self.style.WARNING('Synthetic dataset rolled back.'))
+
+    def seed(self, seat_rows, seats_per_bus, days):
+        """Bulk-create locations, routes, buses, trips and seat availability"""
+        started = time.perf_counter()
+        trip_count = max(seat_rows // seats_per_bus, 1)
+        self.stdout.write(f'Seeding {trip_count} trips x {seats_per_bus} seats...')
+
+        tag = f'BM{random.randint(1000, 9999)}'
+        self.locations = Location.objects.bulk_create([
+            Location(name=f'{tag} Town {i}', code=f'{tag}{i:02d}') for i in range(20)
+        ])
+        company = BusCompany.objects.create(name=f'{tag} Coaches', phone='+254700000000', email='bench@example.com')
+        layout = SeatLayout.objects.create(
+            name=f'{tag} Layout', seat_class='ECONOMY', total_seats=seats_per_bus,
+            rows=(seats_per_bus + 3) // 4, columns=4, layout_data={'config': '2x2'}
+        )
+
+        # A chain of routes, each with two intermediate stops
+        self.routes = []
+        for i in range(len(self.locations) - 3):
+            route = Route.objects.create(
+                origin=self.locations[i], destination=self.locations[i + 3],
+                distance=300, estimated_duration=timedelta(hours=5)
+            )
+            RouteStop.objects.bulk_create([
+                RouteStop(route=route, location=self.locations[i + 1], stop_order=1, distance_from_origin=100),
+                RouteStop(route=route, location=self.locations[i + 2], stop_order=2, distance_from_origin=200),
+            ])
+            # Signal-driven rebuilds run on commit, which never happens here
+            rebuild_route_segments(route.id)
+            self.routes.append(route)
+
+        buses = Bus.objects.bulk_create([
+            Bus(company=company, number_plate=f'{tag} {i:04d}', bus_type='ECONOMY',
+                seat_layout=layout, total_seats=seats_per_bus)
+            for i in range(200)
+        ])
+        Seat.objects.bulk_create([
+            Seat(bus=bus, seat_number=f'{n + 1:02d}', seat_type='WINDOW', seat_class='ECONOMY',
+                 row_number=n // 4 + 1, column_number=n % 4 + 1, price_multiplier=Decimal('1.00'))
+            for bus in buses for n in range(seats_per_bus)
+        ], batch_size=5000)
+        seats_by_bus = {}
+        for seat_id, bus_id in Seat.objects.filter(bus__in=buses).values_list('id', 'bus_id'):
+            seats_by_bus.setdefault(bus_id, []).append(seat_id)
+
+        base = timezone.now().replace(hour=6, minute=0, second=0, microsecond=0)
+        trips = Trip.objects.bulk_create([
+            Trip(
+                bus=random.choice(buses),
+                route=random.choice(self.routes),
+                departure_time=base + timedelta(days=random.randrange(days), minutes=30 * random.randrange(32)),
+                arrival_time=base,
+                base_price=Decimal('1500.00'),
+                status=random.choice(['SCHEDULED'] * 9 + ['CANCELLED']),
+            )
+            for _ in range(trip_count)
+        ], batch_size=5000)
+
+        batch = []
+        for trip in trips:
+            for seat_id in seats_by_bus[trip.bus_id]:
+                batch.append(TripSeatAvailability(
+                    trip_id=trip.id, seat_id=seat_id, is_available=random.random() > 0.3
+                ))
+            if len(batch) >= 50_000:
+                TripSeatAvailability.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        TripSeatAvailability.objects.bulk_create(batch, batch_size=5000)
+
+        self.sample_trip = trips[len(trips) // 2]
+        self.sample_date = self.sample_trip.departure_date
+
+        # Pending bookings, a share of them already expired
+        now = timezone.now()
+        Booking.objects.bulk_create([
+            Booking(
+                trip=random.choice(trips), passenger_name='Bench Passenger',
+                passenger_email='bench@example.com', passenger_phone='0700000000',
+                passenger_id_number='00000000', passenger_age=30,
+                pickup_location=self.locations[0], dropoff_location=self.locations[3],
+                total_amount=Decimal('1500.00'),
+                status=random.choice(['PENDING', 'CONFIRMED', 'CONFIRMED', 'EXPIRED']),
+                expires_at=now + timedelta(minutes=random.randint(-600, 5)),
+            )
+            for _ in range(max(trip_count // 2, 1))
+        ], batch_size=5000)
+
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {TripSeatAvailability.objects.count()} seat rows in {time.perf_counter() - started:.1f}s'
+        ))
+
+    def run_benchmarks(self):
+        # A stop-to-stop pair served by two overlapping routes
+        origin, destination = self.locations[2], self.locations[4]
+        travel_date = self.sample_date
+        now = timezone.now()
+
+        queries = [
+            # Same annotated search, differing only in the date filter
+            ('search_trips (departure_time__date, legacy)', lambda: annotate_search_results(
+                segment_trips(origin, destination).filter(departure_time__date=travel_date, status='SCHEDULED')
+            )),
+            ('search_trips (departure_date, indexed)', lambda: trip_search_queryset(
+                origin, destination, travel_date
+            )),
+            ('trip_seats availability', lambda: TripSeatAvailability.objects.filter(
+                trip=self.sample_trip
+            ).select_related('seat')),
+            ('available seat count', lambda: TripSeatAvailability.objects.filter(
+                trip=self.sample_trip, is_available=True
+            )),
+            ('cleanup_expired_bookings', lambda: Booking.objects.filter(
+                status='PENDING', expires_at__lt=now
+            )),
+            ('admin trip list (status, date range)', lambda: Trip.objects.filter(
+                status='SCHEDULED',
+                departure_time__gte=now,
+                departure_time__lt=now + timedelta(days=1),
+            )[:100]),
+        ]
+
+        for label, build in queries:
+            self.stdout.write('\n' + self.style.MIGRATE_HEADING(label))
+            self.stdout.write(build().explain())
+
+            timings = []
+            for _ in range(self.iterations):
+                started = time.perf_counter()
+                list(build())
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f'rows={len(list(build()))} '
+                f'p50={statistics.median(timings):.2f}ms '
+                f'p95={timings[int(len(timings) * 0.95) - 1]:.2f}ms '
+                f'max={timings[-1]:.2f}ms'
+            )
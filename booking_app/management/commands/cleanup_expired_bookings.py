@@ -2,7 +2,11 @@
 
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from booking_app.models import Booking, TripSeatAvailability
+from booking_app.models import Booking, Trip, TripSeatAvailability
+from booking_app.search import invalidate_trip_search_for_bookings
+from booking_app.inventory import invalidate_seat_maps
+from booking_app.pricing import schedule_fare_refresh
+from booking_app.mpesa import expire_stale_payments
 
 class Command(BaseCommand):
     help = 'Clean up expired bookings and release reserved seats'
@@ -34,26 +38,36 @@ class Command(BaseCommand):
                 self.stdout.write(f'  - {booking.booking_id} (expired {booking.expires_at})')
                 
         else:
+            timed_out = expire_stale_payments()
+            if timed_out:
+                self.stdout.write(f'Marked {timed_out} M-Pesa payments with no callback as timed out.')
+            
             if expired_count == 0:
                 self.stdout.write(
                     self.style.SUCCESS('No expired bookings found.')
                 )
                 return
             
+            # Capture IDs first: once the status changes the filter above no longer matches
+            expired_ids = list(expired_bookings.values_list('id', flat=True))
+            
             # Update booking status
-            updated = expired_bookings.update(status='EXPIRED')
+            updated = Booking.objects.filter(id__in=expired_ids).update(status='EXPIRED')
             
-            # Release reserved seats
-            released_seats = 0
-            for booking in expired_bookings:
-                seat_count = TripSeatAvailability.objects.filter(
-                    booking=booking
-                ).update(
-                    is_available=True,
-                    reserved_until=None,
-                    booking=None
-                )
-                released_seats += seat_count
+            # Release reserved seats in one statement
+            released_seats = TripSeatAvailability.objects.filter(
+                booking_id__in=expired_ids, reserved_until__lte=timezone.now()
+            ).update(
+                is_available=True,
+                reserved_until=None,
+                hold_token=None,
+                booking=None
+            )
+            invalidate_trip_search_for_bookings(expired_ids)
+            trip_ids = set(Booking.objects.filter(id__in=expired_ids).values_list('trip_id', flat=True))
+            invalidate_seat_maps(trip_ids)
+            # Released seats can bring fares back down
+            schedule_fare_refresh(Trip.objects.filter(id__in=trip_ids))
             
             self.stdout.write(
                 self.style.SUCCESS(
@@ -0,0 +1,162 @@
+# management/commands/mpesa_simulator.py
+
+import json
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+from django.core.management.base import BaseCommand
+from booking_app.mpesa import callback_body, new_request_ids
+
+class Command(BaseCommand):
+    help = 'Serve a local stand-in for the Safaricom Daraja API that accepts STK pushes and posts their callbacks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001, help='Port to listen on (default: 8001)')
+        parser.add_argument(
+            '--delay',
+            type=float,
+            default=2.0,
+            help='Average seconds before a push is answered (default: 2)',
+        )
+        parser.add_argument(
+            '--fail-rate',
+            type=float,
+            default=0.0,
+            help='Share of pushes the "customer" cancels (default: 0)',
+        )
+        parser.add_argument(
+            '--drop-rate',
+            type=float,
+            default=0.0,
+            help='Share of pushes that never get a callback, to exercise timeouts (default: 0)',
+        )
+        parser.add_argument(
+            '--duplicates',
+            type=int,
+            default=1,
+            help='Copies of each callback sent at once, as Safaricom sometimes does (default: 1)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=64,
+            help='Callbacks in flight at once (default: 64)',
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.stats = {'pushes': 0, 'callbacks': 0, 'errors': 0, 'dropped': 0}
+        self.timings = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=options['workers'])
+        self.pending = queue.PriorityQueue()
+        threading.Thread(target=self.dispatch, daemon=True).start()
+
+        server = ThreadingHTTPServer(('127.0.0.1', options['port']), self.handler_class())
+        server.daemon_threads = True
+        self.stdout.write(
+            f"M-Pesa simulator on http://127.0.0.1:{options['port']} "
+            f"(set MPESA_BASE_URL to this); Ctrl-C to stop."
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.report()
+
+    def handler_class(self):
+        command = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/oauth/v1/generate'):
+                    self.reply(200, {'access_token': 'simulated-token', 'expires_in': '3599'})
+                else:
+                    self.reply(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                if not self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+                    return self.reply(404, {'errorMessage': 'Not found'})
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    callback_url = body['CallBackURL']
+                    amount = body['Amount']
+                except (KeyError, ValueError):
+                    return self.reply(400, {'errorMessage': 'Bad Request - Invalid STK push'})
+                merchant_request_id, checkout_request_id = new_request_ids()
+                command.schedule(callback_url, merchant_request_id, checkout_request_id, amount, body.get('PhoneNumber'))
+                self.reply(200, {
+                    'MerchantRequestID': merchant_request_id,
+                    'CheckoutRequestID': checkout_request_id,
+                    'ResponseCode': '0',
+                    'ResponseDescription': 'Success. Request accepted for processing',
+                    'CustomerMessage': 'Success. Request accepted for processing',
+                })
+
+            def reply(self, status, data):
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def schedule(self, callback_url, merchant_request_id, checkout_request_id, amount, phone_number):
+        """Queue the callback(s) for one push according to the simulator options"""
+        with self.lock:
+            self.stats['pushes'] += 1
+            if random.random() < self.options['drop_rate']:
+                self.stats['dropped'] += 1
+                return
+        result_code = 1032 if random.random() < self.options['fail_rate'] else 0
+        body = callback_body(merchant_request_id, checkout_request_id, result_code, amount, phone_number)
+        due = time.monotonic() + self.options['delay'] * random.uniform(0.5, 1.5)
+        self.pending.put((due, checkout_request_id, callback_url, body))
+
+    def dispatch(self):
+        """Hand callbacks to the worker pool as they fall due"""
+        while True:
+            item = self.pending.get()
+            wait = item[0] - time.monotonic()
+            if wait > 0:
+                self.pending.put(item)
+                time.sleep(min(wait, 0.01))
+                continue
+            for _ in range(max(self.options['duplicates'], 1)):
+                self.executor.submit(self.post_callback, item[2], item[3])
+
+    def post_callback(self, callback_url, body):
+        started = time.perf_counter()
+        request = Request(callback_url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+        try:
+            with urlopen(request, timeout=30) as response:
+                response.read()
+            failed = False
+        except OSError as e:
+            failed = True
+            self.stderr.write(f'Callback to {callback_url} failed: {e}')
+        with self.lock:
+            self.stats['errors' if failed else 'callbacks'] += 1
+            self.timings.append((time.perf_counter() - started) * 1000)
+
+    def report(self):
+        timings = sorted(self.timings)
+        line = ', '.join(f'{name}={count}' for name, count in self.stats.items())
+        if timings:
+            line += (
+                f', callback p50={timings[len(timings) // 2]:.1f}ms'
+                f' p95={timings[min(int(len(timings) * 0.95), len(timings) - 1)]:.1f}ms'
+            )
+        self.stdout.write(self.style.SUCCESS(line))
@@ -0,0 +1,29 @@
+# management/commands/rebuild_route_segments.py
+
+from django.core.management.base import BaseCommand
+from booking_app.models import Route
+from booking_app.search import rebuild_route_segments
+
+class Command(BaseCommand):
+    help = 'Rebuild the route segment index used by trip search'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--route',
+            type=int,
+            action='append',
+            help='Only rebuild the given route ID (may be repeated)',
+        )
+
+    def handle(self, *args, **options):
+        route_ids = options['route'] or list(Route.objects.values_list('id', flat=True))
+        
+        total_segments = 0
+        for route_id in route_ids:
+            total_segments += rebuild_route_segments(route_id)
+        
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rebuilt {total_segments} segments for {len(route_ids)} routes.'
+            )
+        )
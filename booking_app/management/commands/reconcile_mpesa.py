@@ -0,0 +1,114 @@
+# management/commands/reconcile_mpesa.py
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max
+from django.utils import timezone
+from booking_app.models import Booking
+from booking_app.reconciliation import merge_reports, reconcile_statement, write_unpaid_confirmations
+
+class Command(BaseCommand):
+    help = 'Reconcile M-Pesa statement CSV exports against bookings and write discrepancy reports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statements', nargs='+', help='Statement CSV files')
+        parser.add_argument(
+            '--output-dir',
+            default='reconciliation',
+            help='Directory for the report CSVs (default: ./reconciliation)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Statement files processed at once (default: CPU count)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Statement lines matched per query (default: 1000)',
+        )
+        parser.add_argument(
+            '--since',
+            help='Check confirmations paid from this date, YYYY-MM-DD (default: first statement line)',
+        )
+        parser.add_argument(
+            '--until',
+            help='Check confirmations paid up to this date, YYYY-MM-DD (default: last statement line)',
+        )
+
+    def handle(self, *args, **options):
+        for path in options['statements']:
+            if not os.path.isfile(path):
+                raise CommandError(f'Statement {path} not found.')
+        out_dir = options['output_dir']
+        os.makedirs(out_dir, exist_ok=True)
+
+        max_booking_pk = Booking.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+        statements = options['statements']
+        # Forked workers must not share the parent's open connection
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        workers = max(1, min(options['workers'], len(statements)))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            try:
+                results = list(pool.map(
+                    reconcile_statement,
+                    statements,
+                    [out_dir] * len(statements),
+                    [max_booking_pk] * len(statements),
+                    [options['chunk_size']] * len(statements),
+                ))
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        matched = 0
+        for result in results:
+            matched |= int.from_bytes(result['bitmap'], 'little')
+            self.stdout.write(
+                f"{result['path']}: {result['payments']} payments, {result['matched']} matched, "
+                f"{result['orphans']} orphans, {result['mismatches']} amount mismatches"
+            )
+        matched = matched.to_bytes(max_booking_pk // 8 + 1, 'little')
+
+        orphan_path = os.path.join(out_dir, 'orphan_payments.csv')
+        mismatch_path = os.path.join(out_dir, 'amount_mismatches.csv')
+        merge_reports([result['reports'][0] for result in results], orphan_path)
+        merge_reports([result['reports'][1] for result in results], mismatch_path)
+
+        since = self.date_option(options['since'], time.min) or min(
+            (result['first'] for result in results if result['first']), default=None
+        )
+        until = self.date_option(options['until'], time.max) or max(
+            (result['last'] for result in results if result['last']), default=None
+        )
+        unpaid_path = os.path.join(out_dir, 'unpaid_confirmations.csv')
+        if since is None or until is None:
+            self.stdout.write(self.style.WARNING(
+                'No statement dates could be read; pass --since and --until to check confirmations.'
+            ))
+            unpaid = 0
+        else:
+            unpaid = write_unpaid_confirmations(unpaid_path, matched, since, until)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Reconciled {sum(r['payments'] for r in results)} payments from {len(results)} statements: "
+                f"{sum(r['orphans'] for r in results)} orphan payments, "
+                f"{sum(r['mismatches'] for r in results)} amount mismatches, "
+                f"{unpaid} unpaid confirmations. Reports in {out_dir}/"
+            )
+        )
+
+    def date_option(self, value, at):
+        if not value:
+            return None
+        try:
+            return timezone.make_aware(datetime.combine(datetime.strptime(value, '%Y-%m-%d').date(), at))
+        except ValueError:
+            raise CommandError(f'Invalid date {value}; use YYYY-MM-DD.')
@@ -0,0 +1,48 @@
+# management/commands/refresh_fares.py
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from booking_app.models import Trip
+from booking_app.pricing import refresh_fare_factor
+
+class Command(BaseCommand):
+    help = 'Recompute fare factors for upcoming trips (run from cron as departure dates approach)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--trip',
+            type=int,
+            action='append',
+            help='Only refresh the given trip ID (may be repeated)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Trips loaded per batch (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        trips = Trip.objects.filter(
+            status='SCHEDULED', departure_time__gte=timezone.now()
+        ).only('id', 'route_id', 'departure_time', 'departure_date', 'fare_factor').order_by('id')
+        if options['trip']:
+            trips = trips.filter(id__in=options['trip'])
+
+        batch_size = options['batch_size']
+        trip_count = 0
+        changed = 0
+        last_id = 0
+        while True:
+            batch = list(trips.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            changed += sum(1 for trip in batch if refresh_fare_factor(trip))
+            trip_count += len(batch)
+            last_id = batch[-1].id
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Checked {trip_count} trips, {changed} fare factors changed.'
+            )
+        )
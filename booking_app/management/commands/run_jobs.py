@@ -0,0 +1,58 @@
+# management/commands/run_jobs.py
+
+import os
+import socket
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from booking_app.jobs import claim_jobs, run_job
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs (confirmation emails and receipts)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Run every job that is due now, then exit (for cron)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10,
+            help='Jobs claimed at a time (default: 10)',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the queue is empty (default: 1)',
+        )
+
+    def handle(self, *args, **options):
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        done = failed = 0
+        self.stdout.write(f'Worker {worker} started.')
+        try:
+            while True:
+                close_old_connections()
+                jobs = claim_jobs(options['batch_size'], worker)
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                for job in jobs:
+                    if run_job(job):
+                        done += 1
+                    else:
+                        failed += 1
+                        self.stdout.write(self.style.WARNING(
+                            f'{job} failed (attempt {job.attempts}/{job.max_attempts})'
+                        ))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Ran {done + failed} jobs: {done} succeeded, {failed} failed.')
+        )
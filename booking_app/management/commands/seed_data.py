@@ -8,6 +8,7 @@ from booking_app.models import (
     Location, BusCompany, SeatLayout, Bus, Route, RouteStop, 
     Trip, Seat, Booking, BookingSeat, TripSeatAvailability
 )
+from booking_app.inventory import materialize_trip_seats
 
 
 class Command(BaseCommand):
@@ -436,24 +437,18 @@ class Command(BaseCommand):
         """Create seat availability records for all trips"""
         self.stdout.write('Creating trip seat availability...')
         
-        trips = Trip.objects.all()
-        availability_created = 0
+        # Saving a trip already created its rows; this only fills any gaps
+        availability_created = materialize_trip_seats(Trip.objects.all())
         
-        for trip in trips:
-            seats = trip.bus.seats.all()
-            
-            for seat in seats:
-                # 85% of seats available initially (some may be blocked for maintenance)
-                is_available = random.choice([True] * 85 + [False] * 15)
-                
-                TripSeatAvailability.objects.create(
-                    trip=trip,
-                    seat=seat,
-                    is_available=is_available
-                )
-                availability_created += 1
+        # 85% of seats available initially (some may be blocked for maintenance)
+        availability_ids = list(TripSeatAvailability.objects.values_list('id', flat=True))
+        blocked_ids = random.sample(availability_ids, len(availability_ids) * 15 // 100)
+        TripSeatAvailability.objects.filter(id__in=blocked_ids).update(is_available=False)
         
-        self.stdout.write(f'Created {availability_created} seat availability records')
+        self.stdout.write(
+            f'Created {availability_created} seat availability records, '
+            f'blocked {len(blocked_ids)} of {len(availability_ids)} seats'
+        )
 
     def create_users(self):
         """Create sample users"""
@@ -583,9 +578,10 @@ class Command(BaseCommand):
                     
                     # Update seat availability
                     if status in ['CONFIRMED', 'PENDING']:
-                        seat_avail.is_available = False
                         seat_avail.booking = booking
-                        if status == 'PENDING':
+                        if status == 'CONFIRMED':
+                            seat_avail.legs_sold = booking.legs
+                        else:
                             seat_avail.reserved_until = timezone.now() + timedelta(minutes=5)
                         seat_avail.save()
                         
@@ -0,0 +1,100 @@
+# management/commands/send_outbox.py
+
+import os
+import socket
+import time
+from collections import deque
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from booking_app.outbox import OUTBOX_BATCH_SIZE, claim_emails, send_batch
+from booking_app.receipts import start_render_pool
+
+# Batch durations kept for the exit report's percentiles
+BATCH_TIMINGS_KEPT = 10_000
+
+class Command(BaseCommand):
+    help = 'Send queued emails from the outbox in batches over one SMTP connection each'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Send every email that is due now, then exit (for cron)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=OUTBOX_BATCH_SIZE,
+            help=f'Emails sent per SMTP connection (default: {OUTBOX_BATCH_SIZE})',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the outbox is empty (default: 1)',
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            default=60.0,
+            help='Seconds between throughput reports (default: 60)',
+        )
+
+    def handle(self, *args, **options):
+        sender = f"{socket.gethostname()}:{os.getpid()}"
+        totals = {'sent': 0, 'retried': 0, 'dead': 0, 'batches': 0}
+        interval = {'sent': 0, 'busy': 0.0}
+        # Percentiles over the most recent batches; a long-running sender must not grow without bound
+        batch_timings = deque(maxlen=BATCH_TIMINGS_KEPT)
+        started = last_report = time.perf_counter()
+        start_render_pool()
+        self.stdout.write(f'Outbox sender {sender} started.')
+        try:
+            while True:
+                close_old_connections()
+                emails = claim_emails(options['batch_size'], sender)
+                if not emails:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                else:
+                    batch_started = time.perf_counter()
+                    sent, retried, dead = send_batch(emails, get_connection())
+                    elapsed = time.perf_counter() - batch_started
+                    batch_timings.append(elapsed * 1000)
+                    totals['batches'] += 1
+                    totals['sent'] += sent
+                    totals['retried'] += retried
+                    totals['dead'] += dead
+                    interval['sent'] += sent
+                    interval['busy'] += elapsed
+                    if dead:
+                        self.stdout.write(self.style.WARNING(f'{dead} emails dead-lettered after repeated failures'))
+
+                if time.perf_counter() - last_report >= options['stats_interval']:
+                    self.report_interval(interval, time.perf_counter() - last_report)
+                    interval = {'sent': 0, 'busy': 0.0}
+                    last_report = time.perf_counter()
+        except KeyboardInterrupt:
+            pass
+
+        elapsed = time.perf_counter() - started
+        batch_timings = sorted(batch_timings)
+        line = (
+            f"Sent {totals['sent']} emails in {totals['batches']} batches "
+            f"({totals['sent'] / elapsed:.1f}/s); {totals['retried']} to retry, {totals['dead']} dead."
+        )
+        if batch_timings:
+            line += (
+                f" Batch p50={batch_timings[len(batch_timings) // 2]:.0f}ms"
+                f" p95={batch_timings[min(int(len(batch_timings) * 0.95), len(batch_timings) - 1)]:.0f}ms."
+            )
+        self.stdout.write(self.style.SUCCESS(line))
+
+    def report_interval(self, interval, seconds):
+        busy_rate = interval['sent'] / interval['busy'] if interval['busy'] else 0
+        self.stdout.write(
+            f"{interval['sent']} sent in the last {seconds:.0f}s "
+            f"({interval['sent'] / seconds:.1f}/s overall, {busy_rate:.1f}/s while sending)"
+        )
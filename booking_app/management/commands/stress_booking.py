@@ -0,0 +1,293 @@
+# management/commands/stress_booking.py
+
+import json
+import multiprocessing
+import random
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from booking_app.inventory import SEAT_HOLD_MINUTES
+from booking_app.models import (
+    Location, BusCompany, SeatLayout, Bus, Route, Trip, Seat, Booking, BookingSeat, Payment
+)
+from booking_app.mpesa import MPESA_CALLBACK_TOKEN, callback_body
+
+
+def booking_flow(trip_id, seat_ids, seats_per_flow, seed):
+    """
+    One buyer: reserve_seats -> booking_details -> process_payment through the
+    real views, then the M-Pesa callback delivered twice at once, as Safaricom
+    sometimes does.
+    """
+    rng = random.Random(seed)
+    client = Client()
+    wanted = rng.sample(seat_ids, rng.randint(1, seats_per_flow))
+    result = {'held': None, 'hold_ms': None, 'flow_ms': None, 'paid': False, 'error': None}
+    started = time.perf_counter()
+    try:
+        response = client.post(
+            reverse('reserve_seats'),
+            json.dumps({'trip_id': trip_id, 'seat_ids': wanted}),
+            content_type='application/json',
+        )
+        result['hold_ms'] = (time.perf_counter() - started) * 1000
+        data = response.json()
+        if not data.get('success'):
+            return result
+        result['held'] = wanted
+
+        response = client.post(
+            reverse('booking_details', args=[trip_id])
+            + f"?seats={','.join(map(str, wanted))}&hold={data['hold_token']}",
+            {
+                'passenger_name': 'Stress Passenger',
+                'passenger_email': 'stress@example.com',
+                'passenger_phone': '0700000000',
+                'passenger_id_number': '00000000',
+                'passenger_age': 30,
+                'is_kenyan': 'on',
+            },
+        )
+        match = re.search(r'/payment/([^/]+)/', response.get('Location', ''))
+        if not match:
+            result['error'] = f'booking_details returned {response.status_code}'
+            return result
+
+        response = client.post(
+            reverse('process_payment'),
+            json.dumps({'booking_id': match.group(1), 'phone_number': '0700000000'}),
+            content_type='application/json',
+        )
+        data = response.json()
+        if not data.get('success'):
+            result['error'] = f"process_payment: {data.get('message')}"
+            return result
+
+        callback_url = reverse('mpesa_callback')
+        if MPESA_CALLBACK_TOKEN:
+            callback_url += f'?token={MPESA_CALLBACK_TOKEN}'
+        amount = Payment.objects.get(checkout_request_id=data['checkout_request_id']).amount
+        body = json.dumps(callback_body('stress', data['checkout_request_id'], amount=amount, phone_number='0700000000'))
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(post_callback, [callback_url] * 2, [body] * 2))
+        result['paid'] = Booking.objects.filter(booking_id=match.group(1), status='CONFIRMED').exists()
+    except Exception as e:
+        result['error'] = repr(e)
+    finally:
+        result['flow_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def post_callback(url, body):
+    try:
+        return Client().post(url, body, content_type='application/json')
+    finally:
+        connections.close_all()
+
+
+def percentile(timings, pct):
+    return timings[min(int(len(timings) * pct / 100), len(timings) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Stress the booking hot path with concurrent buyers and check no seat is held or sold twice'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--flows',
+            type=int,
+            default=300,
+            help='Buyer flows per phase (default: 300)',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=16,
+            help='Thread pool size for the thread phase (default: 16)',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=4,
+            help='Process pool size for the process phase; 0 skips it (default: 4)',
+        )
+        parser.add_argument(
+            '--seats',
+            type=int,
+            default=60,
+            help='Seats on the synthetic bus; fewer seats means more contention (default: 60)',
+        )
+        parser.add_argument(
+            '--seats-per-flow',
+            type=int,
+            default=4,
+            help='Most seats a single buyer asks for (default: 4)',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='Keep the synthetic trips and bookings instead of deleting them',
+        )
+
+    def handle(self, *args, **options):
+        name = str(connection.settings_dict['NAME'])
+        if connection.vendor == 'sqlite' and (name == ':memory:' or 'mode=memory' in name):
+            raise CommandError('Needs a file-based database so every worker sees the same data.')
+
+        self.options = options
+        # Confirmation emails go nowhere; the test client's host must be allowed
+        with override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            ALLOWED_HOSTS=['testserver'],
+        ):
+            self.seed()
+            try:
+                failures = self.run_phase('thread pool', self.trips[0], self.run_threads)
+                if options['processes']:
+                    failures += self.run_phase('process pool', self.trips[1], self.run_processes)
+            finally:
+                if not options['keep']:
+                    self.cleanup()
+
+        if failures:
+            raise CommandError(f'{failures} double holds, sales or payments detected')
+        self.stdout.write(self.style.SUCCESS('No seat was held or sold twice.'))
+
+    def seed(self):
+        """One bus, one route and a trip per phase, committed so workers can see them"""
+        tag = f'ST{random.randint(1000, 9999)}'
+        seats = self.options['seats']
+        self.locations = [
+            Location.objects.create(name=f'{tag} Origin', code=f'{tag}A'),
+            Location.objects.create(name=f'{tag} Destination', code=f'{tag}B'),
+        ]
+        self.company = BusCompany.objects.create(name=f'{tag} Coaches', phone='+254700000000', email='stress@example.com')
+        self.layout = SeatLayout.objects.create(
+            name=f'{tag} Layout', seat_class='ECONOMY', total_seats=seats,
+            rows=(seats + 3) // 4, columns=4, layout_data={'config': '2x2'}
+        )
+        bus = Bus.objects.create(
+            company=self.company, number_plate=f'{tag} 0001', bus_type='ECONOMY',
+            seat_layout=self.layout, total_seats=seats
+        )
+        Seat.objects.bulk_create([
+            Seat(bus=bus, seat_number=f'{n + 1:02d}', seat_type='WINDOW', seat_class='ECONOMY',
+                 row_number=n // 4 + 1, column_number=n % 4 + 1, price_multiplier=Decimal('1.00'))
+            for n in range(seats)
+        ])
+        self.seat_ids = list(Seat.objects.filter(bus=bus).values_list('id', flat=True))
+        self.route = Route.objects.create(
+            origin=self.locations[0], destination=self.locations[1],
+            distance=300, estimated_duration=timedelta(hours=5)
+        )
+        departure = timezone.now() + timedelta(days=1)
+        # Saving each trip creates its seat availability rows
+        self.trips = [
+            Trip.objects.create(
+                bus=bus, route=self.route, departure_time=departure + timedelta(hours=i),
+                arrival_time=departure + timedelta(hours=i + 5), base_price=Decimal('1500.00')
+            )
+            for i in range(2)
+        ]
+        self.stdout.write(f'Seeded 2 trips with {seats} seats each on a {connection.vendor} database')
+
+    def flow_args(self, trip):
+        flows = self.options['flows']
+        return [
+            (trip.id, self.seat_ids, self.options['seats_per_flow'], seed)
+            for seed in random.sample(range(10 ** 9), flows)
+        ]
+
+    def run_threads(self, trip):
+        def flow(args):
+            try:
+                return booking_flow(*args)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.options['threads']) as pool:
+            return list(pool.map(flow, self.flow_args(trip)))
+
+    def run_processes(self, trip):
+        # Forked workers must not share the parent's open connection
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=self.options['processes'], mp_context=context) as pool:
+            return list(pool.map(booking_flow, *zip(*self.flow_args(trip))))
+
+    def run_phase(self, label, trip, runner):
+        self.stdout.write('\n' + self.style.MIGRATE_HEADING(label))
+        started = time.perf_counter()
+        results = runner(trip)
+        elapsed = time.perf_counter() - started
+
+        holds = [result for result in results if result['held']]
+        errors = [result['error'] for result in results if result['error']]
+        hold_timings = sorted(result['hold_ms'] for result in results if result['hold_ms'] is not None)
+        flow_timings = sorted(result['flow_ms'] for result in holds)
+
+        self.stdout.write(
+            f'flows={len(results)} holds={len(holds)} paid={sum(r["paid"] for r in results)} '
+            f'errors={len(errors)} wall={elapsed:.2f}s holds/sec={len(holds) / elapsed:.1f}'
+        )
+        for name, timings in (('reserve_seats', hold_timings), ('full flow', flow_timings)):
+            if timings:
+                self.stdout.write(
+                    f'{name}: p50={percentile(timings, 50):.1f}ms '
+                    f'p95={percentile(timings, 95):.1f}ms p99={percentile(timings, 99):.1f}ms'
+                )
+        for error in sorted(set(errors))[:5]:
+            self.stdout.write(self.style.WARNING(f'  {error}'))
+
+        return self.check_invariants(trip, holds, elapsed)
+
+    def check_invariants(self, trip, holds, elapsed):
+        """Count seats held by two flows or sold on overlapping legs of two confirmed bookings"""
+        failures = 0
+        if elapsed >= SEAT_HOLD_MINUTES * 60:
+            self.stdout.write(self.style.WARNING('Run outlasted the hold time; hold check skipped'))
+        else:
+            # Nothing is released during a run, so a seat can be held successfully only once
+            held_by = {}
+            for result in holds:
+                for seat_id in result['held']:
+                    held_by[seat_id] = held_by.get(seat_id, 0) + 1
+            for seat_id, count in held_by.items():
+                if count > 1:
+                    failures += 1
+                    self.stdout.write(self.style.ERROR(f'Seat {seat_id} held by {count} buyers'))
+
+        # Seats may be resold on other legs, so only overlapping sales count
+        sold_legs = {}
+        for seat_id, legs in BookingSeat.objects.filter(
+            booking__trip=trip, booking__status='CONFIRMED'
+        ).values_list('seat_id', 'booking__legs'):
+            if sold_legs.get(seat_id, 0) & legs:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f'Seat {seat_id} sold twice on the same leg'))
+            sold_legs[seat_id] = sold_legs.get(seat_id, 0) | legs
+
+        # Duplicate callbacks must settle each payment once
+        for booking_id, payments in Payment.objects.filter(
+            booking__trip=trip, status='PAID'
+        ).values_list('booking__booking_id').annotate(count=Count('id')).filter(count__gt=1):
+            failures += 1
+            self.stdout.write(self.style.ERROR(f'Booking {booking_id} paid {payments} times'))
+        return failures
+
+    def cleanup(self):
+        # Trips, bookings and seat rows go with the bus company and locations
+        self.company.delete()
+        self.route.delete()
+        self.layout.delete()
+        for location in self.locations:
+            location.delete()
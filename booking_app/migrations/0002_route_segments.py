@@ -0,0 +1,78 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:27
+
+import django.db.models.deletion
+from datetime import timedelta
+from django.db import migrations, models
+
+
+def route_segment_rows(route, stops):
+    """
+    Frozen copy of booking_app.search.route_segment_rows as of this
+    migration, so later changes to the app cannot alter what it builds.
+    """
+    points = [(route.origin_id, 0)]
+    points += [(stop.location_id, stop.distance_from_origin) for stop in stops]
+    points.append((route.destination_id, route.distance))
+
+    def offset(distance):
+        if not route.distance:
+            return timedelta()
+        return route.estimated_duration * (distance / route.distance)
+
+    rows = []
+    for i, (origin_id, origin_distance) in enumerate(points):
+        for j in range(i + 1, len(points)):
+            destination_id, destination_distance = points[j]
+            if origin_id == destination_id:
+                continue
+            rows.append({
+                'route_id': route.id,
+                'origin_id': origin_id,
+                'destination_id': destination_id,
+                'origin_index': i,
+                'destination_index': j,
+                'distance': max(destination_distance - origin_distance, 0),
+                'departure_offset': offset(origin_distance),
+                'arrival_offset': offset(destination_distance),
+            })
+    return rows
+
+
+def build_route_segments(apps, schema_editor):
+    Route = apps.get_model('booking_app', 'Route')
+    RouteStop = apps.get_model('booking_app', 'RouteStop')
+    RouteSegment = apps.get_model('booking_app', 'RouteSegment')
+    for route in Route.objects.all():
+        stops = RouteStop.objects.filter(route=route).order_by('stop_order')
+        RouteSegment.objects.bulk_create([
+            RouteSegment(**row) for row in route_segment_rows(route, stops)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin_index', models.PositiveIntegerField()),
+                ('destination_index', models.PositiveIntegerField()),
+                ('distance', models.PositiveIntegerField(help_text='Segment distance in kilometers')),
+                ('departure_offset', models.DurationField(help_text='Time from route departure to boarding')),
+                ('arrival_offset', models.DurationField(help_text='Time from route departure to alighting')),
+                ('destination', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='destination_segments', to='booking_app.location')),
+                ('origin', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='origin_segments', to='booking_app.location')),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='booking_app.route')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['origin', 'destination', 'route'], name='segment_lookup_idx')],
+                'unique_together': {('route', 'origin_index', 'destination_index')},
+            },
+        ),
+        migrations.RunPython(build_route_segments, migrations.RunPython.noop),
+    ]
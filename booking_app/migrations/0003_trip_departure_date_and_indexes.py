@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:31
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def backfill_departure_date(apps, schema_editor):
+    Trip = apps.get_model('booking_app', 'Trip')
+    Trip.objects.update(departure_date=TruncDate('departure_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0002_route_segments'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='departure_date',
+            field=models.DateField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_departure_date, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='trip',
+            name='departure_date',
+            field=models.DateField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['status', 'expires_at'], name='booking_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['trip', 'status'], name='booking_trip_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['route', 'status', 'departure_date', 'departure_time'], name='trip_search_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['status', 'departure_time'], name='trip_status_departure_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tripseatavailability',
+            index=models.Index(fields=['trip', 'is_available', 'reserved_until'], name='seat_availability_idx'),
+        ),
+    ]
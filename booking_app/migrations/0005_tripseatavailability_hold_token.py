@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0004_location_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tripseatavailability',
+            name='hold_token',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0005_tripseatavailability_hold_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='fare_factor',
+            field=models.DecimalField(decimal_places=2, default=1.0, max_digits=4),
+        ),
+        migrations.AddField(
+            model_name='tripseatavailability',
+            name='quoted_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='PriceCurve',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('load_steps', models.JSONField(default=list, help_text='[[load factor, multiplier], ...], e.g. [[0, 1.0], [0.8, 1.2]]')),
+                ('days_steps', models.JSONField(default=list, help_text='[[days before departure, multiplier], ...], e.g. [[0, 1.1], [3, 1.0]]')),
+                ('min_factor', models.DecimalField(decimal_places=2, default=1.0, max_digits=4)),
+                ('max_factor', models.DecimalField(decimal_places=2, default=1.5, max_digits=4)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('route', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='price_curve', to='booking_app.route')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:54
+
+from django.db import migrations, models
+
+ALL_LEGS = (1 << 63) - 1
+
+
+def move_sold_seats_to_legs(apps, schema_editor):
+    # Seats on confirmed bookings were taken off sale entirely; they are
+    # now sold on every leg, leaving is_available for operator blocks
+    TripSeatAvailability = apps.get_model('booking_app', 'TripSeatAvailability')
+    TripSeatAvailability.objects.filter(
+        is_available=False, booking__status='CONFIRMED'
+    ).update(is_available=True, legs_sold=ALL_LEGS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0006_dynamic_pricing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='legs',
+            field=models.PositiveBigIntegerField(default=9223372036854775807),
+        ),
+        migrations.AddField(
+            model_name='tripseatavailability',
+            name='legs_sold',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(move_sold_seats_to_legs, migrations.RunPython.noop),
+    ]
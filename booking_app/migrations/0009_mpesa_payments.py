@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0008_job_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('status', models.CharField(choices=[('INITIATED', 'Initiated'), ('AWAITING_CALLBACK', 'Awaiting Callback'), ('PAID', 'Paid'), ('FAILED', 'Failed'), ('TIMED_OUT', 'Timed Out')], default='INITIATED', max_length=20)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100)),
+                ('checkout_request_id', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('mpesa_receipt', models.CharField(blank=True, max_length=50)),
+                ('result_code', models.IntegerField(blank=True, null=True)),
+                ('result_desc', models.CharField(blank=True, max_length=255)),
+                ('refund_due', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('callback_received_at', models.DateTimeField(blank=True, null=True)),
+                ('booking', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payments', to='booking_app.booking')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='payment_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0009_mpesa_payments'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['mpesa_transaction_id'], name='booking_mpesa_receipt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='booking',
+            index=models.Index(fields=['status', 'paid_at'], name='booking_paid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['mpesa_receipt'], name='payment_receipt_idx'),
+        ),
+    ]
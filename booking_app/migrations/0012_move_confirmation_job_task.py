@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:40
+
+from django.db import migrations
+
+OLD_TASK = 'booking_app.views.send_booking_confirmation_job'
+NEW_TASK = 'booking_app.outbox.send_booking_confirmation_job'
+
+
+def move_task(apps, schema_editor):
+    """Point confirmation jobs still waiting to run at the shim's new home"""
+    Job = apps.get_model('booking_app', 'Job')
+    Job.objects.filter(task=OLD_TASK, status__in=['PENDING', 'RUNNING']).update(task=NEW_TASK)
+
+
+def restore_task(apps, schema_editor):
+    Job = apps.get_model('booking_app', 'Job')
+    Job.objects.filter(task=NEW_TASK, status__in=['PENDING', 'RUNNING']).update(task=OLD_TASK)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking_app', '0011_email_outbox'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_task, restore_task),
+    ]
@@ -1,8 +1,12 @@
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.functions import TruncDate
+from django.db.models.lookups import Exact
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.utils import timezone
-from datetime import timedelta
-import uuid
+from datetime import datetime, timedelta
+from .booking_ids import new_booking_id
 
 class Location(models.Model):
     name = models.CharField(max_length=100)
@@ -83,6 +87,93 @@ class RouteStop(models.Model):
     
     def __str__(self):
         return f"{self.route} - {self.location} (Stop {self.stop_order})"
+    
+    def renumbered_routes(self):
+        """Routes whose legs would be renumbered by saving this stop (none if only the distance changed)"""
+        previous = None
+        if self.pk:
+            previous = RouteStop.objects.filter(pk=self.pk).values_list('route_id', 'location_id', 'stop_order').first()
+        if previous == (self.route_id, self.location_id, self.stop_order):
+            return set()
+        return {self.route_id} | ({previous[0]} if previous else set())
+    
+    def clean(self):
+        for route_id in self.renumbered_routes():
+            check_stops_editable(route_id)
+
+class PriceCurve(models.Model):
+    """
+    Yield-management curve scaling a trip's base price.
+
+    Each list holds [threshold, multiplier] pairs; the multiplier of the
+    highest threshold reached applies. The curve without a route is the
+    default for routes that have none.
+    """
+    route = models.OneToOneField(Route, on_delete=models.CASCADE, null=True, blank=True, related_name='price_curve')
+    load_steps = models.JSONField(default=list, help_text="[[load factor, multiplier], ...], e.g. [[0, 1.0], [0.8, 1.2]]")
+    days_steps = models.JSONField(default=list, help_text="[[days before departure, multiplier], ...], e.g. [[0, 1.1], [3, 1.0]]")
+    min_factor = models.DecimalField(max_digits=4, decimal_places=2, default=1.0)
+    max_factor = models.DecimalField(max_digits=4, decimal_places=2, default=1.5)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"Price curve for {self.route or 'all routes'}"
+
+class RouteSegment(models.Model):
+    """Precomputed boarding/alighting pair on a route, used by trip search"""
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, related_name='segments')
+    origin = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='origin_segments')
+    destination = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='destination_segments')
+    # Position along the route: 0 is the route origin, last is the route destination
+    origin_index = models.PositiveIntegerField()
+    destination_index = models.PositiveIntegerField()
+    distance = models.PositiveIntegerField(help_text="Segment distance in kilometers")
+    departure_offset = models.DurationField(help_text="Time from route departure to boarding")
+    arrival_offset = models.DurationField(help_text="Time from route departure to alighting")
+    
+    class Meta:
+        unique_together = ('route', 'origin_index', 'destination_index')
+        indexes = [
+            models.Index(fields=['origin', 'destination', 'route'], name='segment_lookup_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.route}: {self.origin} to {self.destination}"
+
+def local_departure_date(departure_time):
+    """Calendar date of a departure in the site's time zone"""
+    if timezone.is_naive(departure_time):
+        return departure_time.date()
+    return timezone.localdate(departure_time)
+
+class TripQuerySet(models.QuerySet):
+    """Keeps Trip.departure_date in sync for writes that bypass save()"""
+    
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for trip in objs:
+            if trip.departure_time:
+                trip.departure_date = local_departure_date(trip.departure_time)
+        return super().bulk_create(objs, *args, **kwargs)
+    
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = list(objs)
+        fields = list(fields)
+        if 'departure_time' in fields:
+            for trip in objs:
+                trip.departure_date = local_departure_date(trip.departure_time)
+            if 'departure_date' not in fields:
+                fields.append('departure_date')
+        return super().bulk_update(objs, fields, *args, **kwargs)
+    
+    def update(self, **kwargs):
+        if 'departure_time' in kwargs:
+            value = kwargs['departure_time']
+            if isinstance(value, datetime):
+                kwargs['departure_date'] = local_departure_date(value)
+            else:
+                kwargs['departure_date'] = TruncDate(value)
+        return super().update(**kwargs)
 
 class Trip(models.Model):
     STATUS_CHOICES = [
@@ -95,11 +186,31 @@ class Trip(models.Model):
     bus = models.ForeignKey(Bus, on_delete=models.CASCADE)
     route = models.ForeignKey(Route, on_delete=models.CASCADE)
     departure_time = models.DateTimeField()
+    # Local date of departure_time, stored so date searches can use an index
+    departure_date = models.DateField(editable=False)
     arrival_time = models.DateTimeField()
     base_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # Current PriceCurve multiplier on base_price, kept up to date by pricing.py
+    fare_factor = models.DecimalField(max_digits=4, decimal_places=2, default=1.0)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='SCHEDULED')
     created_at = models.DateTimeField(auto_now_add=True)
     
+    objects = TripQuerySet.as_manager()
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['route', 'status', 'departure_date', 'departure_time'], name='trip_search_idx'),
+            models.Index(fields=['status', 'departure_time'], name='trip_status_departure_idx'),
+        ]
+    
+    def save(self, *args, **kwargs):
+        if self.departure_time:
+            self.departure_date = local_departure_date(self.departure_time)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'departure_time' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'departure_date'}
+        super().save(*args, **kwargs)
+    
     def __str__(self):
         return f"{self.route} - {self.departure_time.strftime('%Y-%m-%d %H:%M')}"
 
@@ -133,9 +244,13 @@ class Seat(models.Model):
 
 # In your models.py, replace the Booking model with this:
 
+# Leg mask covering a whole route however many stops it has. Leg k runs
+# from stop k to stop k + 1, numbered like RouteSegment's stop indexes.
+ALL_LEGS = (1 << 63) - 1
+
 def generate_booking_id():
-    """Generate a unique booking ID"""
-    return str(uuid.uuid4())[:12].upper()
+    """Generate a unique, time-ordered booking ID"""
+    return new_booking_id()
 
 class Booking(models.Model):
     STATUS_CHOICES = [
@@ -160,6 +275,8 @@ class Booking(models.Model):
     # Booking details
     pickup_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='pickup_bookings')
     dropoff_location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='dropoff_bookings')
+    # Route legs travelled between pickup and dropoff, as a bitmask
+    legs = models.PositiveBigIntegerField(default=ALL_LEGS)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     
@@ -172,6 +289,15 @@ class Booking(models.Model):
     expires_at = models.DateTimeField()
     paid_at = models.DateTimeField(null=True, blank=True)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='booking_expiry_idx'),
+            models.Index(fields=['trip', 'status'], name='booking_trip_status_idx'),
+            # Statement reconciliation looks bookings up by receipt and scans confirmations by payment time
+            models.Index(fields=['mpesa_transaction_id'], name='booking_mpesa_receipt_idx'),
+            models.Index(fields=['status', 'paid_at'], name='booking_paid_idx'),
+        ]
+    
     def save(self, *args, **kwargs):
         if not self.expires_at:
             self.expires_at = timezone.now() + timedelta(minutes=5)
@@ -184,6 +310,46 @@ class Booking(models.Model):
         return f"Booking {self.booking_id} - {self.passenger_name}"
     
     
+class Payment(models.Model):
+    """
+    One M-Pesa STK push for a booking.
+
+    Moves INITIATED -> AWAITING_CALLBACK when Safaricom accepts the push,
+    then to PAID or FAILED on the callback, or TIMED_OUT if none arrives in
+    time. Transitions are conditional UPDATEs in mpesa.py, so a repeated
+    callback finds the payment already settled and changes nothing.
+    """
+    STATUS_CHOICES = [
+        ('INITIATED', 'Initiated'),
+        ('AWAITING_CALLBACK', 'Awaiting Callback'),
+        ('PAID', 'Paid'),
+        ('FAILED', 'Failed'),
+        ('TIMED_OUT', 'Timed Out'),
+    ]
+    
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='payments')
+    phone_number = models.CharField(max_length=20)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='INITIATED')
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    checkout_request_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    mpesa_receipt = models.CharField(max_length=50, blank=True)
+    result_code = models.IntegerField(null=True, blank=True)
+    result_desc = models.CharField(max_length=255, blank=True)
+    # Paid after the booking had expired or was paid by another push; money must go back
+    refund_due = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    callback_received_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='payment_status_idx'),
+            models.Index(fields=['mpesa_receipt'], name='payment_receipt_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Payment {self.checkout_request_id or self.id} for {self.booking.booking_id} ({self.status})"
+
 class BookingSeat(models.Model):
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, related_name='booked_seats')
     seat = models.ForeignKey(Seat, on_delete=models.CASCADE)
@@ -195,23 +361,156 @@ class BookingSeat(models.Model):
     def __str__(self):
         return f"{self.booking.booking_id} - Seat {self.seat.seat_number}"
 
+def reservable_q(prefix='', now=None):
+    """
+    SQL form of TripSeatAvailability.is_reservable().
+
+    `prefix` reaches the availability rows through a relation, e.g.
+    'tripseatavailability__' from Trip.
+    """
+    now = now or timezone.now()
+    return Q(**{f'{prefix}is_available': True}) & (
+        Q(**{f'{prefix}reserved_until__isnull': True}) |
+        Q(**{f'{prefix}reserved_until__lte': now})
+    )
+
+def check_stops_editable(route_id):
+    """
+    Refuse a stop change on a route with part-route bookings still to travel.
+
+    Their leg masks, and the legs_sold built from them, are numbered by the
+    route's current stops; adding, moving or removing one would shift every
+    later leg under them. Raises ValidationError.
+    """
+    sold = Booking.objects.filter(
+        trip__route_id=route_id,
+        trip__departure_time__gte=timezone.now(),
+        status__in=('PENDING', 'CONFIRMED'),
+    ).exclude(legs=ALL_LEGS)
+    if sold.exists():
+        raise ValidationError(
+            "This route has upcoming trips with bookings for part of the route; "
+            "its stops cannot change until those trips have run."
+        )
+
+def legs_free_q(legs, prefix=''):
+    """
+    SQL filter for availability rows with none of the given legs sold.
+
+    `legs` is a mask or an expression giving one, e.g. from the search's
+    segment join.
+    """
+    return Q(Exact(F(f'{prefix}legs_sold').bitand(legs), 0))
+
 class TripSeatAvailability(models.Model):
-    """Track seat availability for specific trips"""
+    """
+    Track seat availability for specific trips.
+
+    `booking` is the latest booking to take the seat. Once a seat is sold
+    for part of the route and resold on its other legs, several bookings
+    own it; they are found through BookingSeat, not this link.
+    """
     trip = models.ForeignKey(Trip, on_delete=models.CASCADE)
     seat = models.ForeignKey(Seat, on_delete=models.CASCADE)
     is_available = models.BooleanField(default=True)
     reserved_until = models.DateTimeField(null=True, blank=True)
+    # Identifies the reserve_seats call that placed the current hold
+    hold_token = models.CharField(max_length=32, null=True, blank=True)
+    # Fare quoted when the hold was placed; honoured until the hold ends
+    quoted_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # Legs sold on confirmed bookings; a seat is resold on the legs left clear
+    legs_sold = models.PositiveBigIntegerField(default=0)
     booking = models.ForeignKey(Booking, on_delete=models.CASCADE, null=True, blank=True)
     
     class Meta:
         unique_together = ('trip', 'seat')
+        indexes = [
+            models.Index(fields=['trip', 'is_available', 'reserved_until'], name='seat_availability_idx'),
+        ]
     
-    def is_reservable(self):
-        if not self.is_available:
+    def is_reservable(self, legs=ALL_LEGS):
+        if not self.is_available or self.legs_sold & legs:
             return False
         if self.reserved_until and timezone.now() < self.reserved_until:
             return False
         return True
     
     def __str__(self):
-        return f"{self.trip} - Seat {self.seat.seat_number} ({'Available' if self.is_available else 'Booked'})"
\ No newline at end of file
+        return f"{self.trip} - Seat {self.seat.seat_number} ({'Available' if self.is_available else 'Booked'})"
+
+
+class Job(models.Model):
+    """Background task queued in the database and run by the run_jobs command"""
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ]
+    
+    # Dotted path of the function to call with payload as keyword arguments
+    task = models.CharField(max_length=200)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    # Set while a worker runs the job; an expired lease makes it claimable again
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_queue_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.task} #{self.id} ({self.status})"
+
+
+class OutboxEmail(models.Model):
+    """
+    Email waiting to be sent by the send_outbox command.
+
+    Rows are written in the same transaction as the change they announce,
+    so an email goes out if and only if that change committed. Messages
+    that keep failing end up DEAD for someone to look at in the admin.
+    """
+    KIND_CHOICES = [
+        ('BOOKING_CONFIRMATION', 'Booking Confirmation'),
+        ('PLAIN', 'Plain Text'),
+    ]
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('SENDING', 'Sending'),
+        ('SENT', 'Sent'),
+        ('DEAD', 'Dead'),
+    ]
+    
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES, default='PLAIN')
+    # Confirmation emails are rendered from the booking when they are sent
+    booking = models.ForeignKey(Booking, on_delete=models.CASCADE, null=True, blank=True, related_name='emails')
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=8)
+    send_after = models.DateTimeField(default=timezone.now)
+    # Set while a sender has the message; an expired lease makes it claimable again
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'send_after'], name='outbox_queue_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} to {self.to_email} ({self.status})"
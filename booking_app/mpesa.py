@@ -0,0 +1,301 @@
+# mpesa.py - M-Pesa STK push payments and their callbacks
+
+import base64
+import hmac
+import json
+import math
+import uuid
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import Payment
+from .bookings import confirm_booking, extend_booking
+from .jobs import enqueue
+
+# Daraja API root, e.g. https://api.safaricom.co.ke. Left empty, pushes are
+# simulated in-process and the callback arrives through the job queue; point
+# it at `manage.py mpesa_simulator` to exercise the real HTTP round trips.
+MPESA_BASE_URL = getattr(settings, 'MPESA_BASE_URL', '').rstrip('/')
+MPESA_CONSUMER_KEY = getattr(settings, 'MPESA_CONSUMER_KEY', '')
+MPESA_CONSUMER_SECRET = getattr(settings, 'MPESA_CONSUMER_SECRET', '')
+MPESA_SHORTCODE = getattr(settings, 'MPESA_SHORTCODE', '174379')
+MPESA_PASSKEY = getattr(settings, 'MPESA_PASSKEY', '')
+
+# Shared secret appended to the callback URL; Safaricom does not sign callbacks.
+# Required once MPESA_BASE_URL is set: without it callbacks are refused.
+MPESA_CALLBACK_TOKEN = getattr(settings, 'MPESA_CALLBACK_TOKEN', '')
+
+# How long a push may wait for its callback before it counts as timed out
+MPESA_CALLBACK_TIMEOUT = getattr(settings, 'MPESA_CALLBACK_TIMEOUT', 120)
+
+# Delay before an in-process simulated push "completes"
+SIMULATED_CALLBACK_DELAY = 2
+
+MPESA_HTTP_TIMEOUT = 10
+
+# Callback result codes that mean the customer paid
+RESULT_SUCCESS = 0
+
+# Payments a callback may still settle. A timed out push can be paid late,
+# so its callback is recorded, but it can no longer confirm an expired booking.
+OPEN_STATUSES = ('INITIATED', 'AWAITING_CALLBACK', 'TIMED_OUT')
+
+
+class MpesaError(Exception):
+    """The STK push could not be started"""
+
+
+def normalize_phone(phone_number):
+    """Safaricom's 2547XXXXXXXX form of a Kenyan mobile number"""
+    digits = ''.join(char for char in str(phone_number) if char.isdigit())
+    if digits.startswith('0'):
+        digits = '254' + digits[1:]
+    elif len(digits) == 9:
+        digits = '254' + digits
+    return digits
+
+
+def callback_authorized(token):
+    """
+    Whether a callback carrying `token` may settle payments.
+
+    Anyone who learns a checkout request ID could otherwise post a success
+    callback for it, so against a real M-Pesa API the token is mandatory.
+    Only the in-process simulation accepts callbacks without one.
+    """
+    if MPESA_CALLBACK_TOKEN:
+        return hmac.compare_digest(str(token or ''), MPESA_CALLBACK_TOKEN)
+    return not MPESA_BASE_URL
+
+
+def charged_amount(amount):
+    """What an STK push for `amount` asks for: whole shillings, rounded up"""
+    return Decimal(math.ceil(amount))
+
+
+def amount_matches(paid, amount):
+    return paid is not None and paid in (amount, charged_amount(amount))
+
+
+def _request_json(url, body=None, headers=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(url, data=data, headers={'Content-Type': 'application/json', **(headers or {})})
+    try:
+        with urlopen(request, timeout=MPESA_HTTP_TIMEOUT) as response:
+            return json.loads(response.read() or b'{}')
+    except (URLError, OSError, ValueError) as e:
+        raise MpesaError(f"M-Pesa request to {url} failed: {e}") from e
+
+
+def access_token():
+    """OAuth token for the Daraja API, cached until shortly before it expires"""
+    token = cache.get('mpesa_access_token')
+    if token is None:
+        credentials = base64.b64encode(f"{MPESA_CONSUMER_KEY}:{MPESA_CONSUMER_SECRET}".encode()).decode()
+        data = _request_json(
+            f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
+            headers={'Authorization': f'Basic {credentials}'},
+        )
+        token = data.get('access_token')
+        if not token:
+            raise MpesaError(f"M-Pesa did not issue an access token: {data}")
+        cache.set('mpesa_access_token', token, max(int(data.get('expires_in', 3599)) - 60, 60))
+    return token
+
+
+def stk_push(payment, callback_url):
+    """
+    Ask Safaricom to prompt the customer's phone for payment.
+
+    Returns (merchant_request_id, checkout_request_id). Raises MpesaError if
+    the push was not accepted.
+    """
+    if not MPESA_BASE_URL:
+        return _simulated_stk_push(payment)
+
+    timestamp = timezone.localtime().strftime('%Y%m%d%H%M%S')
+    password = base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
+    phone = normalize_phone(payment.phone_number)
+    data = _request_json(
+        f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
+        {
+            'BusinessShortCode': MPESA_SHORTCODE,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': int(charged_amount(payment.amount)),
+            'PartyA': phone,
+            'PartyB': MPESA_SHORTCODE,
+            'PhoneNumber': phone,
+            'CallBackURL': callback_url,
+            'AccountReference': payment.booking.booking_id,
+            'TransactionDesc': 'Bus ticket',
+        },
+        headers={'Authorization': f'Bearer {access_token()}'},
+    )
+    if str(data.get('ResponseCode')) != '0' or not data.get('CheckoutRequestID'):
+        raise MpesaError(data.get('errorMessage') or data.get('ResponseDescription') or 'STK push rejected')
+    return data.get('MerchantRequestID', ''), data['CheckoutRequestID']
+
+
+def new_request_ids():
+    """Merchant and checkout request IDs shaped like Safaricom's"""
+    merchant_request_id = f"{uuid.uuid4().int % 100000}-{uuid.uuid4().int % 10 ** 8}-1"
+    checkout_request_id = f"ws_CO_{timezone.localtime().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:12]}"
+    return merchant_request_id, checkout_request_id
+
+
+def _simulated_stk_push(payment):
+    merchant_request_id, checkout_request_id = new_request_ids()
+    enqueue(
+        'booking_app.mpesa.deliver_simulated_callback',
+        run_at=timezone.now() + timedelta(seconds=SIMULATED_CALLBACK_DELAY),
+        checkout_request_id=checkout_request_id,
+    )
+    return merchant_request_id, checkout_request_id
+
+
+def callback_body(merchant_request_id, checkout_request_id, result_code=RESULT_SUCCESS,
+                  amount=None, phone_number=None, receipt=None):
+    """A Daraja STK callback payload; used by the simulators"""
+    callback = {
+        'MerchantRequestID': merchant_request_id,
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == RESULT_SUCCESS
+                      else 'Request cancelled by user',
+    }
+    if result_code == RESULT_SUCCESS:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': float(amount or 0)},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt or uuid.uuid4().hex[:10].upper()},
+            {'Name': 'TransactionDate', 'Value': int(timezone.localtime().strftime('%Y%m%d%H%M%S'))},
+            {'Name': 'PhoneNumber', 'Value': int(normalize_phone(phone_number or '0700000000'))},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+def deliver_simulated_callback(checkout_request_id):
+    """Job: complete an in-process simulated push as a successful payment"""
+    payment = Payment.objects.filter(checkout_request_id=checkout_request_id).first()
+    if payment is not None:
+        apply_callback(callback_body(
+            payment.merchant_request_id, checkout_request_id,
+            amount=payment.amount, phone_number=payment.phone_number,
+        ))
+
+
+def initiate_payment(booking, phone_number, callback_url):
+    """
+    Start an STK push for a pending booking.
+
+    A push still waiting on the customer is returned instead of sending a
+    second prompt. Once Safaricom accepts, the booking and its seat holds
+    are extended to cover the callback window. Raises MpesaError (with the
+    payment marked FAILED) if the push could not be sent.
+    """
+    now = timezone.now()
+    waiting = booking.payments.filter(
+        status__in=['INITIATED', 'AWAITING_CALLBACK'],
+        created_at__gte=now - timedelta(seconds=MPESA_CALLBACK_TIMEOUT),
+    ).order_by('-created_at').first()
+    if waiting is not None:
+        return waiting
+
+    payment = Payment.objects.create(booking=booking, phone_number=phone_number, amount=booking.total_amount)
+    try:
+        merchant_request_id, checkout_request_id = stk_push(payment, callback_url)
+    except MpesaError as e:
+        Payment.objects.filter(id=payment.id, status='INITIATED').update(status='FAILED', result_desc=str(e)[:255])
+        payment.status = 'FAILED'
+        raise
+
+    Payment.objects.filter(id=payment.id, status='INITIATED').update(
+        status='AWAITING_CALLBACK',
+        merchant_request_id=merchant_request_id,
+        checkout_request_id=checkout_request_id,
+    )
+    payment.status = 'AWAITING_CALLBACK'
+    payment.merchant_request_id = merchant_request_id
+    payment.checkout_request_id = checkout_request_id
+    extend_booking(booking, timezone.now() + timedelta(seconds=MPESA_CALLBACK_TIMEOUT))
+    return payment
+
+
+def parse_callback(body):
+    """The fields we use from a Daraja STK callback; raises ValueError if malformed"""
+    try:
+        callback = body['Body']['stkCallback']
+        items = callback.get('CallbackMetadata', {}).get('Item', [])
+        metadata = {item['Name']: item.get('Value') for item in items}
+        amount = metadata.get('Amount')
+        return {
+            'checkout_request_id': str(callback['CheckoutRequestID']),
+            'result_code': int(callback['ResultCode']),
+            'result_desc': str(callback.get('ResultDesc', ''))[:255],
+            'receipt': str(metadata.get('MpesaReceiptNumber') or ''),
+            'phone_number': str(metadata.get('PhoneNumber') or ''),
+            'amount': Decimal(str(amount)) if amount is not None else None,
+        }
+    except (KeyError, TypeError, ValueError, AttributeError, InvalidOperation) as e:
+        raise ValueError(f"Malformed STK callback: {e}") from e
+
+
+def apply_callback(body):
+    """
+    Settle a payment from its STK callback.
+
+    The payment moves to PAID or FAILED in one conditional UPDATE on its
+    open status, so of several deliveries of the same callback only the
+    first has any effect. A success callback whose Amount is not what the
+    push asked for is recorded as FAILED with refund_due set, and never
+    confirms the booking. A successful payment then confirms the booking
+    through confirm_booking(), which refuses expired or already confirmed
+    bookings; such payments are flagged refund_due instead. Returns the
+    settled Payment, or None for a duplicate or unknown callback.
+    """
+    data = parse_callback(body)
+    # Read before the transaction, so its first statement is the write (SQLite
+    # cannot upgrade a read transaction to a write one while another writer waits)
+    payment = Payment.objects.select_related('booking__trip').filter(
+        checkout_request_id=data['checkout_request_id'],
+        status__in=OPEN_STATUSES,
+    ).first()
+    if payment is None:
+        return None
+    paid = data['result_code'] == RESULT_SUCCESS
+    amount_ok = not paid or amount_matches(data['amount'], payment.amount)
+    if not amount_ok:
+        data['result_desc'] = f"Amount mismatch: paid {data['amount']}, expected {charged_amount(payment.amount)}"
+    with transaction.atomic():
+        settled = Payment.objects.filter(id=payment.id, status__in=OPEN_STATUSES).update(
+            status='PAID' if paid and amount_ok else 'FAILED',
+            result_code=data['result_code'],
+            result_desc=data['result_desc'],
+            mpesa_receipt=data['receipt'],
+            refund_due=not amount_ok,
+            callback_received_at=timezone.now(),
+        )
+        if not settled:
+            return None
+        payment.status = 'PAID' if paid and amount_ok else 'FAILED'
+        payment.result_desc = data['result_desc']
+        payment.refund_due = not amount_ok
+        if paid and amount_ok and not confirm_booking(payment.booking, data['receipt'], payment.phone_number):
+            Payment.objects.filter(id=payment.id).update(refund_due=True)
+            payment.refund_due = True
+    return payment
+
+
+def expire_stale_payments(payments=None):
+    """Mark pushes that got no callback within MPESA_CALLBACK_TIMEOUT as TIMED_OUT; returns the count"""
+    payments = Payment.objects.all() if payments is None else payments
+    return payments.filter(
+        status__in=['INITIATED', 'AWAITING_CALLBACK'],
+        created_at__lt=timezone.now() - timedelta(seconds=MPESA_CALLBACK_TIMEOUT),
+    ).update(status='TIMED_OUT')
@@ -0,0 +1,153 @@
+# outbox.py - Transactional email outbox, sent in batches over one connection
+
+import traceback
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import Booking, OutboxEmail
+from .emails import booking_confirmation_email
+from .jobs import retry_delay
+from .receipts import store_receipts
+
+OUTBOX_BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 50)
+
+# How long a claimed batch belongs to its sender; a crashed sender's batch is sent again after it
+OUTBOX_LEASE_SECONDS = getattr(settings, 'OUTBOX_LEASE_SECONDS', 5 * 60)
+
+# Functions building the EmailMessage for a row, by kind
+MESSAGE_BUILDERS = {
+    'BOOKING_CONFIRMATION': booking_confirmation_email,
+}
+
+
+def queue_email(to_email, subject, body='', kind='PLAIN', booking=None):
+    """
+    Add an email to the outbox.
+
+    Call it inside the transaction making the change the email announces;
+    the row commits or rolls back with it.
+    """
+    return OutboxEmail.objects.create(kind=kind, booking=booking, to_email=to_email, subject=subject, body=body)
+
+
+def queue_booking_confirmation(booking):
+    """Outbox the confirmation email, with its PDF receipt, for a paid booking"""
+    return queue_email(
+        booking.passenger_email,
+        f'Booking Confirmed - {booking.booking_id} | DreamLine Bus Service',
+        kind='BOOKING_CONFIRMATION',
+        booking=booking,
+    )
+
+
+def send_booking_confirmation_job(booking_id):
+    """Job queued before confirmations went through the outbox: hand it over"""
+    booking = Booking.objects.get(id=booking_id)
+    if not booking.emails.filter(kind='BOOKING_CONFIRMATION').exists():
+        queue_booking_confirmation(booking)
+
+
+def due_q(now):
+    """Emails ready to send: pending and due, or held by a sender whose lease ran out"""
+    return Q(status='PENDING', send_after__lte=now) | Q(status='SENDING', locked_until__lt=now)
+
+
+def claim_emails(limit=OUTBOX_BATCH_SIZE, sender=None):
+    """Take up to `limit` due emails with one token-stamped UPDATE, as claim_jobs() does"""
+    now = timezone.now()
+    candidates = list(
+        OutboxEmail.objects.filter(due_q(now)).order_by('send_after').values_list('id', flat=True)[:limit]
+    )
+    if not candidates:
+        return []
+    token = f"{sender or 'sender'}:{uuid.uuid4().hex[:12]}"
+    OutboxEmail.objects.filter(due_q(now), id__in=candidates).update(
+        status='SENDING',
+        locked_by=token,
+        locked_until=now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+    )
+    return list(OutboxEmail.objects.filter(locked_by=token, status='SENDING').order_by('send_after'))
+
+
+def build_message(email, bookings):
+    if email.kind in MESSAGE_BUILDERS:
+        message = MESSAGE_BUILDERS[email.kind](None, bookings[email.booking_id])
+    else:
+        message = EmailMessage(email.subject, email.body, settings.DEFAULT_FROM_EMAIL, [email.to_email])
+    message.to = [email.to_email]
+    return message
+
+
+def send_batch(emails, connection=None):
+    """
+    Send claimed emails over one SMTP session and record each outcome.
+
+    Messages go one per send_messages() call on a connection opened once
+    for the batch, so a failure is charged to that message alone. It is
+    retried with backoff, or marked DEAD after max_attempts; the session is
+    reopened in case the failure broke it. Returns (sent, retried, dead).
+    """
+    connection = connection or get_connection()
+    bookings = Booking.objects.select_related(
+        'trip__route__origin', 'trip__route__destination', 'trip__bus__company',
+        'pickup_location', 'dropoff_location'
+    ).prefetch_related('booked_seats__seat').in_bulk([email.booking_id for email in emails if email.booking_id])
+    # Lay out the batch's receipts in parallel rather than one per message
+    store_receipts([bookings[email.booking_id] for email in emails
+                    if email.kind == 'BOOKING_CONFIRMATION' and email.booking_id in bookings])
+
+    sent = []
+    failures = []
+    try:
+        connection.open()
+    except Exception:
+        failures = [(email, traceback.format_exc()) for email in emails]
+        emails = []
+    try:
+        for email in emails:
+            try:
+                if not connection.send_messages([build_message(email, bookings)]):
+                    raise RuntimeError('The email backend did not accept the message')
+            except Exception:
+                failures.append((email, traceback.format_exc()))
+                try:
+                    connection.close()
+                    connection.open()
+                except Exception:
+                    pass
+            else:
+                sent.append(email)
+    finally:
+        connection.close()
+
+    now = timezone.now()
+    # Outcomes are only recorded while the lease is still ours
+    for token in {email.locked_by for email in sent}:
+        OutboxEmail.objects.filter(id__in=[email.id for email in sent if email.locked_by == token], locked_by=token).update(
+            status='SENT',
+            attempts=F('attempts') + 1,
+            sent_at=now,
+            last_error='',
+            locked_by='',
+            locked_until=None,
+        )
+    dead = 0
+    for email, error in failures:
+        attempts = email.attempts + 1
+        if attempts >= email.max_attempts:
+            dead += 1
+            status, send_after = 'DEAD', email.send_after
+        else:
+            status, send_after = 'PENDING', now + retry_delay(attempts)
+        OutboxEmail.objects.filter(id=email.id, locked_by=email.locked_by).update(
+            status=status,
+            attempts=attempts,
+            send_after=send_after,
+            last_error=error,
+            locked_by='',
+            locked_until=None,
+        )
+    return len(sent), len(failures) - dead, dead
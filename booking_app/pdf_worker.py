@@ -0,0 +1,28 @@
+# pdf_worker.py - WeasyPrint state kept warm inside receipt render processes
+#
+# Imported by the render pool's worker processes, so it must not touch the
+# ORM or anything else that needs Django set up.
+
+import threading
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
+
+_state = threading.local()
+
+
+def warm(css):
+    """Load fonts and parse the stylesheet once; later calls with the same CSS are free"""
+    if getattr(_state, 'css', None) != css:
+        _state.font_config = FontConfiguration()
+        _state.stylesheet = CSS(string=css, font_config=_state.font_config)
+        _state.css = css
+
+
+def ping():
+    return True
+
+
+def render(html_string, base_url):
+    """Lay out and write one PDF with the stylesheet and fonts loaded by warm()"""
+    html = HTML(string=html_string, base_url=base_url)
+    return html.render(stylesheets=[_state.stylesheet], font_config=_state.font_config).write_pdf()
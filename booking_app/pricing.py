@@ -0,0 +1,155 @@
+# pricing.py - Occupancy and lead-time driven fares
+
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import PriceCurve, RouteSegment, Seat, Trip, TripSeatAvailability
+from .inventory import seat_map
+from .search import SEARCH_GENERATION_KEY, bump_version, current_versions, invalidate_trip_search_for
+
+# Used for routes without a PriceCurve when no default curve is stored.
+# Fares never drop below the base price; they rise as the bus fills up and
+# in the last days before departure.
+DEFAULT_LOAD_STEPS = getattr(settings, 'DEFAULT_PRICE_LOAD_STEPS', [[0, 1.0], [0.6, 1.1], [0.8, 1.2], [0.9, 1.35]])
+DEFAULT_DAYS_STEPS = getattr(settings, 'DEFAULT_PRICE_DAYS_STEPS', [[0, 1.1], [3, 1.0]])
+DEFAULT_MIN_FACTOR = Decimal('1.00')
+DEFAULT_MAX_FACTOR = Decimal('1.50')
+
+FARE_TABLE_CACHE_TIMEOUT = getattr(settings, 'FARE_TABLE_CACHE_TIMEOUT', 3600)
+
+# Bumped when curves or seat multipliers change, retiring every fare table
+PRICING_VERSION_KEY = 'pricing_version'
+
+CENT = Decimal('0.01')
+
+_curves = None
+
+
+def step_multiplier(steps, value):
+    """Multiplier of the highest [threshold, multiplier] step that value reaches"""
+    multiplier = 1.0
+    for threshold, step in sorted(steps):
+        if value >= threshold:
+            multiplier = step
+    return multiplier
+
+
+def price_curves():
+    """This process's curves by route ID (None for the default), reloaded on version change"""
+    global _curves
+    version, = current_versions(PRICING_VERSION_KEY)
+    if _curves is None or _curves[0] != version:
+        curves = {None: (DEFAULT_LOAD_STEPS, DEFAULT_DAYS_STEPS, DEFAULT_MIN_FACTOR, DEFAULT_MAX_FACTOR)}
+        for curve in PriceCurve.objects.all():
+            curves[curve.route_id] = (curve.load_steps, curve.days_steps, curve.min_factor, curve.max_factor)
+        _curves = (version, curves)
+    return _curves[1]
+
+
+def invalidate_pricing():
+    """Make every process reload curves and rebuild fare tables"""
+    transaction.on_commit(lambda: bump_version(PRICING_VERSION_KEY))
+
+
+def compute_fare_factor(route_id, load_factor, days_to_departure):
+    curves = price_curves()
+    load_steps, days_steps, min_factor, max_factor = curves.get(route_id, curves[None])
+    factor = Decimal(str(step_multiplier(load_steps, load_factor) * step_multiplier(days_steps, days_to_departure)))
+    return min(max(factor, min_factor), max_factor).quantize(CENT, ROUND_HALF_UP)
+
+
+def trip_load_factor(trip_id, now=None):
+    """Share of a trip's seat-legs sold or held, read from the cached seat map"""
+    return seat_map(trip_id).load_factor(now)
+
+
+def refresh_fare_factor(trip):
+    """
+    Recompute a trip's fare factor and store it if it moved.
+
+    Reads only the cached seat map, and writes a single UPDATE when the
+    factor crosses a curve step. Returns True if it changed.
+    """
+    now = timezone.now()
+    days = (trip.departure_time - now).total_seconds() / 86400
+    factor = compute_fare_factor(trip.route_id, trip_load_factor(trip.id, now.timestamp()), days)
+    if factor == trip.fare_factor:
+        return False
+    Trip.objects.filter(id=trip.id).update(fare_factor=factor)
+    trip.fare_factor = factor
+    # Lowest fares shown by search move with the factor
+    invalidate_trip_search_for([trip])
+    return True
+
+
+def schedule_fare_refresh(trips):
+    """refresh_fare_factor() for trips whose occupancy changed, once the transaction commits"""
+    trips = list(trips)
+    transaction.on_commit(lambda: [refresh_fare_factor(trip) for trip in trips])
+
+
+def distance_share(route, origin_id=None, destination_id=None):
+    """
+    Share of a route's distance ridden between two of its stops, as a
+    Decimal; 1 for the whole route. Matches search.seat_fare_expression().
+    """
+    whole_route = origin_id in (None, route.origin_id) and destination_id in (None, route.destination_id)
+    if whole_route or not route.distance:
+        return Decimal(1)
+    distance = RouteSegment.objects.filter(
+        route_id=route.id, origin_id=origin_id, destination_id=destination_id
+    ).order_by('origin_index').values_list('distance', flat=True).first()
+    if distance is None:
+        return Decimal(1)
+    return Decimal(distance) / Decimal(route.distance)
+
+
+def fare_table(trip, journey=None):
+    """
+    Current price of every seat on a trip, as {seat_id: Decimal}.
+
+    Fares are for the journey from trip_journey(), the whole route if
+    omitted: a part-route ticket costs the full fare times distance_share().
+    Cached per (trip, journey, fare factor, base price), so a factor change
+    simply starts a new table; a miss costs one query for the seat
+    multipliers, plus one for the segment distance.
+    """
+    pickup_id, dropoff_id = journey[:2] if journey else (None, None)
+    # Stop changes rebuild segments and bump the search generation, which can change the share
+    version, generation = current_versions(PRICING_VERSION_KEY, SEARCH_GENERATION_KEY)
+    key = (f"fare_table_{trip.id}_{pickup_id}_{dropoff_id}_{trip.fare_factor}_{trip.base_price}"
+           f"_v{version}_{generation}")
+    table = cache.get(key)
+    if table is None:
+        fare = trip.base_price * trip.fare_factor * distance_share(trip.route, pickup_id, dropoff_id)
+        table = {
+            seat_id: (fare * multiplier).quantize(CENT, ROUND_HALF_UP)
+            for seat_id, multiplier in Seat.objects.filter(bus_id=trip.bus_id).values_list('id', 'price_multiplier')
+        }
+        cache.set(key, table, FARE_TABLE_CACHE_TIMEOUT)
+    return table
+
+
+def held_prices(trip, seat_ids, hold_token=None, journey=None):
+    """
+    Prices for seats about to be booked: the fare quoted when the caller's
+    hold was placed where there is one, the current fare for the journey
+    otherwise.
+    """
+    prices = {}
+    if hold_token:
+        prices = {
+            seat_id: price
+            for seat_id, price in TripSeatAvailability.objects.filter(
+                trip=trip, seat_id__in=seat_ids, hold_token=hold_token
+            ).values_list('seat_id', 'quoted_price')
+            if price is not None
+        }
+    if len(prices) < len(seat_ids):
+        table = fare_table(trip, journey)
+        for seat_id in seat_ids:
+            if seat_id not in prices and seat_id in table:
+                prices[seat_id] = table[seat_id]
+    return prices
@@ -0,0 +1,390 @@
+# receipts.py - PDF receipts, rendered once per version and kept on disk
+
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, HttpResponse
+from django.template.loader import get_template
+from . import pdf_worker
+from .jobs import enqueue
+from .models import Booking
+
+# Rendered receipts live under RECEIPT_STORE_DIR/<booking_id>/<version>.pdf
+RECEIPT_STORE_DIR = str(getattr(settings, 'RECEIPT_STORE_DIR', os.path.join(settings.MEDIA_ROOT, 'receipts')))
+
+# Let the web server send the file: '' (Django streams it), 'x-sendfile'
+# (Apache, lighttpd) or 'x-accel-redirect' (nginx, with an internal location
+# mapping RECEIPT_ACCEL_PREFIX to RECEIPT_STORE_DIR)
+RECEIPT_SENDFILE = getattr(settings, 'RECEIPT_SENDFILE', '')
+RECEIPT_ACCEL_PREFIX = getattr(settings, 'RECEIPT_ACCEL_PREFIX', '/internal/receipts/')
+
+# Layout runs in this many pre-warmed worker processes; 0 renders in the
+# calling thread instead (fonts and stylesheet are still loaded only once)
+RECEIPT_RENDER_WORKERS = getattr(settings, 'RECEIPT_RENDER_WORKERS', 2)
+# Renders allowed to wait for a free worker before callers get RenderBusy
+RECEIPT_RENDER_QUEUE = getattr(settings, 'RECEIPT_RENDER_QUEUE', 16)
+# Seconds a caller waits for a render; after that the pool is replaced for new renders
+RECEIPT_RENDER_TIMEOUT = getattr(settings, 'RECEIPT_RENDER_TIMEOUT', 30)
+
+# A download finding no stored receipt queues one render job per version in this window
+RECEIPT_QUEUED_TIMEOUT = getattr(settings, 'RECEIPT_QUEUED_TIMEOUT', 5 * 60)
+
+# Base URL for receipts rendered outside a request, e.g. by the outbox sender
+SITE_URL = getattr(settings, 'SITE_URL', 'http://localhost:8000/')
+
+COMPANY_INFO = {
+    'name': 'DreamLine Bus Service',
+    'address': 'P.O. Box 12345, Nairobi, Kenya',
+    'phone': '+254 700 123456',
+    'email': 'info@dreamlinebus.com',
+    'website': 'www.dreamlinebus.com'
+}
+
+# CSS for small horizontal receipt styling
+RECEIPT_CSS = """
+    @page {
+        size: 8.5in 4in;
+        margin: 0.2in;
+    }
+    body {
+        font-family: 'Courier New', monospace;
+        font-size: 8px;
+        line-height: 1.2;
+        margin: 0;
+        padding: 0;
+    }
+    .receipt-container {
+        border: 2px dashed #333;
+        padding: 8px;
+        height: calc(4in - 0.4in - 16px);
+        display: flex;
+        flex-direction: column;
+    }
+    .receipt-header {
+        text-align: center;
+        margin-bottom: 8px;
+        border-bottom: 1px solid #333;
+        padding-bottom: 4px;
+    }
+    .company-name {
+        font-size: 12px;
+        font-weight: bold;
+        margin-bottom: 2px;
+    }
+    .receipt-title {
+        font-size: 10px;
+        font-weight: bold;
+        margin-bottom: 2px;
+    }
+    .booking-id {
+        font-size: 9px;
+        font-weight: bold;
+        background: #000;
+        color: white;
+        padding: 2px 4px;
+        display: inline-block;
+        margin: 2px 0;
+    }
+    .receipt-body {
+        display: flex;
+        gap: 8px;
+        flex: 1;
+        font-size: 7px;
+    }
+    .column {
+        flex: 1;
+    }
+    .info-line {
+        margin-bottom: 2px;
+        display: flex;
+        justify-content: space-between;
+    }
+    .label {
+        font-weight: bold;
+        width: 45%;
+        text-transform: uppercase;
+    }
+    .value {
+        width: 55%;
+        text-align: right;
+    }
+    .section-divider {
+        border-bottom: 1px dashed #999;
+        margin: 4px 0;
+    }
+    .seats {
+        text-align: center;
+        font-weight: bold;
+        background: #f0f0f0;
+        padding: 2px;
+        margin: 2px 0;
+    }
+    .total-line {
+        font-size: 10px;
+        font-weight: bold;
+        text-align: center;
+        background: #000;
+        color: white;
+        padding: 4px;
+        margin: 4px 0;
+    }
+    .footer {
+        text-align: center;
+        font-size: 6px;
+        margin-top: 4px;
+        border-top: 1px solid #333;
+        padding-top: 4px;
+    }
+    .status {
+        display: inline-block;
+        padding: 1px 4px;
+        background: #28a745;
+        color: white;
+        font-size: 6px;
+        border-radius: 2px;
+    }
+    .barcode {
+        text-align: center;
+        font-family: 'Courier New', monospace;
+        font-size: 6px;
+        letter-spacing: 2px;
+        margin: 2px 0;
+    }
+"""
+
+
+class RenderBusy(Exception):
+    """Every render worker is busy and the queue is full; try again shortly"""
+
+
+class RenderFailed(Exception):
+    """A render timed out or its worker process died"""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(max(RECEIPT_RENDER_WORKERS, 1) + RECEIPT_RENDER_QUEUE)
+
+
+def render_pool():
+    """The process's render pool, created on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: forking a threaded web worker can copy held locks
+            _pool = ProcessPoolExecutor(
+                max_workers=RECEIPT_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=pdf_worker.warm,
+                initargs=(RECEIPT_CSS,),
+            )
+        return _pool
+
+
+def start_render_pool():
+    """Start and warm every render worker now rather than on the first receipt"""
+    if RECEIPT_RENDER_WORKERS:
+        pool = render_pool()
+        for future in [pool.submit(pdf_worker.ping) for _ in range(RECEIPT_RENDER_WORKERS)]:
+            future.result()
+
+
+def _retire_pool(pool, cancel=False):
+    """
+    Stop sending renders to a pool; the next render starts a fresh one.
+
+    Renders already running on it are left to finish and reach their
+    callers. With cancel, renders still queued on it are dropped, for a
+    pool whose workers died.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=cancel)
+
+
+def receipt_html(booking):
+    return get_template('booking_pdf.html').render({'booking': booking, 'company_info': COMPANY_INFO})
+
+
+def submit_receipt(booking, base_url=SITE_URL):
+    """
+    Start rendering a booking's receipt and return a Future of the PDF bytes.
+
+    The template is rendered here, where the ORM is available; only the
+    HTML goes to a worker. Raises RenderBusy instead of queueing without
+    bound when RECEIPT_RENDER_QUEUE renders are already waiting.
+    """
+    html_string = receipt_html(booking)
+    if not _slots.acquire(blocking=False):
+        raise RenderBusy('All receipt render workers are busy')
+
+    if not RECEIPT_RENDER_WORKERS:
+        future = Future()
+        try:
+            pdf_worker.warm(RECEIPT_CSS)
+            future.set_result(pdf_worker.render(html_string, base_url))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            _slots.release()
+        return future
+
+    pool = render_pool()
+    try:
+        future = pool.submit(pdf_worker.render, html_string, base_url)
+    except (BrokenProcessPool, RuntimeError) as e:
+        _slots.release()
+        _retire_pool(pool, cancel=True)
+        raise RenderFailed(f'Receipt render pool unavailable: {e}') from e
+    future.pool = pool
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def receipt_result(future, timeout=RECEIPT_RENDER_TIMEOUT):
+    """
+    PDF bytes of a submitted render; raises RenderFailed if it timed out or its worker died.
+
+    Only this caller gives up on a timeout. The render keeps its worker and
+    its queue slot until it ends, but new renders go to a fresh pool in case
+    that worker is stuck.
+    """
+    try:
+        return future.result(timeout)
+    except FutureTimeout as e:
+        _retire_pool(future.pool)
+        raise RenderFailed(f'Receipt render took longer than {timeout}s') from e
+    except BrokenProcessPool as e:
+        _retire_pool(future.pool, cancel=True)
+        raise RenderFailed('Receipt render worker died') from e
+
+
+def render_receipt(booking, base_url=SITE_URL):
+    """Render a booking's receipt on the pool and wait for the PDF bytes"""
+    return receipt_result(submit_receipt(booking, base_url))
+
+
+@lru_cache(maxsize=None)
+def layout_version():
+    """Digest of the receipt template and CSS; a deploy changing either re-renders receipts"""
+    source = get_template('booking_pdf.html').template.source
+    return hashlib.sha256((source + RECEIPT_CSS).encode()).hexdigest()
+
+
+def receipt_version(booking):
+    """Digest of everything printed on the receipt; it changes only when the receipt would"""
+    trip = booking.trip
+    fields = [
+        layout_version(), booking.booking_id, booking.get_status_display(), booking.created_at.isoformat(),
+        booking.passenger_name, booking.passenger_phone, booking.passenger_id_number,
+        booking.pickup_location.name, booking.dropoff_location.name, str(booking.total_amount),
+        booking.mpesa_transaction_id, str(trip.route), trip.bus.company.name, trip.bus.number_plate,
+        trip.departure_time.isoformat(),
+    ] + [booking_seat.seat.seat_number for booking_seat in booking.booked_seats.all()]
+    return hashlib.sha256('\x1f'.join(fields).encode()).hexdigest()[:32]
+
+
+def stored_receipt(booking, base_url=SITE_URL):
+    """
+    Path and version of the booking's current receipt, rendering it first if
+    this version is not in the store yet.
+
+    Files are written to a temporary name and renamed into place, so a
+    reader never sees half a PDF, and two processes rendering the same
+    version at once just write identical files. Older versions of the
+    booking's receipt are removed.
+    """
+    directory, path, version = _receipt_target(booking)
+    if not os.path.exists(path):
+        _write_receipt(directory, path, version, render_receipt(booking, base_url))
+    return path, version
+
+
+def current_receipt(booking):
+    """Path and version of the booking's current receipt; the path is None until it is in the store"""
+    directory, path, version = _receipt_target(booking)
+    return (path if os.path.exists(path) else None), version
+
+
+def queue_receipt(booking, version):
+    """Have a run_jobs worker put a receipt version in the store, once per RECEIPT_QUEUED_TIMEOUT"""
+    if cache.add(f"receipt_queued_{booking.booking_id}_{version}", True, RECEIPT_QUEUED_TIMEOUT):
+        enqueue('booking_app.receipts.render_receipt_job', booking_id=booking.id)
+
+
+def render_receipt_job(booking_id):
+    booking = Booking.objects.select_related(
+        'trip__route__origin', 'trip__route__destination', 'trip__bus__company',
+        'pickup_location', 'dropoff_location'
+    ).prefetch_related('booked_seats__seat').get(id=booking_id)
+    stored_receipt(booking)
+
+
+def store_receipts(bookings, base_url=SITE_URL):
+    """
+    Render the missing receipts of several bookings side by side on the pool.
+
+    Best effort: receipts that could not be queued or rendered are left to
+    stored_receipt() to try again one at a time.
+    """
+    pending = []
+    for booking in bookings:
+        directory, path, version = _receipt_target(booking)
+        if os.path.exists(path):
+            continue
+        try:
+            pending.append((directory, path, version, submit_receipt(booking, base_url)))
+        except (RenderBusy, RenderFailed):
+            break
+    for directory, path, version, future in pending:
+        try:
+            _write_receipt(directory, path, version, receipt_result(future))
+        except Exception:
+            continue
+
+
+def _receipt_target(booking):
+    version = receipt_version(booking)
+    directory = os.path.join(RECEIPT_STORE_DIR, booking.booking_id)
+    return directory, os.path.join(directory, f'{version}.pdf'), version
+
+
+def _write_receipt(directory, path, version, pdf):
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    for name in os.listdir(directory):
+        if name.endswith('.pdf') and name != f'{version}.pdf':
+            try:
+                os.unlink(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+
+def receipt_response(path, filename):
+    """Download response for a stored receipt, handed to the web server if RECEIPT_SENDFILE says so"""
+    if RECEIPT_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type='application/pdf')
+        response['X-Accel-Redirect'] = RECEIPT_ACCEL_PREFIX + os.path.relpath(path, RECEIPT_STORE_DIR).replace(os.sep, '/')
+    elif RECEIPT_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type='application/pdf')
+        response['X-Sendfile'] = path
+    else:
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=filename, content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
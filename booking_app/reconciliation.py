@@ -0,0 +1,207 @@
+# reconciliation.py - Match M-Pesa statement exports against bookings
+
+import csv
+import math
+import os
+import tempfile
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.db import connections
+from django.utils import timezone
+from .models import Booking, Payment
+
+# Column names used by the M-Pesa org portal statement export and the C2B/API exports
+RECEIPT_COLUMNS = ('Receipt No.', 'Receipt No', 'ReceiptNo', 'TransID', 'Transaction ID')
+AMOUNT_COLUMNS = ('Paid In', 'PaidIn', 'TransAmount', 'Amount')
+TIME_COLUMNS = ('Completion Time', 'CompletionTime', 'TransTime', 'Transaction Time')
+STATUS_COLUMNS = ('Transaction Status', 'Status')
+
+STATEMENT_TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%Y%m%d%H%M%S')
+
+ORPHAN_FIELDS = ['receipt', 'completion_time', 'amount', 'payment_booking_id', 'note']
+MISMATCH_FIELDS = ['receipt', 'completion_time', 'statement_amount', 'booking_id', 'booking_amount', 'booking_status']
+UNPAID_FIELDS = ['booking_id', 'mpesa_transaction_id', 'total_amount', 'paid_at', 'reason']
+
+
+def _column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def parse_amount(value):
+    try:
+        return Decimal(str(value).replace(',', '').strip() or '0')
+    except InvalidOperation:
+        return None
+
+
+def parse_statement_time(value):
+    value = str(value).strip()
+    for fmt in STATEMENT_TIME_FORMATS:
+        try:
+            return timezone.make_aware(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    return None
+
+
+def statement_rows(path):
+    """
+    Yield (receipt, completion_time, amount) for each completed payment
+    received in a statement CSV, one line at a time.
+
+    Portal exports start with a few lines of account details, so everything
+    before the row naming the receipt column is skipped.
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        for header in reader:
+            header = [cell.strip() for cell in header]
+            receipt_col = _column(header, RECEIPT_COLUMNS)
+            if receipt_col is not None:
+                break
+        else:
+            raise ValueError(f"{path}: no receipt column found")
+
+        amount_col = _column(header, AMOUNT_COLUMNS)
+        if amount_col is None:
+            raise ValueError(f"{path}: no paid-in amount column found")
+        time_col = _column(header, TIME_COLUMNS)
+        status_col = _column(header, STATUS_COLUMNS)
+
+        for row in reader:
+            if len(row) <= max(receipt_col, amount_col):
+                continue
+            if status_col is not None and len(row) > status_col and row[status_col].strip().lower() not in ('', 'completed'):
+                continue
+            amount = parse_amount(row[amount_col])
+            # Withdrawals and charges have nothing in the paid-in column
+            if not amount:
+                continue
+            completed = row[time_col].strip() if time_col is not None and len(row) > time_col else ''
+            yield row[receipt_col].strip().upper(), completed, amount
+
+
+def amount_matches(paid, total_amount):
+    # STK pushes are for whole shillings, rounded up
+    return paid in (total_amount, Decimal(math.ceil(total_amount)))
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _report_file(out_dir):
+    # Merged into the final reports by merge_reports()
+    return tempfile.NamedTemporaryFile('w', newline='', dir=out_dir, prefix='.part-', suffix='.csv', delete=False)
+
+
+def reconcile_statement(path, out_dir, max_booking_pk, chunk_size=1000):
+    """
+    Match one statement file against bookings, streaming it in chunks.
+
+    Each chunk costs one indexed IN lookup on Booking.mpesa_transaction_id,
+    plus one on Payment.mpesa_receipt for receipts no booking claims. Orphan
+    payments and amount mismatches are written to CSVs in out_dir as they
+    are found. Matched bookings are returned as a bitmap indexed by primary
+    key, so memory stays flat however long the statement is.
+    """
+    matched = bytearray(max_booking_pk // 8 + 1)
+    stats = {'path': path, 'payments': 0, 'matched': 0, 'orphans': 0, 'mismatches': 0, 'first': None, 'last': None}
+
+    try:
+        with _report_file(out_dir) as orphan_file, _report_file(out_dir) as mismatch_file:
+            orphans = csv.writer(orphan_file)
+            mismatches = csv.writer(mismatch_file)
+            orphans.writerow(ORPHAN_FIELDS)
+            mismatches.writerow(MISMATCH_FIELDS)
+
+            for chunk in _chunks(statement_rows(path), chunk_size):
+                stats['payments'] += len(chunk)
+                bookings = {
+                    receipt: (pk, booking_id, total_amount, status)
+                    for pk, receipt, booking_id, total_amount, status in Booking.objects.filter(
+                        mpesa_transaction_id__in={receipt for receipt, _, _ in chunk}
+                    ).values_list('id', 'mpesa_transaction_id', 'booking_id', 'total_amount', 'status')
+                }
+                unclaimed = {receipt for receipt, _, _ in chunk if receipt not in bookings}
+                payments = {
+                    receipt: (booking_id, status, refund_due)
+                    for receipt, booking_id, status, refund_due in Payment.objects.filter(
+                        mpesa_receipt__in=unclaimed
+                    ).values_list('mpesa_receipt', 'booking__booking_id', 'booking__status', 'refund_due')
+                } if unclaimed else {}
+
+                for receipt, completed, amount in chunk:
+                    completed_at = parse_statement_time(completed) if completed else None
+                    if completed_at is not None:
+                        stats['first'] = min(stats['first'] or completed_at, completed_at)
+                        stats['last'] = max(stats['last'] or completed_at, completed_at)
+
+                    booking = bookings.get(receipt)
+                    if booking is None:
+                        stats['orphans'] += 1
+                        payment = payments.get(receipt)
+                        if payment is None:
+                            orphans.writerow([receipt, completed, amount, '', 'no booking or payment with this receipt'])
+                        else:
+                            note = 'refund due' if payment[2] else f'booking is {payment[1]}'
+                            orphans.writerow([receipt, completed, amount, payment[0], note])
+                        continue
+
+                    pk, booking_id, total_amount, status = booking
+                    stats['matched'] += 1
+                    if pk <= max_booking_pk:
+                        matched[pk >> 3] |= 1 << (pk & 7)
+                    if not amount_matches(amount, total_amount):
+                        stats['mismatches'] += 1
+                        mismatches.writerow([receipt, completed, amount, booking_id, total_amount, status])
+    finally:
+        connections.close_all()
+
+    stats['bitmap'] = bytes(matched)
+    stats['reports'] = (orphan_file.name, mismatch_file.name)
+    return stats
+
+
+def write_unpaid_confirmations(path, matched, since, until, batch_size=2000):
+    """
+    Write confirmed bookings paid between since and until whose receipt no
+    statement line matched. Returns the number written.
+    """
+    count = 0
+    bookings = Booking.objects.filter(status='CONFIRMED', paid_at__range=(since, until)).values_list(
+        'id', 'booking_id', 'mpesa_transaction_id', 'total_amount', 'paid_at'
+    ).order_by()
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(UNPAID_FIELDS)
+        for pk, booking_id, receipt, total_amount, paid_at in bookings.iterator(chunk_size=batch_size):
+            if pk >> 3 < len(matched) and matched[pk >> 3] & (1 << (pk & 7)):
+                continue
+            reason = 'receipt not on statement' if receipt else 'confirmed without a receipt'
+            writer.writerow([booking_id, receipt, total_amount, paid_at.isoformat(), reason])
+            count += 1
+    return count
+
+
+def merge_reports(paths, destination):
+    """Concatenate per-file CSV reports that share a header into one file"""
+    with open(destination, 'w', newline='') as out:
+        for index, path in enumerate(paths):
+            with open(path, newline='') as f:
+                header = f.readline()
+                if index == 0:
+                    out.write(header)
+                for line in f:
+                    out.write(line)
+            os.remove(path)
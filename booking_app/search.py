@@ -0,0 +1,327 @@
+# search.py - Trip search backed by the precomputed route segment index
+
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    BigIntegerField, Count, DecimalField, ExpressionWrapper, F, FilteredRelation, FloatField, Min, Q, Value
+)
+from django.db.models.functions import Cast, Coalesce, NullIf
+from .models import ALL_LEGS, Route, RouteStop, RouteSegment, Seat, Trip, legs_free_q, reservable_q
+
+# How long a cached result set may live; versioning makes most entries die sooner
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)
+
+# Fare calendars are cheap to rebuild and only need to be roughly current
+FARE_CALENDAR_CACHE_TIMEOUT = getattr(settings, 'FARE_CALENDAR_CACHE_TIMEOUT', 60)
+
+# Bumped whenever any route's stops change, retiring every cached search at once
+SEARCH_GENERATION_KEY = 'trip_search_generation'
+
+
+def route_segment_rows(route, stops):
+    """
+    Build one row per (boarding, alighting) pair along a route.
+
+    `stops` are the route's intermediate RouteStops in stop order. Time
+    offsets are interpolated from the route's estimated duration by distance,
+    since stops only record their distance from the origin.
+    """
+    points = [(route.origin_id, 0)]
+    points += [(stop.location_id, stop.distance_from_origin) for stop in stops]
+    points.append((route.destination_id, route.distance))
+
+    def offset(distance):
+        if not route.distance:
+            return timedelta()
+        return route.estimated_duration * (distance / route.distance)
+
+    rows = []
+    for i, (origin_id, origin_distance) in enumerate(points):
+        for j in range(i + 1, len(points)):
+            destination_id, destination_distance = points[j]
+            if origin_id == destination_id:
+                continue
+            rows.append({
+                'route_id': route.id,
+                'origin_id': origin_id,
+                'destination_id': destination_id,
+                'origin_index': i,
+                'destination_index': j,
+                'distance': max(destination_distance - origin_distance, 0),
+                'departure_offset': offset(origin_distance),
+                'arrival_offset': offset(destination_distance),
+            })
+    return rows
+
+
+def rebuild_route_segments(route_id):
+    """Replace the segment index rows for a single route"""
+    route = Route.objects.filter(id=route_id).first()
+    with transaction.atomic():
+        RouteSegment.objects.filter(route_id=route_id).delete()
+        if route is None:
+            bump_version(SEARCH_GENERATION_KEY)
+            return 0
+        stops = RouteStop.objects.filter(route=route).order_by('stop_order')
+        segments = RouteSegment.objects.bulk_create([
+            RouteSegment(**row) for row in route_segment_rows(route, stops)
+        ])
+    # Which pairs a route serves has changed; cheaper to retire all searches
+    bump_version(SEARCH_GENERATION_KEY)
+    return len(segments)
+
+
+def schedule_segment_rebuild(route_id):
+    """Rebuild a route's segments once the current transaction commits"""
+    transaction.on_commit(lambda: rebuild_route_segments(route_id))
+
+
+def reservable_seat_q(now=None, legs=ALL_LEGS):
+    """Trip-level filter selecting active seats reservable on `legs` through the availability join"""
+    return reservable_q('tripseatavailability__', now) & legs_free_q(legs, 'tripseatavailability__') & Q(
+        tripseatavailability__seat__is_active=True
+    )
+
+
+def segment_legs_expression():
+    """Leg mask of the joined search segment (see inventory.leg_mask), computed in SQL"""
+    one = Value(1, output_field=BigIntegerField())
+    return one.bitleftshift(F('segment__destination_index')) - one.bitleftshift(F('segment__origin_index'))
+
+
+def seat_fare_expression():
+    """
+    Seat price as charged by reserve_seats: base price times fare factor
+    times the seat multiplier, scaled by the share of the route's distance
+    the joined search segment covers (pricing.distance_share()).
+    """
+    share = Coalesce(
+        Cast('segment__distance', FloatField()) / NullIf(F('route__distance'), Value(0)),
+        Value(1.0),
+    )
+    return ExpressionWrapper(
+        F('base_price') * F('fare_factor') * F('tripseatavailability__seat__price_multiplier')
+        * Cast(share, DecimalField(max_digits=12, decimal_places=6)),
+        output_field=DecimalField(max_digits=14, decimal_places=4),
+    )
+
+
+def seat_summary_annotations(now=None, legs=ALL_LEGS):
+    """
+    Aggregates over a trip's reservable seats, for use with Trip.annotate().
+
+    Gives seats_left and lowest_fare overall plus seats_<class> and
+    fare_<class> for every seat class, all computed by conditional
+    aggregates in the same query. Seats count when free on `legs`, the
+    whole trip by default.
+    """
+    reservable = reservable_seat_q(now, legs)
+    fare = seat_fare_expression()
+    annotations = {
+        'seats_left': Count('tripseatavailability', filter=reservable),
+        'lowest_fare': Min(fare, filter=reservable),
+    }
+    for seat_class, _ in Seat.SEAT_CLASS_CHOICES:
+        in_class = reservable & Q(tripseatavailability__seat__seat_class=seat_class)
+        annotations[f'seats_{seat_class.lower()}'] = Count('tripseatavailability', filter=in_class)
+        annotations[f'fare_{seat_class.lower()}'] = Min(fare, filter=in_class)
+    return annotations
+
+
+def segment_trips(origin, destination):
+    """Trips whose route serves origin -> destination, as a whole route or a segment"""
+    return Trip.objects.annotate(
+        segment=FilteredRelation(
+            'route__segments',
+            condition=Q(
+                route__segments__origin=origin,
+                route__segments__destination=destination,
+            ),
+        ),
+    ).filter(segment__isnull=False)
+
+
+def trip_search_queryset(origin, destination, travel_date):
+    """
+    Scheduled trips serving origin -> destination on travel_date.
+
+    Matches whole routes as well as any stop-to-stop segment in a single
+    query against the segment index, filtering on the stored departure_date
+    so the trip_search_idx index applies. Each trip is annotated as
+    annotate_search_results() describes.
+    """
+    return annotate_search_results(segment_trips(origin, destination).filter(
+        departure_date=travel_date,
+        status='SCHEDULED',
+    ))
+
+
+def annotate_search_results(trips):
+    """
+    Add the boarding/alighting offsets, segment distance and the seat
+    summary from seat_summary_annotations(), counting seats free on the
+    segment's legs, to a segment_trips() queryset.
+    """
+    return trips.annotate(
+        segment_departure_offset=F('segment__departure_offset'),
+        segment_arrival_offset=F('segment__arrival_offset'),
+        segment_distance=F('segment__distance'),
+        **seat_summary_annotations(legs=segment_legs_expression()),
+    ).select_related(
+        'bus', 'bus__company', 'route', 'route__origin', 'route__destination'
+    ).order_by('departure_time')
+
+
+def seat_classes_for(trip):
+    """Per-class seats left and lowest fare from a trip's seat summary annotations"""
+    classes = []
+    for seat_class, label in Seat.SEAT_CLASS_CHOICES:
+        seats_left = getattr(trip, f'seats_{seat_class.lower()}')
+        if seats_left:
+            classes.append({
+                'code': seat_class,
+                'label': label,
+                'seats_left': seats_left,
+                'lowest_fare': getattr(trip, f'fare_{seat_class.lower()}'),
+            })
+    return classes
+
+
+def find_trips(origin, destination, travel_date):
+    """Evaluate the trip search, adding display times and per-class seat summaries"""
+    results = list(trip_search_queryset(origin, destination, travel_date))
+    for trip in results:
+        trip.boarding_time = trip.departure_time + trip.segment_departure_offset
+        trip.alighting_time = trip.departure_time + trip.segment_arrival_offset
+        trip.seat_classes = seat_classes_for(trip)
+    return results
+
+
+def fare_calendar(origin_id, destination_id, center_date, days):
+    """
+    Trip count, seats left and lowest fare for each day in center_date +/- days.
+
+    All days come from one grouped query over the search index; days with no
+    trips are filled in with zeros. Cached for FARE_CALENDAR_CACHE_TIMEOUT.
+    """
+    start = center_date - timedelta(days=days)
+    end = center_date + timedelta(days=days)
+    key = f"fare_calendar_{origin_id}_{destination_id}_{start.isoformat()}_{end.isoformat()}"
+    calendar = cache.get(key)
+    if calendar is not None:
+        return calendar
+
+    reservable = reservable_seat_q(legs=segment_legs_expression())
+    rows = segment_trips(origin_id, destination_id).filter(
+        departure_date__range=(start, end),
+        status='SCHEDULED',
+    ).values('departure_date').annotate(
+        trips=Count('id', distinct=True),
+        seats_left=Count('tripseatavailability', filter=reservable),
+        lowest_fare=Min(seat_fare_expression(), filter=reservable),
+    ).order_by('departure_date')
+    by_date = {row['departure_date']: row for row in rows}
+
+    calendar = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        row = by_date.get(day, {})
+        lowest_fare = row.get('lowest_fare')
+        calendar.append({
+            'date': day.isoformat(),
+            'trips': row.get('trips', 0),
+            'seats_left': row.get('seats_left', 0),
+            'lowest_fare': float(round(lowest_fare, 2)) if lowest_fare is not None else None,
+        })
+    cache.set(key, calendar, FARE_CALENDAR_CACHE_TIMEOUT)
+    return calendar
+
+
+def _search_version_key(origin_id, destination_id, travel_date):
+    return f"trip_search_version_{origin_id}_{destination_id}_{travel_date.isoformat()}"
+
+
+def _new_version():
+    # Seeded from the clock so a version key that was evicted can never
+    # restart at a number an older cached result was stored under
+    return time.time_ns() // 1000
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Nothing has been cached under this key yet
+        cache.add(key, _new_version(), timeout=None)
+
+
+def current_versions(*keys):
+    """Fetch version counters in one round trip, initialising missing ones"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = _new_version()
+            if not cache.add(key, version, timeout=None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return [versions[key] for key in keys]
+
+
+def cached_find_trips(origin, destination, travel_date):
+    """
+    find_trips() behind a versioned cache entry per (origin, destination, date).
+
+    Writes never delete entries; they bump the version counter so the next
+    search misses and the stale entry ages out on its own. Works with any
+    Django cache backend.
+    """
+    version, generation = current_versions(
+        _search_version_key(origin.id, destination.id, travel_date),
+        SEARCH_GENERATION_KEY,
+    )
+    key = f"trip_search_{origin.id}_{destination.id}_{travel_date.isoformat()}_v{version}_g{generation}"
+    results = cache.get(key)
+    if results is None:
+        results = find_trips(origin, destination, travel_date)
+        cache.set(key, results, SEARCH_CACHE_TIMEOUT)
+    return results
+
+
+def invalidate_trip_search(trip_keys):
+    """
+    Bump the search versions covering some trips once the transaction commits.
+
+    `trip_keys` is an iterable of (route_id, departure_date) pairs; every
+    origin/destination pair the route serves on that date is invalidated.
+    """
+    trip_keys = set(trip_keys)
+    if not trip_keys:
+        return
+
+    def bump():
+        pairs_by_route = {}
+        segments = RouteSegment.objects.filter(
+            route_id__in={route_id for route_id, _ in trip_keys}
+        ).values_list('route_id', 'origin_id', 'destination_id')
+        for route_id, origin_id, destination_id in segments:
+            pairs_by_route.setdefault(route_id, []).append((origin_id, destination_id))
+        for route_id, travel_date in trip_keys:
+            for origin_id, destination_id in pairs_by_route.get(route_id, []):
+                bump_version(_search_version_key(origin_id, destination_id, travel_date))
+
+    transaction.on_commit(bump)
+
+
+def invalidate_trip_search_for(trips):
+    """invalidate_trip_search() for Trip instances"""
+    invalidate_trip_search((trip.route_id, trip.departure_date) for trip in trips)
+
+
+def invalidate_trip_search_for_bookings(booking_ids):
+    """invalidate_trip_search() for the trips of the given Booking primary keys"""
+    invalidate_trip_search(
+        Trip.objects.filter(booking__id__in=booking_ids).values_list('route_id', 'departure_date').distinct()
+    )
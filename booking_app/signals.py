@@ -0,0 +1,140 @@
+# signals.py - Keep derived search data in sync with the models it is built from
+
+from django.db.models.signals import pre_save, pre_delete, post_save, post_delete
+from django.dispatch import receiver
+from django.db import transaction
+from django.utils import timezone
+from .models import (
+    Bus, Location, PriceCurve, Route, RouteStop, Seat, SeatLayout, Trip, TripSeatAvailability, check_stops_editable
+)
+from .search import schedule_segment_rebuild, invalidate_trip_search, invalidate_trip_search_for
+from .connections import invalidate_connection_graphs
+from .locations import invalidate_location_index
+from .inventory import invalidate_seat_maps, materialize_trip_seats
+from .allocation import invalidate_seat_grids
+from .pricing import invalidate_pricing
+
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def route_changed(sender, instance, **kwargs):
+    """Origin, destination, distance or duration may have changed"""
+    schedule_segment_rebuild(instance.id)
+    # Route counts drive autocomplete ranking
+    transaction.on_commit(invalidate_location_index)
+
+
+@receiver(pre_save, sender=RouteStop)
+def route_stop_saving(sender, instance, raw=False, **kwargs):
+    """Part-route bookings are numbered by the stops; refuse to renumber legs under them"""
+    if raw:
+        return
+    for route_id in instance.renumbered_routes():
+        check_stops_editable(route_id)
+
+
+@receiver(pre_delete, sender=RouteStop)
+def route_stop_deleting(sender, instance, **kwargs):
+    check_stops_editable(instance.route_id)
+
+
+@receiver(post_save, sender=RouteStop)
+@receiver(post_delete, sender=RouteStop)
+def route_stop_changed(sender, instance, **kwargs):
+    """Adding, moving or removing a stop changes the route's segments and leg count"""
+    schedule_segment_rebuild(instance.route_id)
+    transaction.on_commit(invalidate_location_index)
+    invalidate_seat_maps(Trip.objects.filter(
+        route_id=instance.route_id, departure_time__gte=timezone.now()
+    ).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Location)
+@receiver(post_delete, sender=Location)
+def location_changed(sender, instance, **kwargs):
+    """New or renamed locations must show up in autocomplete without a restart"""
+    transaction.on_commit(invalidate_location_index)
+
+
+@receiver(pre_save, sender=Trip)
+def trip_saving(sender, instance, **kwargs):
+    """Remember where the trip was listed so a moved trip leaves its old search"""
+    instance._previous_search_key = None
+    instance._previous_bus_id = None
+    if instance.pk:
+        previous = Trip.objects.filter(
+            pk=instance.pk
+        ).values_list('route_id', 'departure_date', 'bus_id').first()
+        if previous:
+            instance._previous_search_key = previous[:2]
+            instance._previous_bus_id = previous[2]
+
+
+@receiver(post_save, sender=Trip)
+@receiver(post_delete, sender=Trip)
+def trip_changed(sender, instance, **kwargs):
+    """New, edited, re-timed, cancelled or deleted trips change search results"""
+    keys = [(instance.route_id, instance.departure_date)]
+    previous = getattr(instance, '_previous_search_key', None)
+    if previous:
+        keys.append(previous)
+    invalidate_trip_search(keys)
+    invalidate_connection_graphs(travel_date for _, travel_date in keys)
+
+
+@receiver(post_save, sender=Trip)
+def trip_saved(sender, instance, created, raw=False, **kwargs):
+    """Put every seat of a new (or re-assigned) bus on sale in the same transaction"""
+    if raw:
+        return
+    if created or getattr(instance, '_previous_bus_id', None) != instance.bus_id:
+        materialize_trip_seats([instance])
+
+
+@receiver(post_save, sender=Seat)
+def seat_saved(sender, instance, created, raw=False, **kwargs):
+    """A seat added to a bus goes on sale on the bus's upcoming trips"""
+    if raw:
+        return
+    trips = list(Trip.objects.filter(
+        bus_id=instance.bus_id, status='SCHEDULED', departure_time__gte=timezone.now()
+    ))
+    if not created:
+        # is_active may have changed, which the seat maps record as sold
+        invalidate_seat_maps(trip.id for trip in trips)
+    elif materialize_trip_seats(trips):
+        invalidate_trip_search_for(trips)
+
+
+@receiver(post_save, sender=TripSeatAvailability)
+@receiver(post_delete, sender=TripSeatAvailability)
+def seat_availability_changed(sender, instance, **kwargs):
+    """Edits outside the reservation flow (admin, shell) must reach the seat map"""
+    invalidate_seat_maps([instance.trip_id])
+
+
+@receiver(post_save, sender=Seat)
+@receiver(post_delete, sender=Seat)
+def seat_changed(sender, instance, **kwargs):
+    """Seat positions, classes and types feed the group allocator's grid; multipliers feed fare tables"""
+    invalidate_seat_grids([instance.bus_id])
+    invalidate_pricing()
+
+
+@receiver(post_save, sender=Bus)
+def bus_changed(sender, instance, **kwargs):
+    """The bus may now use a different seat layout"""
+    invalidate_seat_grids([instance.id])
+
+
+@receiver(post_save, sender=SeatLayout)
+def seat_layout_changed(sender, instance, **kwargs):
+    """Aisle positions come from the layout"""
+    invalidate_seat_grids(Bus.objects.filter(seat_layout=instance).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=PriceCurve)
+@receiver(post_delete, sender=PriceCurve)
+def price_curve_changed(sender, instance, **kwargs):
+    """Curves are cached per process and baked into fare tables"""
+    invalidate_pricing()
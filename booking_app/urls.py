@@ -17,8 +17,13 @@ urlpatterns = [
     
     # AJAX endpoints
     path('api/location-autocomplete/', views.location_autocomplete, name='location_autocomplete'),
+    path('api/fare-calendar/', views.fare_calendar_api, name='fare_calendar'),
+    path('api/connections/', views.connections_api, name='connections'),
     path('api/reserve-seats/', views.reserve_seats, name='reserve_seats'),
+    path('api/quick-book/', views.quick_book, name='quick_book'),
     path('api/process-payment/', views.process_payment, name='process_payment'),
+    path('api/payment-status/<str:checkout_request_id>/', views.payment_status, name='payment_status'),
+    path('api/mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
     
     # Admin seat layout management
     path('admin-seat-layouts/', views.admin_seat_layout, name='admin_seat_layout'),
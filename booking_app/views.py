@@ -1,14 +1,18 @@
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth import login
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.db.models import Q
-from django.core.mail import send_mail
 from django.conf import settings
-from datetime import timedelta
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from datetime import date
+import hashlib
 import json
+import logging
 import uuid
 from .models import *
 
@@ -23,17 +27,32 @@ from django.utils import timezone
 from django.core.mail import EmailMessage
 from django.template.loader import get_template
 from django.conf import settings
-from weasyprint import HTML, CSS
-from weasyprint.text.fonts import FontConfiguration
 from .models import Booking, TripSeatAvailability
 
 from .forms import SearchForm, BookingForm, GuestBookingForm
+from .search import cached_find_trips, fare_calendar, invalidate_trip_search_for
+from .connections import find_connections
+from .locations import location_index, search_locations
+from .idempotency import idempotent
+from .allocation import MAX_GROUP_SIZE, allocate_group
+from .bookings import create_booking, expire_booking
+from .pricing import distance_share, fare_table, held_prices, schedule_fare_refresh
+from .inventory import SeatsUnavailable, reserve_trip_seats, seat_map, trip_journey
+from .mpesa import MPESA_CALLBACK_TOKEN, MpesaError, apply_callback, callback_authorized, expire_stale_payments, initiate_payment
+from .receipts import current_receipt, queue_receipt, receipt_response
+
+logger = logging.getLogger(__name__)
+
+# Lifetime of the cached home page fragments; location changes retire them sooner
+HOME_PAGE_CACHE_TIMEOUT = getattr(settings, 'HOME_PAGE_CACHE_TIMEOUT', 600)
 
 def home(request):
     """Home page with search form"""
     search_form = SearchForm()
     return render(request, 'home.html', {
-        'search_form': search_form
+        'search_form': search_form,
+        'location_version': location_index().version,
+        'page_cache_timeout': HOME_PAGE_CACHE_TIMEOUT,
     })
 
 def location_autocomplete(request):
@@ -41,18 +60,26 @@ def location_autocomplete(request):
     # Replace request.is_ajax() with header check
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
         q = request.GET.get('term', '')
-        locations = Location.objects.filter(
-            name__icontains=q
-        )[:10]
-        results = []
-        for location in locations:
-            location_json = {
-                'id': location.id,
-                'label': location.name,
-                'value': location.name
-            }
-            results.append(location_json)
-        return JsonResponse(results, safe=False)
+        index = location_index()
+        
+        # Answers only change when the index version does
+        etag = f'"loc-{index.version}-{hashlib.md5(q.lower().encode()).hexdigest()[:12]}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+        else:
+            results = []
+            for location in search_locations(q):
+                location_json = {
+                    'id': location['id'],
+                    'label': location['name'],
+                    'value': location['name']
+                }
+                results.append(location_json)
+            response = JsonResponse(results, safe=False)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=300)
+        patch_vary_headers(response, ['X-Requested-With'])
+        return response
     return JsonResponse([], safe=False)
 
 def search_trips(request):
@@ -64,28 +91,18 @@ def search_trips(request):
             destination = form.cleaned_data['destination']
             travel_date = form.cleaned_data['travel_date']
             
-            # Find trips for the specified route and date
-            trips = Trip.objects.filter(
-                route__origin=origin,
-                route__destination=destination,
-                departure_time__date=travel_date,
-                status='SCHEDULED'
-            ).select_related('bus', 'bus__company', 'route')
-            
-            # Also include trips with intermediate stops
-            intermediate_trips = Trip.objects.filter(
-                route__stops__location=origin,
-                route__destination=destination,
-                departure_time__date=travel_date,
-                status='SCHEDULED'
-            ).exclude(
-                route__origin=origin
-            ).select_related('bus', 'bus__company', 'route')
+            # Whole routes and stop-to-stop segments come from one indexed query,
+            # cached per origin/destination/date until a trip or seat changes
+            all_trips = cached_find_trips(origin, destination, travel_date)
             
-            all_trips = list(trips) + list(intermediate_trips)
+            # No bus covers the whole way; offer itineraries with transfers
+            connections = []
+            if not all_trips:
+                connections = find_connections(origin.id, destination.id, travel_date, limit=5)
             
             return render(request, 'search_results.html', {
                 'trips': all_trips,
+                'connections': connections,
                 'origin': origin,
                 'destination': destination,
                 'travel_date': travel_date
@@ -93,45 +110,100 @@ def search_trips(request):
     
     return redirect('home')
 
+def fare_calendar_api(request):
+    """Lowest fare, trips and seats left per day around a travel date"""
+    try:
+        origin_id = int(request.GET['origin'])
+        destination_id = int(request.GET['destination'])
+        center_date = date.fromisoformat(request.GET.get('date') or timezone.localdate().isoformat())
+        days = min(max(int(request.GET.get('days', 3)), 0), 14)
+    except (KeyError, ValueError):
+        return JsonResponse({
+            'success': False,
+            'error': 'origin, destination and a valid date (YYYY-MM-DD) are required'
+        }, status=400)
+    
+    calendar = fare_calendar(origin_id, destination_id, center_date, days)
+    priced_days = [day for day in calendar if day['lowest_fare'] is not None]
+    cheapest = min(priced_days, key=lambda day: day['lowest_fare']) if priced_days else None
+    
+    response = JsonResponse({
+        'success': True,
+        'origin': origin_id,
+        'destination': destination_id,
+        'days': calendar,
+        'cheapest_date': cheapest['date'] if cheapest else None,
+    })
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
+
+def connections_api(request):
+    """Itineraries with up to two transfers between two locations"""
+    try:
+        origin_id = int(request.GET['origin'])
+        destination_id = int(request.GET['destination'])
+        travel_date = date.fromisoformat(request.GET['date'])
+        max_transfers = min(max(int(request.GET.get('max_transfers', 2)), 0), 2)
+    except (KeyError, ValueError):
+        return JsonResponse({
+            'success': False,
+            'error': 'origin, destination and a valid date (YYYY-MM-DD) are required'
+        }, status=400)
+    
+    itineraries = find_connections(origin_id, destination_id, travel_date, max_transfers)
+    return JsonResponse({'success': True, 'itineraries': itineraries})
+
+def requested_journey(trip, params):
+    """trip_journey() for the optional origin/destination location IDs in params; None if invalid"""
+    try:
+        origin_id = int(params.get('origin') or 0) or None
+        destination_id = int(params.get('destination') or 0) or None
+    except (TypeError, ValueError):
+        return None
+    return trip_journey(trip, origin_id, destination_id)
+
 def trip_seats(request, trip_id):
-    """Display seat layout for a specific trip"""
-    trip = get_object_or_404(Trip, id=trip_id)
+    """Display seat layout for a specific trip, optionally for one segment of its route"""
+    trip = get_object_or_404(
+        Trip.objects.select_related(
+            'bus__seat_layout', 'bus__company', 'route__origin', 'route__destination'
+        ),
+        id=trip_id
+    )
     bus = trip.bus
+    journey = requested_journey(trip, request.GET)
+    if journey is None:
+        raise Http404("This trip does not serve that journey")
+    pickup_id, dropoff_id, legs = journey
     
-    # Get seat availability for this trip
-    seat_availability = TripSeatAvailability.objects.filter(
-        trip=trip
-    ).select_related('seat')
-    
-    # Create availability dict
-    availability_dict = {
-        sa.seat.id: sa for sa in seat_availability
-    }
+    # Seat availability for this trip, from the cached seat map
+    availability = seat_map(trip.id)
+    now = timezone.now().timestamp()
     
     # Get all seats for the bus
     seats = Seat.objects.filter(bus=bus, is_active=True).order_by('row_number', 'column_number')
     
-    # Add availability info to seats
+    # Add availability and current fare to seats; rows are created with the
+    # trip, so a seat missing from the map is not on sale
+    fares = fare_table(trip, journey)
     for seat in seats:
-        seat.availability = availability_dict.get(seat.id)
-        if seat.availability:
-            seat.is_available = seat.availability.is_reservable()
-        else:
-            # Create availability record if not exists
-            TripSeatAvailability.objects.create(
-                trip=trip,
-                seat=seat,
-                is_available=True
-            )
-            seat.is_available = True
+        seat.is_available = availability.is_reservable(seat.id, now, legs)
+        seat.price = fares.get(seat.id)
     
+    locations = location_index().locations
     return render(request, 'seat_selection.html', {
         'trip': trip,
+        'pickup_id': pickup_id,
+        'dropoff_id': dropoff_id,
+        'pickup_name': locations.get(pickup_id, {}).get('name', trip.route.origin.name),
+        'dropoff_name': locations.get(dropoff_id, {}).get('name', trip.route.destination.name),
+        'base_fare': trip.base_price * trip.fare_factor * distance_share(trip.route, pickup_id, dropoff_id),
         'seats': seats,
         'layout_data': bus.seat_layout.layout_data
     })
 
 @csrf_exempt
+@idempotent
 def reserve_seats(request):
     """Reserve selected seats temporarily"""
     if request.method == 'POST':
@@ -139,101 +211,135 @@ def reserve_seats(request):
         trip_id = data.get('trip_id')
         seat_ids = data.get('seat_ids', [])
         
-        trip = get_object_or_404(Trip, id=trip_id)
+        trip = get_object_or_404(Trip.objects.select_related('route'), id=trip_id)
+        journey = requested_journey(trip, data)
         
-        # Check if seats are available
-        unavailable_seats = []
-        for seat_id in seat_ids:
-            try:
-                availability = TripSeatAvailability.objects.get(
-                    trip=trip,
-                    seat_id=seat_id
-                )
-                if not availability.is_reservable():
-                    unavailable_seats.append(seat_id)
-            except TripSeatAvailability.DoesNotExist:
-                unavailable_seats.append(seat_id)
+        try:
+            seat_ids = [int(seat_id) for seat_id in seat_ids]
+        except (TypeError, ValueError):
+            return JsonResponse({'success': False, 'message': 'Invalid seat selection'}, status=400)
+        if journey is None:
+            return JsonResponse({'success': False, 'message': 'This trip does not serve that journey'}, status=400)
         
-        if unavailable_seats:
+        # Check and hold every seat in one conditional update
+        try:
+            hold_token, reservation_time, seats = reserve_trip_seats(trip, seat_ids, fare_table(trip, journey), legs=journey[2])
+        except SeatsUnavailable as e:
             return JsonResponse({
                 'success': False,
                 'message': 'Some seats are no longer available',
-                'unavailable_seats': unavailable_seats
+                'unavailable_seats': e.seat_ids
             })
+        invalidate_trip_search_for([trip])
+        schedule_fare_refresh([trip])
+        
+        # Calculate total price from the fares locked in with the hold
+        total_price = sum([seat.price for seat in seats])
         
-        # Reserve seats for 5 minutes
-        reservation_time = timezone.now() + timedelta(minutes=5)
-        for seat_id in seat_ids:
-            TripSeatAvailability.objects.filter(
-                trip=trip,
-                seat_id=seat_id
-            ).update(
-                reserved_until=reservation_time
+        return JsonResponse({
+            'success': True,
+            'total_price': float(total_price),
+            'reservation_expires': reservation_time.isoformat(),
+            'hold_token': hold_token
+        })
+    
+    return JsonResponse({'success': False})
+
+@csrf_exempt
+@idempotent
+def quick_book(request):
+    """Pick and hold the best adjacent seats for a group"""
+    if request.method == 'POST':
+        data = json.loads(request.body)
+        trip = get_object_or_404(Trip.objects.select_related('route'), id=data.get('trip_id'))
+        journey = requested_journey(trip, data)
+        if journey is None:
+            return JsonResponse({'success': False, 'message': 'This trip does not serve that journey'}, status=400)
+        
+        try:
+            passengers = int(data.get('passengers', 0))
+        except (TypeError, ValueError):
+            passengers = 0
+        if not 1 <= passengers <= MAX_GROUP_SIZE:
+            return JsonResponse({
+                'success': False,
+                'message': f'Choose between 1 and {MAX_GROUP_SIZE} passengers'
+            }, status=400)
+        
+        # The seat map may lag a concurrent hold; skip seats we lost and retry
+        taken = set()
+        for attempt in range(3):
+            seat_ids = allocate_group(
+                trip, passengers,
+                seat_class=data.get('seat_class') or None,
+                prefer_window=bool(data.get('prefer_window')),
+                exclude=taken,
+                legs=journey[2],
             )
+            if seat_ids is None:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'No block of {passengers} seats together is available'
+                })
+            try:
+                hold_token, reservation_time, seats = reserve_trip_seats(trip, seat_ids, fare_table(trip, journey), legs=journey[2])
+                break
+            except SeatsUnavailable as e:
+                taken.update(e.seat_ids)
+        else:
+            return JsonResponse({
+                'success': False,
+                'message': 'Seats are selling fast, please try again'
+            })
+        invalidate_trip_search_for([trip])
+        schedule_fare_refresh([trip])
         
-        # Calculate total price
-        seats = Seat.objects.filter(id__in=seat_ids)
-        total_price = sum([
-            trip.base_price * seat.price_multiplier for seat in seats
-        ])
+        total_price = sum([seat.price for seat in seats])
+        seat_numbers = {seat.id: seat.seat_number for seat in seats}
         
         return JsonResponse({
             'success': True,
+            'seat_ids': seat_ids,
+            'seat_numbers': [seat_numbers[seat_id] for seat_id in seat_ids],
             'total_price': float(total_price),
-            'reservation_expires': reservation_time.isoformat()
+            'reservation_expires': reservation_time.isoformat(),
+            'hold_token': hold_token
         })
     
     return JsonResponse({'success': False})
 
 def booking_details(request, trip_id):
     """Collect booking details"""
-    trip = get_object_or_404(Trip, id=trip_id)
+    trip = get_object_or_404(Trip.objects.select_related('route'), id=trip_id)
     seat_ids = request.GET.get('seats', '').split(',')
+    hold_token = request.GET.get('hold')
+    journey = requested_journey(trip, request.GET)
     
-    if not seat_ids or not seat_ids[0]:
+    if not seat_ids or not seat_ids[0] or journey is None:
         return redirect('trip_seats', trip_id=trip_id)
     
-    seats = Seat.objects.filter(id__in=seat_ids)
-    total_price = sum([
-        trip.base_price * seat.price_multiplier for seat in seats
-    ])
+    seats = list(Seat.objects.filter(id__in=seat_ids))
+    prices = held_prices(trip, [seat.id for seat in seats], hold_token, journey)
+    for seat in seats:
+        seat.price = prices.get(seat.id)
+    total_price = sum([seat.price for seat in seats if seat.price is not None])
     
     if request.method == 'POST':
         form = GuestBookingForm(request.POST)
         if form.is_valid():
-            # Create booking
-            booking = Booking.objects.create(
-                booking_id=str(uuid.uuid4())[:12].upper(),
-                trip=trip,
-                user=request.user if request.user.is_authenticated else None,
-                passenger_name=form.cleaned_data['passenger_name'],
-                passenger_email=form.cleaned_data['passenger_email'],
-                passenger_phone=form.cleaned_data['passenger_phone'],
-                passenger_id_number=form.cleaned_data['passenger_id_number'],
-                passenger_age=form.cleaned_data['passenger_age'],
-                is_kenyan=form.cleaned_data['is_kenyan'],
-                pickup_location=trip.route.origin,
-                dropoff_location=trip.route.destination,
-                total_amount=total_price,
-                payment_phone=form.cleaned_data['passenger_phone']
-            )
-            
-            # Create booking seats
-            for seat in seats:
-                BookingSeat.objects.create(
-                    booking=booking,
-                    seat=seat,
-                    price=trip.base_price * seat.price_multiplier
-                )
-                
-                # Update seat availability
-                TripSeatAvailability.objects.filter(
-                    trip=trip,
-                    seat=seat
-                ).update(
-                    booking=booking,
-                    reserved_until=booking.expires_at
+            try:
+                booking = create_booking(
+                    trip,
+                    [seat.id for seat in seats],
+                    form.cleaned_data,
+                    user=request.user if request.user.is_authenticated else None,
+                    hold_token=hold_token,
+                    journey=journey
                 )
+            except SeatsUnavailable:
+                # The hold lapsed and someone else took a seat; choose again
+                return redirect('trip_seats', trip_id=trip_id)
+            invalidate_trip_search_for([trip])
             
             return redirect('payment', booking_id=booking.booking_id)
     else:
@@ -241,6 +347,8 @@ def booking_details(request, trip_id):
     
     return render(request, 'booking_details.html', {
         'trip': trip,
+        'pickup_id': journey[0],
+        'dropoff_id': journey[1],
         'seats': seats,
         'total_price': total_price,
         'form': form
@@ -254,18 +362,12 @@ def payment(request, booking_id):
         return redirect('booking_confirmation', booking_id=booking_id)
     
     if booking.is_expired():
-        booking.status = 'EXPIRED'
-        booking.save()
-        
         # Release seats
-        TripSeatAvailability.objects.filter(
-            booking=booking
-        ).update(
-            is_available=True,
-            reserved_until=None,
-            booking=None
-        )
-        
+        if not expire_booking(booking):
+            # Paid in the meantime
+            booking.refresh_from_db(fields=['status'])
+            if booking.status == 'CONFIRMED':
+                return redirect('booking_confirmation', booking_id=booking_id)
         return render(request, 'booking_expired.html', {'booking': booking})
     
     return render(request, 'payment.html', {
@@ -279,79 +381,99 @@ def booking_expired(request, booking_id):
     
     # Update booking status to expired if it's still pending
     if booking.is_expired() and booking.status == 'PENDING':
-        booking.status = 'EXPIRED'
-        booking.save()
-        
         # Release reserved seats
-        TripSeatAvailability.objects.filter(
-            booking=booking
-        ).update(
-            is_available=True,
-            reserved_until=None,
-            booking=None
-        )
+        expire_booking(booking)
     
     return render(request, 'booking_expired.html', {'booking': booking})
 
 
 @csrf_exempt
+@idempotent
 def process_payment(request):
-    """Process M-Pesa payment with automatic PDF email confirmation"""
+    """Start an M-Pesa STK push for a booking; the callback confirms it"""
     if request.method == 'POST':
         data = json.loads(request.body)
         booking_id = data.get('booking_id')
         phone_number = data.get('phone_number')
         
-        booking = get_object_or_404(Booking, booking_id=booking_id)
+        booking = get_object_or_404(Booking.objects.select_related('trip'), booking_id=booking_id)
+        
+        if booking.status == 'CONFIRMED':
+            return JsonResponse({
+                'success': True,
+                'status': 'PAID',
+                'transaction_id': booking.mpesa_transaction_id,
+                'booking_id': booking.booking_id,
+                'redirect_url': reverse('booking_confirmation', args=[booking_id])
+            })
         
         # Check if booking is still valid
-        if booking.is_expired():
+        if booking.is_expired() or booking.status != 'PENDING':
             return JsonResponse({
                 'success': False,
                 'error': 'Booking has expired',
-                'redirect_url': f'/booking/{booking_id}/expired/'
+                'redirect_url': reverse('booking_expired', args=[booking_id])
             })
         
-        # Mock M-Pesa payment processing
-        # In real implementation, integrate with Safaricom API
-        
+        callback_url = request.build_absolute_uri(reverse('mpesa_callback'))
+        if MPESA_CALLBACK_TOKEN:
+            callback_url += f'?token={MPESA_CALLBACK_TOKEN}'
         try:
-            # Simulate successful payment
-            booking.status = 'CONFIRMED'
-            booking.paid_at = timezone.now()
-            booking.mpesa_transaction_id = f"MPesa{uuid.uuid4().hex[:10].upper()}"
-            booking.payment_phone = phone_number
-            booking.save()
-            
-            # Update seat availability
-            TripSeatAvailability.objects.filter(
-                booking=booking
-            ).update(
-                is_available=False,
-                reserved_until=None
-            )
-            
-            # Send confirmation email with PDF attachment
-            email_sent = send_booking_confirmation_with_pdf(request, booking)
-            
-            return JsonResponse({
-                'success': True,
-                'transaction_id': booking.mpesa_transaction_id,
-                'booking_id': booking.booking_id,
-                'email_sent': email_sent,
-                'redirect_url': f'/booking/{booking_id}/confirmation/'
-            })
-            
-        except Exception as e:
-            # Log the error in production
-            print(f"Payment processing error: {str(e)}")
+            payment = initiate_payment(booking, phone_number or booking.payment_phone, callback_url)
+        except MpesaError as e:
+            logger.error(f"Payment processing error: {str(e)}")
             return JsonResponse({
                 'success': False,
-                'error': 'Payment processing failed. Please try again.'
+                'error': 'Could not reach M-Pesa. Please try again.'
             })
+        
+        return JsonResponse({
+            'success': True,
+            'status': payment.status,
+            'checkout_request_id': payment.checkout_request_id,
+            'booking_id': booking.booking_id,
+            'status_url': reverse('payment_status', args=[payment.checkout_request_id]),
+            'message': 'Check your phone and enter your M-Pesa PIN to complete payment'
+        })
     
     return JsonResponse({'success': False, 'error': 'Invalid request method'})
 
+@csrf_exempt
+def mpesa_callback(request):
+    """Safaricom's STK push result; always acknowledged so it is not resent"""
+    if request.method != 'POST':
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid request method'}, status=405)
+    if not callback_authorized(request.GET.get('token')):
+        logger.warning(f"Refused M-Pesa callback without a valid token from {get_client_ip(request)}")
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Forbidden'}, status=403)
+    try:
+        apply_callback(json.loads(request.body))
+    except ValueError:
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Malformed callback'}, status=400)
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+def payment_status(request, checkout_request_id):
+    """Polled by the payment page while the customer completes the push"""
+    payment = get_object_or_404(Payment.objects.select_related('booking'), checkout_request_id=checkout_request_id)
+    if payment.status == 'AWAITING_CALLBACK' and expire_stale_payments(Payment.objects.filter(id=payment.id)):
+        payment.status = 'TIMED_OUT'
+    booking = payment.booking
+    response = {
+        'success': True,
+        'status': payment.status,
+        'booking_status': booking.status,
+    }
+    if booking.status == 'CONFIRMED':
+        response['transaction_id'] = booking.mpesa_transaction_id
+        response['redirect_url'] = reverse('booking_confirmation', args=[booking.booking_id])
+    elif payment.status == 'PAID':
+        response['message'] = 'Payment received after the booking expired; it will be refunded'
+    elif payment.status == 'FAILED':
+        response['message'] = payment.result_desc or 'Payment failed'
+    elif payment.status == 'TIMED_OUT':
+        response['message'] = 'No response from M-Pesa. Please try again.'
+    return JsonResponse(response)
+
 
 def payment_failed(request):
     """
@@ -367,342 +489,6 @@ def payment_failed(request):
     response.status_code = 500
     return response
 
-def generate_booking_pdf(request, booking):
-    """Generate PDF for booking"""
-    try:
-        # Load the template
-        template = get_template('booking_pdf.html')
-        
-        # Context for the template
-        context = {
-            'booking': booking,
-            'company_info': {
-                'name': 'DreamLine Bus Service',
-                'address': 'P.O. Box 12345, Nairobi, Kenya',
-                'phone': '+254 700 123456',
-                'email': 'info@dreamlinebus.com',
-                'website': 'www.dreamlinebus.com'
-            }
-        }
-        
-        # Render HTML
-        html_string = template.render(context)
-        
-        # Generate PDF
-        font_config = FontConfiguration()
-        html = HTML(string=html_string, base_url=request.build_absolute_uri())
-        
-        # CSS for small horizontal receipt styling
-        css_string = """
-            @page {
-                size: 8.5in 4in;
-                margin: 0.2in;
-            }
-            body {
-                font-family: 'Courier New', monospace;
-                font-size: 8px;
-                line-height: 1.2;
-                margin: 0;
-                padding: 0;
-            }
-            .receipt-container {
-                border: 2px dashed #333;
-                padding: 8px;
-                height: calc(4in - 0.4in - 16px);
-                display: flex;
-                flex-direction: column;
-            }
-            .receipt-header {
-                text-align: center;
-                margin-bottom: 8px;
-                border-bottom: 1px solid #333;
-                padding-bottom: 4px;
-            }
-            .company-name {
-                font-size: 12px;
-                font-weight: bold;
-                margin-bottom: 2px;
-            }
-            .receipt-title {
-                font-size: 10px;
-                font-weight: bold;
-                margin-bottom: 2px;
-            }
-            .booking-id {
-                font-size: 9px;
-                font-weight: bold;
-                background: #000;
-                color: white;
-                padding: 2px 4px;
-                display: inline-block;
-                margin: 2px 0;
-            }
-            .receipt-body {
-                display: flex;
-                gap: 8px;
-                flex: 1;
-                font-size: 7px;
-            }
-            .column {
-                flex: 1;
-            }
-            .info-line {
-                margin-bottom: 2px;
-                display: flex;
-                justify-content: space-between;
-            }
-            .label {
-                font-weight: bold;
-                width: 45%;
-                text-transform: uppercase;
-            }
-            .value {
-                width: 55%;
-                text-align: right;
-            }
-            .section-divider {
-                border-bottom: 1px dashed #999;
-                margin: 4px 0;
-            }
-            .seats {
-                text-align: center;
-                font-weight: bold;
-                background: #f0f0f0;
-                padding: 2px;
-                margin: 2px 0;
-            }
-            .total-line {
-                font-size: 10px;
-                font-weight: bold;
-                text-align: center;
-                background: #000;
-                color: white;
-                padding: 4px;
-                margin: 4px 0;
-            }
-            .footer {
-                text-align: center;
-                font-size: 6px;
-                margin-top: 4px;
-                border-top: 1px solid #333;
-                padding-top: 4px;
-            }
-            .status {
-                display: inline-block;
-                padding: 1px 4px;
-                background: #28a745;
-                color: white;
-                font-size: 6px;
-                border-radius: 2px;
-            }
-            .barcode {
-                text-align: center;
-                font-family: 'Courier New', monospace;
-                font-size: 6px;
-                letter-spacing: 2px;
-                margin: 2px 0;
-            }
-        """
-        
-        main_css = CSS(string=css_string, font_config=font_config)
-        
-        # Generate PDF
-        pdf = html.render(stylesheets=[main_css], font_config=font_config)
-        
-        return pdf.write_pdf()
-        
-    except Exception as e:
-        print(f"PDF generation error: {str(e)}")
-        return None
-
-def send_booking_confirmation_with_pdf(request, booking):
-    """Send booking confirmation email with PDF attachment"""
-    try:
-        # Generate PDF
-        pdf_content = generate_booking_pdf(request, booking)
-        if not pdf_content:
-            # Fallback to sending email without PDF
-            return send_booking_confirmation_text_only(booking)
-        
-        # Email subject and content
-        subject = f'Booking Confirmed - {booking.booking_id} | DreamLine Bus Service'
-        
-        # HTML email template
-        html_message = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-                .header {{ background: #28a745; color: white; padding: 20px; text-align: center; }}
-                .content {{ padding: 20px; }}
-                .booking-info {{ background: #f8f9fa; padding: 15px; border-radius: 5px; margin: 15px 0; }}
-                .seats {{ background: #007bff; color: white; padding: 5px 10px; border-radius: 3px; margin: 2px; }}
-                .total {{ font-size: 18px; font-weight: bold; color: #28a745; }}
-                .footer {{ background: #f8f9fa; padding: 15px; text-align: center; font-size: 12px; color: #666; }}
-                .important {{ background: #fff3cd; padding: 10px; border-radius: 5px; margin: 15px 0; border-left: 4px solid #ffc107; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>🎉 Booking Confirmed!</h1>
-                <p>Thank you for choosing DreamLine Bus Service</p>
-            </div>
-            
-            <div class="content">
-                <p>Dear {booking.passenger_name},</p>
-                
-                <p>Great news! Your booking has been successfully confirmed and payment processed.</p>
-                
-                <div class="booking-info">
-                    <h3>📋 Booking Details</h3>
-                    <p><strong>Booking ID:</strong> {booking.booking_id}</p>
-                    <p><strong>Route:</strong> {booking.trip.route}</p>
-                    <p><strong>Bus Company:</strong> {booking.trip.bus.company.name}</p>
-                    <p><strong>Bus Number:</strong> {booking.trip.bus.number_plate}</p>
-                    <p><strong>Departure:</strong> {booking.trip.departure_time.strftime('%B %d, %Y at %H:%M')}</p>
-                    <p><strong>Arrival:</strong> {booking.trip.arrival_time.strftime('%B %d, %Y at %H:%M')}</p>
-                    <p><strong>Pickup Location:</strong> {booking.pickup_location.name}</p>
-                    <p><strong>Drop-off Location:</strong> {booking.dropoff_location.name}</p>
-                    <p><strong>Seats:</strong> 
-                        {' '.join([f'<span class="seats">{seat.seat.seat_number}</span>' for seat in booking.booked_seats.all()])}
-                    </p>
-                    <p class="total"><strong>Total Paid:</strong> KSh {booking.total_amount:,.0f}</p>
-                    <p><strong>Transaction ID:</strong> {booking.mpesa_transaction_id}</p>
-                </div>
-                
-                <div class="important">
-                    <h4>🚨 Important Information:</h4>
-                    <ul>
-                        <li><strong>Arrive 30 minutes early</strong> at the pickup location</li>
-                        <li>Bring a <strong>valid ID</strong> for verification</li>
-                        <li>Keep this confirmation and the attached receipt for your records</li>
-                        <li>Contact us immediately if you need to make changes</li>
-                    </ul>
-                </div>
-                
-                <h4>📞 Need Help?</h4>
-                <p>Our customer support team is available 24/7:</p>
-                <ul>
-                    <li>📱 Phone: +254 700 123456</li>
-                    <li>📧 Email: support@dreamlinebus.com</li>
-                    <li>🌐 Website: www.dreamlinebus.com</li>
-                </ul>
-                
-                <p>Have a safe and comfortable journey!</p>
-                
-                <p>Best regards,<br>
-                <strong>DreamLine Bus Service Team</strong></p>
-            </div>
-            
-            <div class="footer">
-                <p>This is an automated email. Please do not reply directly to this message.</p>
-                <p>© 2024 DreamLine Bus Service. All rights reserved.</p>
-            </div>
-        </body>
-        </html>
-        """
-        
-        # Plain text version
-        text_message = f"""
-        Booking Confirmed - {booking.booking_id}
-        
-        Dear {booking.passenger_name},
-        
-        Your booking has been successfully confirmed!
-        
-        BOOKING DETAILS:
-        ================
-        Booking ID: {booking.booking_id}
-        Route: {booking.trip.route}
-        Bus Company: {booking.trip.bus.company.name}
-        Departure: {booking.trip.departure_time.strftime('%B %d, %Y at %H:%M')}
-        Arrival: {booking.trip.arrival_time.strftime('%B %d, %Y at %H:%M')}
-        Pickup: {booking.pickup_location.name}
-        Drop-off: {booking.dropoff_location.name}
-        Seats: {', '.join([seat.seat.seat_number for seat in booking.booked_seats.all()])}
-        Total Paid: KSh {booking.total_amount:,.0f}
-        Transaction ID: {booking.mpesa_transaction_id}
-        
-        IMPORTANT:
-        - Arrive 30 minutes early at pickup location
-        - Bring valid ID for verification
-        - Keep this confirmation for your records
-        
-        Need help? Contact us at +254 700 123456 or support@dreamlinebus.com
-        
-        Thank you for choosing DreamLine Bus Service!
-        """
-        
-        # Create email message
-        email = EmailMessage(
-            subject=subject,
-            body=text_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[booking.passenger_email],
-            reply_to=['support@dreamlinebus.com'],
-        )
-        
-        # Add HTML version
-        email.content_subtype = 'html'
-        email.body = html_message
-        
-        # Attach PDF
-        email.attach(
-            f'booking_{booking.booking_id}.pdf',
-            pdf_content,
-            'application/pdf'
-        )
-        
-        # Send email
-        email.send(fail_silently=False)
-        
-        return True
-        
-    except Exception as e:
-        print(f"Email sending error: {str(e)}")
-        # Try to send text-only email as fallback
-        return send_booking_confirmation_text_only(booking)
-
-def send_booking_confirmation_text_only(booking):
-    """Fallback method to send text-only confirmation email"""
-    try:
-        from django.core.mail import send_mail
-        
-        subject = f'Booking Confirmed - {booking.booking_id}'
-        message = f"""
-        Dear {booking.passenger_name},
-        
-        Your booking has been confirmed!
-        
-        Booking ID: {booking.booking_id}
-        Route: {booking.trip.route}
-        Departure: {booking.trip.departure_time.strftime('%Y-%m-%d %H:%M')}
-        Seats: {', '.join([bs.seat.seat_number for bs in booking.booked_seats.all()])}
-        Total Amount: KSh {booking.total_amount}
-        Transaction ID: {booking.mpesa_transaction_id}
-        
-        Please arrive at the pickup location 30 minutes before departure.
-        
-        Thank you for choosing {booking.trip.bus.company.name}!
-        
-        For support: +254 700 123456
-        """
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [booking.passenger_email],
-            fail_silently=True,
-        )
-        
-        return True
-        
-    except Exception as e:
-        print(f"Fallback email error: {str(e)}")
-        return False
-
 def booking_confirmation(request, booking_id):
     """Show booking confirmation"""
     booking = get_object_or_404(Booking, booking_id=booking_id)
@@ -755,162 +541,42 @@ def save_seat_layout(request):
 from django.http import HttpResponse
 from django.template.loader import get_template
 from django.shortcuts import get_object_or_404
-from weasyprint import HTML, CSS
-from weasyprint.text.fonts import FontConfiguration
 import tempfile
 import os
 from .models import Booking
 
 def download_booking_pdf(request, booking_id):
     """
-    Generate and download PDF receipt for booking
-    """
-    # Get the booking object
-    booking = get_object_or_404(Booking, booking_id=booking_id)
-    
-    # Load the template
-    template = get_template('booking_pdf.html')
-    
-    # Context for the template
-    context = {
-        'booking': booking,
-        'company_info': {
-            'name': 'DreamLine Bus Service',
-            'address': 'P.O. Box 12345, Nairobi, Kenya',
-            'phone': '+254 700 123456',
-            'email': 'info@dreamlinebus.com'
-        }
-    }
-    
-    # Render HTML
-    html_string = template.render(context)
-    
-    # Generate PDF
-    font_config = FontConfiguration()
-    html = HTML(string=html_string, base_url=request.build_absolute_uri())
-    
-    # CSS for small horizontal receipt styling
-    css_string = """
-        @page {
-            size: 8.5in 4in;
-            margin: 0.2in;
-        }
-        body {
-            font-family: 'Courier New', monospace;
-            font-size: 8px;
-            line-height: 1.2;
-            margin: 0;
-            padding: 0;
-        }
-        .receipt-container {
-            border: 2px dashed #333;
-            padding: 8px;
-            height: calc(4in - 0.4in - 16px);
-            display: flex;
-            flex-direction: column;
-        }
-        .receipt-header {
-            text-align: center;
-            margin-bottom: 8px;
-            border-bottom: 1px solid #333;
-            padding-bottom: 4px;
-        }
-        .company-name {
-            font-size: 12px;
-            font-weight: bold;
-            margin-bottom: 2px;
-        }
-        .receipt-title {
-            font-size: 10px;
-            font-weight: bold;
-            margin-bottom: 2px;
-        }
-        .booking-id {
-            font-size: 9px;
-            font-weight: bold;
-            background: #000;
-            color: white;
-            padding: 2px 4px;
-            display: inline-block;
-            margin: 2px 0;
-        }
-        .receipt-body {
-            display: flex;
-            gap: 8px;
-            flex: 1;
-            font-size: 7px;
-        }
-        .column {
-            flex: 1;
-        }
-        .info-line {
-            margin-bottom: 2px;
-            display: flex;
-            justify-content: space-between;
-        }
-        .label {
-            font-weight: bold;
-            width: 45%;
-            text-transform: uppercase;
-        }
-        .value {
-            width: 55%;
-            text-align: right;
-        }
-        .section-divider {
-            border-bottom: 1px dashed #999;
-            margin: 4px 0;
-        }
-        .seats {
-            text-align: center;
-            font-weight: bold;
-            background: #f0f0f0;
-            padding: 2px;
-            margin: 2px 0;
-        }
-        .total-line {
-            font-size: 10px;
-            font-weight: bold;
-            text-align: center;
-            background: #000;
-            color: white;
-            padding: 4px;
-            margin: 4px 0;
-        }
-        .footer {
-            text-align: center;
-            font-size: 6px;
-            margin-top: 4px;
-            border-top: 1px solid #333;
-            padding-top: 4px;
-        }
-        .status {
-            display: inline-block;
-            padding: 1px 4px;
-            background: #28a745;
-            color: white;
-            font-size: 6px;
-            border-radius: 2px;
-        }
-        .barcode {
-            text-align: center;
-            font-family: 'Courier New', monospace;
-            font-size: 6px;
-            letter-spacing: 2px;
-            margin: 2px 0;
-        }
+    Download PDF receipt for booking
+
+    The receipt is rendered once per version of the booking data and then
+    streamed from disk; the version doubles as the ETag. A version not yet
+    in the store is rendered by a background job while the client gets a
+    202 asking it to retry.
     """
-    
-    main_css = CSS(string=css_string, font_config=font_config)
-    
-    # Generate PDF
-    pdf = html.render(stylesheets=[main_css], font_config=font_config)
-    
-    # Create HTTP response
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="booking_{booking_id}.pdf"'
-    response.write(pdf.write_pdf())
-    
+    booking = get_object_or_404(
+        Booking.objects.select_related(
+            'trip__route__origin', 'trip__route__destination', 'trip__bus__company',
+            'pickup_location', 'dropoff_location'
+        ).prefetch_related('booked_seats__seat'),
+        booking_id=booking_id
+    )
+    path, version = current_receipt(booking)
+    etag = f'"receipt-{version}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    elif path is None:
+        queue_receipt(booking, version)
+        response = HttpResponse('Your receipt is being prepared. Please try again in a moment.', status=202)
+        response['Retry-After'] = '5'
+        # Browsers following the plain download link reload on their own
+        response['Refresh'] = '5'
+        return response
+    else:
+        response = receipt_response(path, f'booking_{booking.booking_id}.pdf')
+    response['ETag'] = etag
+    # Receipts carry passenger details: browsers may keep them but must revalidate
+    patch_cache_control(response, private=True, no_cache=True)
     return response
 
 
@@ -1064,7 +730,6 @@ from django.template import RequestContext
 from django.views.decorators.csrf import requires_csrf_token
 import logging
 
-logger = logging.getLogger(__name__)
 
 @requires_csrf_token
 def custom_404(request, exception=None):